@@ -1,41 +1,67 @@
 #!/usr/bin/env python3
 
+import time
+STARTUP_PHASES = [('start', time.perf_counter())]
+
 import os
 import sys
-import io
 import re
-import random
 import datetime
-import string
-import subprocess
 import yaml
 import shutil
 import hashlib
-from PIL import Image
+import collections
+import json
+import functools
+import types
+import contextlib
+import stat
+import threading
 
 import bottle
 from bottle import (
         route, request, response, run, static_file,
-        HTTPError, get, post, template, redirect, abort)
+        HTTPError, get, post, put, template, redirect, abort)
 
 # Assumes the admin.py file is in immediate subdir of the project directory
 BASEDIR = os.path.split(os.path.dirname(__file__))[0]
 bottle.TEMPLATE_PATH = [os.path.join(os.path.dirname(__file__), 'views')]
+# For the modules in wmkadmin/ (see wmkadmin.common.BASEDIR)
+os.environ['WMK_ADMIN_BASEDIR'] = BASEDIR
+
+from wmkadmin.common import (
+    CACHES, CONFIG_CACHE, EDITABLE_EXTENSIONS, atomic_write, base64, bisect,
+    difflib, fcntl, get_config, heapq, hmac, metric_line, secrets, sqlite3,
+    subprocess, wmk)
+from wmkadmin.caches import (
+    DIR_ROWS, DIRECTORY_TREE, GIT_STATUS, HTDOCS_MANIFEST, HTML_VARIANTS,
+    IMAGE_SIZES, PRECOMPRESSED_EXTENSIONS, PREVIEWS, RECENT_CHANGES, REFERENCES,
+    SEARCH_INDEX, THUMBNAILS, guess_mimetype)
+from wmkadmin.deploy import BUILD_QUEUE, BUILD_TELEMETRY, DEPLOYS
+from wmkadmin.uploads import UPLOADS
+from wmkadmin.watcher import WATCHER, files_changed
+
+STARTUP_PHASES.append(('imports', time.perf_counter()))
+
+
+def load_svg_icons(svg_dir):
+    "The icons in `svg_dir` as a read-only mapping of name (without .svg) to markup."
+    icons = {}
+    for fn in sorted(os.listdir(svg_dir)):
+        if fn.endswith('.svg'):
+            with open(os.path.join(svg_dir, fn)) as f:
+                icons[fn[:-4]] = f.read()
+    return types.MappingProxyType(icons)
+
+
+# Available as `svg` in all templates
+SVG_ICONS = load_svg_icons(os.path.join(bottle.TEMPLATE_PATH[0], 'svg'))
+bottle.BaseTemplate.defaults['svg'] = SVG_ICONS
 
 COOKIE_NAME = 'wmk_' + re.sub(r'\W', '', BASEDIR)
 
-EDITABLE_EXTENSIONS = (
-    # wmk content which can be handled without pandoc:
-    'md', 'mdwn', 'mdown', 'markdown', 'mmd', 'gfm', 'html', 'htm',
-    # wmk content which requires pandoc:
-    'org', 'rst', 'tex', 'man', 'rtf', 'textile', 'xml', 'jats', 'tei', 'docbook',
-    # other common text-based formats:
-    'yaml', 'yml', 'json', 'js', 'css', 'scss',
-    'csv', 'txt', 'sgml', 'ini', 'toml', 'svg',
-    # Mako templates:
-    'mhtml', 'mc', 'mako', )
-
-# Map the above extensions to Ace Editor modes.
+
+# Map EDITABLE_EXTENSIONS to Ace Editor modes.
 # Without available Ace modes: org, man, rtf, csv, txt
 ACE_EDITOR_MODES = {
     'md': 'markdown',
@@ -72,17 +98,63 @@ ACE_EDITOR_MODES = {
 IMG_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'svg', )
 ATTACHMENT_EXTENSIONS = ('pdf', 'docx', 'odt', 'zip', 'tar', 'gz', 'mp3', 'm4a', )
 
-# Find out where wmk resides and add it to the python path
-wmkenv_info = subprocess.run(["wmk", "env", "."], cwd=BASEDIR,
-                         capture_output=True, text=True)
-wfound = re.search(r'wmk home: (.*)', wmkenv_info.stdout)
-if wfound:
-    sys.path.append(wfound.group(1))
-    import wmk
+
+def find_wmk_home():
+    """
+    Find the directory containing wmk.py. The `WMK_HOME` environment
+    variable takes precedence, then the `wmk_home` setting in wmk_admin.yaml
+    and then the location found the last time (stored in tmp/wmk_home).
+    Only if none of these is valid is `wmk env` run (which is slow).
+    """
+    def valid(path):
+        return bool(path) and os.path.isfile(os.path.join(path, 'wmk.py'))
+    home = os.environ.get('WMK_HOME')
+    if valid(home):
+        return home
+    try:
+        with open(os.path.join(BASEDIR, 'wmk_admin.yaml')) as f:
+            home = (yaml.safe_load(f) or {}).get('wmk_home')
+        if valid(home):
+            return home
+    except Exception:
+        pass
+    cache_file = os.path.join(BASEDIR, 'tmp', 'wmk_home')
+    try:
+        with open(cache_file) as f:
+            home = f.read().strip()
+        if valid(home):
+            return home
+    except OSError:
+        pass
+    try:
+        wmkenv_info = subprocess.run(["wmk", "env", "."], cwd=BASEDIR,
+                                     capture_output=True, text=True)
+    except OSError:
+        return None
+    wfound = re.search(r'wmk home: (.*)', wmkenv_info.stdout)
+    if not wfound:
+        return None
+    home = wfound.group(1).strip()
+    try:
+        with open(cache_file, 'w') as f:
+            f.write(home)
+    except OSError:
+        pass
+    return home
+
+
+# Find out where wmk resides and add it to the python path. Both wmk and
+# PIL are imported on first use (see wmkadmin.common).
+WMK_HOME = find_wmk_home()
+if WMK_HOME:
+    if WMK_HOME not in sys.path:
+        sys.path.append(WMK_HOME)
 else:
     print("ERROR: Could not load wmk environment. Is wmk installed?")
     sys.exit(1)
 
+STARTUP_PHASES.append(('wmk lookup', time.perf_counter()))
+
 # ----- Decorator(s) --------
 
 def authorize(fn):
@@ -122,14 +194,10 @@ def login_post():
         pass_match = True
         msg = 'The password in wmk_config.yaml is in plaintext. For increased security, you should hash it using SHA256.'
     if pass_match:
-        val = ''.join(random.choices(string.ascii_letters, k=20))
-        tmpdir = os.path.join(BASEDIR, 'tmp')
-        filename = os.path.join(tmpdir, val + '.session')
-        with open(filename, 'w') as f:
-            f.write(COOKIE_NAME + ' ' + str(datetime.datetime.now()))
-        response.set_cookie(COOKIE_NAME, val, path='/')
+        sid = SESSIONS.create()
+        response.set_cookie(COOKIE_NAME, sid, path='/', httponly=True)
         if msg:
-            set_flash_message(request, msg, filename=filename)
+            set_flash_message(request, msg, status='warning')
         return template('soft_redirect.tpl')
     else:
         return template('login.tpl', err=True, conf_err=False)
@@ -137,9 +205,9 @@ def login_post():
 
 @get('/_/admin/logout/')
 def logout():
-    filename = is_logged_in(request)
-    if filename:
-        os.remove(filename)
+    sid = is_logged_in(request)
+    if sid:
+        SESSIONS.delete(sid)
     response.delete_cookie(COOKIE_NAME, path='/')
     response.set_header('Cache-Control', 'no-store')
     redirect('/_/admin/login/')
@@ -151,55 +219,211 @@ def upload_get():
     return upload_form()
 
 
-@post('/_/admin/upload/')
+@post('/_/admin/upload/chunked/')
 @authorize
-def upload_post():
-    return handle_upload(request)
+def chunked_upload_start():
+    "Start a chunked upload (see the ChunkedUploads class)."
+    kind = request.forms.get('kind', 'file')
+    if kind not in ('file', 'attachment'):
+        abort(400, 'Unknown kind of upload')
+    try:
+        size = int(request.forms.get('size', ''))
+    except ValueError:
+        abort(400, 'The size of the file must be given')
+    upload_id = UPLOADS.start(
+        kind, request.forms.getunicode('dest_dir') or '',
+        request.forms.getunicode('filename') or '', size,
+        request.forms.getunicode('dest_name') or '')
+    return {'id': upload_id, 'offset': 0, 'chunk_size': UPLOADS.CHUNK_SIZE}
 
 
-@post('/_/admin/edit-upload/')
+@get('/_/admin/upload/chunked/<upload_id>')
 @authorize
-def edit_upload():
-    return handle_attachment_upload(request)
+def chunked_upload_info(upload_id):
+    "Where to resume an interrupted upload."
+    meta = UPLOADS.info(upload_id)
+    return {'id': upload_id, 'offset': meta['offset'], 'size': meta['size'],
+            'chunk_size': UPLOADS.CHUNK_SIZE}
+
+
+@put('/_/admin/upload/chunked/<upload_id>')
+@authorize
+def chunked_upload_chunk(upload_id):
+    """
+    Receive one chunk as the raw request body. The `offset` query parameter
+    says where it belongs; the optional X-Chunk-SHA256 header is its hash.
+    """
+    length = request.content_length
+    if length < 0:
+        abort(411, 'Content-Length is required')
+    try:
+        offset = int(request.query.get('offset', ''))
+    except ValueError:
+        abort(400, 'The offset of the chunk must be given')
+    offset = UPLOADS.write_chunk(
+        upload_id, offset, request.environ['wsgi.input'], length,
+        request.get_header('X-Chunk-SHA256'))
+    return {'id': upload_id, 'offset': offset}
+
+
+@post('/_/admin/upload/chunked/finish/')
+@authorize
+def chunked_upload_finish():
+    """
+    Move a batch of completed uploads (the comma-separated `ids`, all with
+    the same destination) into place, with a single build for the batch.
+    """
+    ids = [_ for _ in (request.forms.get('ids') or '').split(',') if _]
+    if not ids:
+        abort(400, 'No uploads given')
+    kind, dest_dir, paths, refused = UPLOADS.finish(ids)
+    if kind == 'attachment':
+        return {'html': attachments_uploaded(dest_dir, paths, refused),
+                'refused': [{'name': name, 'reason': reason} for name, reason in refused]}
+    files_changed(paths)
+    IMAGE_SIZES.warm(paths)
+    THUMBNAILS.warm(paths)
+    if len(paths) == 1:
+        msg = "File %s uploaded to %s" % (os.path.basename(paths[0]), dest_dir)
+    else:
+        msg = "%d files uploaded to %s" % (len(paths), dest_dir)
+    BUILD_QUEUE.submit(msg, paths=paths)
+    set_flash_message(request, msg)
+    return {'redirect': '/_/admin/list/%s' % dest_dir}
 
 
 @get('/_/admin/build/')
 @authorize
 def build_site():
     hard_rebuild = request.params.get('hard', False)
-    wmk_build('Manually requested', hard_rebuild)
-    msg = 'The site was rebuilt.'
+    BUILD_QUEUE.submit('Manually requested', hard=bool(hard_rebuild))
+    msg = 'The site is being rebuilt in the background.'
     if hard_rebuild:
-        msg += ' The contents of the htdocs directory and the cache were removed first (hard rebuild).'
-    # the S says that the status is success
-    set_flash_message(request, 'S:'+msg)
+        msg += ' The contents of the htdocs directory and the cache will be removed first (hard rebuild).'
+    set_flash_message(request, msg)
     redirect('/_/admin/')
 
 
+@get('/_/admin/build/status/')
+@authorize
+def build_status():
+    "Queue depth, currently running build and the last finished build as JSON."
+    return BUILD_QUEUE.status()
+
+
+@get('/_/admin/thumb/<size:int>/<filename:re:(?:content|static|data)/.+>')
+@authorize
+def thumbnail(size, filename):
+    "Downscaled version of an image, cached on disk and in the browser."
+    if size not in THUMBNAILS.SIZES:
+        abort(404, "Unsupported thumbnail size")
+    full_path = os.path.join(BASEDIR, filename)
+    if not filename.lower().endswith(THUMBNAILS.IMAGE_SUFFIXES) or not os.path.isfile(full_path):
+        abort(404, "Not found")
+    try:
+        thumb_path = THUMBNAILS.get(full_path, size)
+    except Exception as e:
+        abort(404, "Could not make a thumbnail: %s" % e)
+    resp = static_file(os.path.basename(thumb_path), root=os.path.dirname(thumb_path),
+                       mimetype=THUMBNAILS.mimetype)
+    # The URL contains the mtime of the source, so the thumbnail never changes
+    resp.set_header('Cache-Control', 'private, max-age=31536000, immutable')
+    return resp
+
+
+@get('/_/admin/dirs/')
+@authorize
+def list_directories():
+    """
+    The subdirectories of content, data and static as JSON, one level at a
+    time: without a `parent` parameter, the top-level directories are
+    returned.
+    """
+    parent = request.params.getunicode('parent') or None
+    dirs = DIRECTORY_TREE.children(parent)
+    if dirs is None:
+        abort(404, "Unknown directory")
+    return {'parent': parent, 'dirs': dirs}
+
+
+@get('/_/admin/metrics')
+@get('/_/admin/metrics/')
+def metrics():
+    """
+    Request latency per route, build durations and cache hit rates in the
+    Prometheus text format.  Requires login, or the `metrics_token` from
+    wmk_admin.yaml as a bearer token.
+    """
+    token = get_config(BASEDIR, 'wmk_admin').get('metrics_token')
+    auth = request.get_header('Authorization', '')
+    if not (token and hmac.compare_digest(auth.encode(), b'Bearer ' + str(token).encode())):
+        if not is_logged_in(request):
+            abort(401, "Login or metrics token required")
+    response.set_header('Cache-Control', 'no-store')
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    lines = REQUEST_METRICS.metrics() + BUILD_TELEMETRY.metrics() + cache_metrics()
+    return "\n".join(lines) + "\n"
+
+
+@get('/_/admin/cache-stats/')
+@authorize
+def cache_stats():
+    "Hit/miss counters of the in-process caches as JSON."
+    return dict((name, cache.stats()) for name, cache in CACHES.items())
+
+
 @get('/_/admin/deploy/')
 @authorize
 def deploy_site():
     conf = get_config(BASEDIR, 'wmk_admin')
     deploy_command = conf.get('deploy')
     if deploy_command:
-        wmk_build('Rebuilding before DEPLOY action')
-        depl_res = subprocess.run(deploy_command, cwd=BASEDIR,
-                                  capture_output=True, text=True)
-        logfile = os.path.join(BASEDIR, 'tmp/admin.log')
-        depl_log = os.path.join(BASEDIR, 'tmp/deploy.log')
-        now = datetime.datetime.now()
-        with open(logfile, 'a') as f:
-            f.write("\n=====\nRan DEPLOY at %s. Output:\n" % str(now))
-            if depl_res.stdout:
-                f.write(depl_res.stdout)
-        with open(depl_log, 'a') as f:
-            f.write("DEPLOY " + str(now) + "\n")
-        set_flash_message(request, 'S:Rebuilt and published site (ran deployment command).')
+        job, started = DEPLOYS.start(
+            deploy_command, timeout=float(conf.get('deploy_timeout', 600)))
+        if started:
+            set_flash_message(
+                request, 'Started rebuilding and publishing the site. Its progress is shown below.')
+        elif job:
+            set_flash_message(
+                request, 'A deployment is already running; see its progress below.',
+                status='warning')
+        else:
+            set_flash_message(
+                request, 'A deployment started from another admin process is still running.',
+                status='warning')
     else:
-        set_flash_message('No deployment command specified in configuration file')
+        set_flash_message(
+            request, 'No deployment command specified in configuration file',
+            status='warning')
     redirect('/_/admin/')
 
 
+@get('/_/admin/deploy/<job_id:re:[0-9a-f]+>/log/')
+@authorize
+def deploy_log(job_id):
+    """
+    Status and new output lines of a deployment as JSON. Only lines numbered
+    above the `after` parameter are included; `next` is the value to pass
+    next time.
+    """
+    try:
+        after = int(request.params.get('after', 0))
+    except ValueError:
+        after = 0
+    ret = DEPLOYS.tail(job_id, after)
+    if ret is None:
+        abort(404, "No such deployment")
+    return ret
+
+
+@post('/_/admin/deploy/<job_id:re:[0-9a-f]+>/cancel/')
+@authorize
+def deploy_cancel(job_id):
+    if not DEPLOYS.cancel(job_id):
+        abort(409, "The deployment is not running")
+    return {'cancelled': job_id}
+
+
 @get('/_/admin/edit/<section:re:content|data|static|templates>/<filename:re:.*>')
 @authorize
 def content_file_form(section, filename):
@@ -235,10 +459,19 @@ def edit_config_save():
 
 
 @post('/_/admin/preview/')
+@authorize
 def preview_html():
-    filename = request.params.get('filename')
-    source = request.params.get('source')
-    html = wmk.preview_single(BASEDIR, filename, source)
+    filename = request.forms.getunicode('filename')
+    source = request.forms.getunicode('source')
+    try:
+        seq = int(request.forms.get('seq', 0))
+    except ValueError:
+        seq = 0
+    html = PREVIEWS.render(filename, source, session=is_logged_in(request), seq=seq)
+    if html is None:
+        # A newer preview has been requested in the meantime
+        response.status = 204
+        return ''
     return html
 
 
@@ -246,11 +479,7 @@ def preview_html():
 @route('/_/admin/')
 @authorize
 def admin_frontpage():
-    msg = get_flash_message(request) or ''
-    msg_status = 'warning'
-    if msg.startswith('S:'):
-        msg = msg[2:]
-        msg_status = 'success'
+    msg, msg_status = get_flash_message(request)
     conf = get_config(BASEDIR)
     site = conf.get('site', {})
     adm_conf = get_config(BASEDIR, 'wmk_admin')
@@ -265,7 +494,8 @@ def admin_frontpage():
             break
     return template('frontpage.tpl', flash_message=msg,
                     msg_status=msg_status, site_title=site_title,
-                    deploy=deploy, status_info=status_info,
+                    deploy=deploy, deploy_job=DEPLOYS.latest(),
+                    status_info=status_info,
                     adm_conf=adm_conf, recent_changes=recent_changes)
 
 
@@ -273,63 +503,72 @@ def admin_frontpage():
 @route('/_/admin/list/<section:re:content|data|static|templates>/<dirname:re:.*>')
 @authorize
 def list_dir(section, dirname=''):
-    start = datetime.datetime.now()
     full_dirname = os.path.join(BASEDIR, section, dirname)
     if not os.path.exists(full_dirname):
         abort(404, f"Directory {full_dirname} not found")
-    dir_entries = [_ for _ in os.scandir(full_dirname)
-                   if not _.name in ('.git', '.gitignore')]
     sort_by_date = request.params.get('sort', '') == 'date'
-    if sort_by_date:
-        ordering = {
-            'reverse': True,
-            'key': lambda x: x.stat().st_mtime,
-        }
-    else:
-        ordering = {'key': lambda x: x.name}
-    dir_entries.sort(**ordering)
-    total_entries = len(dir_entries)
     search = request.params.getunicode('search')
-    # TODO: search in subdirs as well (although that requires some
-    #       changes to the file list format)
-    if search and search.strip():
-        search_expr = wmk.slugify(search)
-        if search_expr:
-            keep = []
-            for it in dir_entries:
-                if search_expr in it.name:
-                    keep.append(it)
-                elif it.name.endswith(('.md', '.mdwn', '.markdown')):
-                    with open(os.path.join(full_dirname, it.name)) as f:
-                        for line in f:
-                            if line == '---':
-                                break
-                            if re.match(r'title:.*'+search, line, flags=re.I):
-                                keep.append(it)
-            dir_entries = keep
-    flash_message = get_flash_message(request)
-    svg_dir = os.path.join(bottle.TEMPLATE_PATH[0], 'svg')
-    end = datetime.datetime.now()
-    page = int(request.params.get('p', 1))
+    flash_message, msg_status = get_flash_message(request)
+    try:
+        page = max(int(request.params.get('p', 1)), 1)
+    except ValueError:
+        abort(400, 'Invalid page number')
     pagesize = 50
-    pagecount = 1
-    paginated = len(dir_entries) > pagesize
-    entry_count = len(dir_entries)
-    if paginated:
-        pagecount = len(dir_entries) // pagesize
-        if len(dir_entries) % 100:
-            pagecount += 1
-        dir_entries = dir_entries[(page-1)*pagesize:page*pagesize]
+    search_results = None
+    search_indexing = False
+    if search and search.strip():
+        # Searches the current directory and all its subdirectories
+        prefix = os.path.join(section, dirname).rstrip('/') + '/'
+        found = SEARCH_INDEX.search(search, prefix=prefix, page=page, pagesize=pagesize)
+        search_indexing = found is None
+        entry_count, search_results = found or (0, [])
+        total_entries, dir_entries = entry_count, []
+    else:
+        total_entries, dir_entries = scan_dir_page(
+            full_dirname, page, pagesize, sort_by_date)
+        entry_count = total_entries
+    paginated = entry_count > pagesize
+    pagecount = max(-(-entry_count // pagesize), 1)
+    rows_html = ''
+    if dir_entries:
+        rows_html = render_dir_rows(section, dirname, dir_entries, page)
     return template(
         'list_dir.tpl', section=section, dirname=dirname,
         dir_entries=dir_entries, full_dirname=full_dirname,
-        flash_message=flash_message, directories=get_directories(),
-        editable_exts=EDITABLE_EXTENSIONS, svg_dir=svg_dir,
+        flash_message=flash_message, msg_status=msg_status,
+        editable_exts=EDITABLE_EXTENSIONS, rows_html=rows_html,
         paginated=paginated, pagecount=pagecount, page=page,
         entry_count=entry_count, sort_by_date=sort_by_date,
-        search=search, total_entries=total_entries, imsiz=imsiz,
+        search=search, total_entries=total_entries,
+        search_results=search_results, search_indexing=search_indexing,
     )
 
+
+def render_dir_rows(section, dirname, dir_entries, page):
+    """
+    The table rows (and Rename/Move dialogs) for a page of a directory
+    listing. Unless the fragment cache is off, they are rendered only once
+    for a given page of names, as long as the mtime of the directory stays
+    the same and no change in it or its subdirectories is reported to
+    DIR_ROWS.  Without the file watcher, changes made outside the admin are
+    not reported, so the sizes and mtimes of the entries are part of the key.
+    """
+    def render():
+        empty_dirs = set(_.name for _ in dir_entries if _.is_dir() and dir_is_empty(_.path))
+        return template(
+            'list_dir_rows.tpl', section=section, dirname=dirname,
+            dir_entries=dir_entries, page=page,
+            editable_exts=EDITABLE_EXTENSIONS, empty_dirs=empty_dirs,
+            imsiz=IMAGE_SIZES.bulk(dir_entries))
+    if bottle.DEBUG or not get_config(BASEDIR, 'wmk_admin').get('fragment_cache', True):
+        return render()
+    full_dirname = os.path.join(BASEDIR, section, dirname)
+    key = (section, dirname, page, os.stat(full_dirname).st_mtime_ns,
+           DIR_ROWS.generation(full_dirname), tuple(_.name for _ in dir_entries))
+    if not WATCHER.active:
+        key += (tuple((_.stat().st_size, _.stat().st_mtime_ns) for _ in dir_entries),)
+    return DIR_ROWS.get(key, render)
+
 @post('/_/admin/move/')
 @authorize
 def move_or_rename():
@@ -340,37 +579,21 @@ def move_or_rename():
         <input type="hidden" name="is_dir" value="{{ '1' if is_dir else '0' }}">
         <label>New name</label>
         <input type="text" name="new_name" value="{{ orig_name }}">
-        <label>New directory</label>
-        <select name="dest_dir">
-          % for d in directories:
-            <option value="{{ d }}"{{ ' selected' if d == from_dir else '' }}>{{ d }}</option>
-          % end
-        </select>
+        <label>Destination folder</label>
+        <input type="text" name="dest_dir" value="{{ from_dir }}">
+        <input type="checkbox" name="update_links" value="1" checked>
         <input type="submit" value="Rename/Move">
+
+    A page is moved together with its attachment folder, and with
+    `update_links`, references to the moved files (and relative references
+    in moved pages) are rewritten as shown by move_preview().
     """
     is_dir = request.forms.getunicode('is_dir') == '1'
-    from_dir = request.forms.getunicode('from_dir')
-    dest_dir = request.forms.getunicode('dest_dir')
-    orig_name = request.forms.getunicode('orig_name')
-    new_name = request.forms.getunicode('new_name')
+    from_dir, orig_name, dest_dir, new_name = move_form_fields()
     okdirs = ('content', 'data', 'static', 'templates')
-    if not from_dir.startswith(okdirs) and dest_dir.startswith(okdirs):
-        abort(403, 'Move/rename outside authorized directories attempted')
-    if not new_name or new_name.startswith('.'):
-        abort(403, 'New name must be filled out and must not start with a dot')
     if from_dir == dest_dir and orig_name == new_name:
         # No need to do anything
         redirect('/_/admin/list/' + from_dir)
-    full_from_dir = os.path.join(BASEDIR, from_dir)
-    full_dest_dir = os.path.join(BASEDIR, dest_dir)
-    if not os.path.isdir(full_from_dir) and os.path.isdir(full_dest_dir):
-        abort(403, "Both origin and destination directories must exist")
-    full_from = os.path.join(full_from_dir, orig_name)
-    full_dest = os.path.join(full_dest_dir, new_name)
-    if not os.path.exists(full_from):
-        abort(403, "The origin file/directory does not exist")
-    if os.path.exists(full_dest):
-        abort(403, "The move/rename conflicts with an existing file/directory")
     typ = 'directory' if is_dir else 'file'
     if from_dir == dest_dir:
         msg = 'Renamed a %s from %s to %s (in %s)' % (typ, orig_name, new_name, from_dir)
@@ -379,14 +602,86 @@ def move_or_rename():
     else:
         msg = 'Moved the %s %s from %s to %s and gave it the new name %s' % (
             typ, orig_name, from_dir, dest_dir, new_name)
-    shutil.move(full_from, full_dest)
-    set_flash_message(request, msg)
-    wmk_build(msg)
+    plan = REFERENCES.plan_move(
+        from_dir + '/' + orig_name, dest_dir + '/' + new_name,
+        rewrite=request.forms.get('update_links') == '1')
+    changed = []
+    for old, new in plan['moves']:
+        shutil.move(os.path.join(BASEDIR, old), os.path.join(BASEDIR, new))
+        changed += [os.path.join(BASEDIR, old), os.path.join(BASEDIR, new)]
+    if len(plan['moves']) > 1:
+        msg += ', together with its attachment folder'
+    rewritten, failed = [], []
+    for rel, changes in sorted(plan['rewrites'].items()):
+        try:
+            if REFERENCES.rewrite(rel, changes):
+                rewritten.append(os.path.join(BASEDIR, rel))
+        except (OSError, UnicodeDecodeError) as e:
+            print("WARNING: Could not update references in %s: %s" % (rel, e))
+            failed.append('%s (%s)' % (rel, e))
+    if rewritten:
+        msg += '; updated references in %d page%s' % (
+            len(rewritten), '' if len(rewritten) == 1 else 's')
+    if failed:
+        msg += '; could not update references in %s' % ', '.join(failed)
+    files_changed(changed + rewritten)
+    set_flash_message(request, msg, status='warning' if failed else 'success')
+    BUILD_QUEUE.submit(msg, paths=changed + rewritten)
     maybe_slash = '/' if from_dir in okdirs else ''
     # NOTE: should we go to dest_dir instead?
     redirect('/_/admin/list/%s%s' % (from_dir, maybe_slash))
 
 
+@post('/_/admin/move/preview/')
+@authorize
+def move_preview():
+    """
+    What the move/rename form (same fields) would do, as JSON: the paths
+    that would be moved, as `[from, to]` pairs, and the references that
+    would be rewritten, as a list of `{"path": ..., "changes": [[old, new],
+    ...]}`, where the path is the one after the move.
+    """
+    from_dir, orig_name, dest_dir, new_name = move_form_fields()
+    if from_dir == dest_dir and orig_name == new_name:
+        return {'moves': [], 'rewrites': []}
+    plan = REFERENCES.plan_move(from_dir + '/' + orig_name, dest_dir + '/' + new_name)
+    return {
+        'moves': plan['moves'],
+        'rewrites': [{'path': rel, 'changes': sorted(changes.items())}
+                     for rel, changes in sorted(plan['rewrites'].items())],
+    }
+
+
+def move_form_fields():
+    """
+    The origin folder, original name, destination folder and new name from
+    the move/rename form, after checking that the move is allowed.
+    """
+    from_dir = request.forms.getunicode('from_dir')
+    dest_dir = request.forms.getunicode('dest_dir')
+    orig_name = request.forms.getunicode('orig_name')
+    new_name = request.forms.getunicode('new_name')
+    okdirs = ('content', 'data', 'static', 'templates')
+    dest_dir = (dest_dir or '').strip().strip('/')
+    if not (is_allowed_dir(from_dir, okdirs) and is_allowed_dir(dest_dir, okdirs)):
+        abort(403, 'Move/rename outside authorized directories attempted')
+    if not new_name or new_name.startswith('.') or '/' in new_name:
+        abort(403, 'New name must be filled out and must not start with a dot')
+    if not orig_name or '/' in orig_name or orig_name in ('.', '..'):
+        abort(403, 'Invalid original name')
+    if from_dir == dest_dir and orig_name == new_name:
+        return from_dir, orig_name, dest_dir, new_name
+    full_from_dir = os.path.join(BASEDIR, from_dir)
+    full_dest_dir = os.path.join(BASEDIR, dest_dir)
+    if not (os.path.isdir(full_from_dir) and os.path.isdir(full_dest_dir)):
+        abort(403, "Both origin and destination directories must exist")
+    if not os.path.exists(os.path.join(full_from_dir, orig_name)):
+        abort(403, "The origin file/directory does not exist")
+    if os.path.exists(os.path.join(full_dest_dir, new_name)):
+        abort(403, "The move/rename conflicts with an existing file/directory")
+    return from_dir, orig_name, dest_dir, new_name
+
+
 @post('/_/admin/create-dir/<section:re:content|data|static|templates>/<dirname:re:.*>')
 @authorize
 def create_dir(section, dirname):
@@ -400,9 +695,10 @@ def create_dir(section, dirname):
     if os.path.exists(new_path):
         abort(403, 'A directory/file of that name already exists')
     os.mkdir(new_path)
+    files_changed([new_path])
     msg = 'Created directory %s in %s' % (new_dirname, full_dirname[len(BASEDIR)+1:])
     set_flash_message(request, msg)
-    wmk_build(msg)
+    BUILD_QUEUE.submit(msg, paths=[new_path])
     redirect('/_/admin/list/%s/%s' % (section, dirname))
 
 
@@ -423,6 +719,7 @@ def create_page(section, dirname):
         abort(403, f'A file named {new_filename} already exists at {section}/{dirname}')
     with open(new_path, 'w') as f:
         f.write(content)
+    files_changed([new_path])
     msg = f'Created page "{title}" in {section}/{dirname}'
     set_flash_message(request, msg)
     path = os.path.join(section, dirname, new_filename) \
@@ -445,6 +742,7 @@ def create_file(section, dirname):
         abort(403, 'A directory/file of that name already exists')
     with open(new_path, 'w') as f:
         f.write('')
+    files_changed([new_path])
     msg = 'Created file %s in %s' % (new_filename, full_dirname[len(BASEDIR)+1:])
     set_flash_message(request, msg)
     # wmk_build(msg)
@@ -462,10 +760,11 @@ def create_file(section, dirname):
 def remove_dir(section, dirname):
     full_dirname = os.path.join(BASEDIR, section, dirname)
     os.rmdir(full_dirname)
+    files_changed([full_dirname])
     list_dirname = re.sub(r'/[^/]+$', '', dirname) if '/' in dirname else ''
     msg = 'Removed directory %s from %s' % (dirname, section)
     set_flash_message(request, msg)
-    wmk_build(msg)
+    BUILD_QUEUE.submit(msg, paths=[full_dirname])
     redirect('/_/admin/list/%s/%s' % (section, list_dirname))
 
 
@@ -474,30 +773,72 @@ def remove_dir(section, dirname):
 def del_file(section, filename):
     full_filename = os.path.join(BASEDIR, section, filename)
     os.remove(full_filename)
+    files_changed([full_filename])
     list_dirname = re.sub(r'/[^/]+$', '', filename) if '/' in filename else ''
     msg = 'Deleted file %s from %s' % (filename, section)
-    wmk_build(msg)
+    BUILD_QUEUE.submit(msg, paths=[full_filename])
     set_flash_message(request, msg)
     page = int(request.params.get('p', 1))
     maybe_page = f'?p={page}' if page > 1 else ''
     redirect('/_/admin/list/%s/%s%s' % (section, list_dirname, maybe_page))
 
 
-# ------ Helpers below ------------
-
-def get_config(dirname, identifier='wmk_config'):
+@post('/_/admin/batch/')
+@authorize
+def batch_file_ops():
     """
-    Will NOT raise an error if the yaml file is not at the expected location,
-    only print a warning to the console.
+    Apply a list of file operations, given as JSON: `{"ops": [...]}`, where
+    each operation is one of
+
+        {"op": "delete", "path": "content/old.md"}
+        {"op": "rmdir", "path": "content/empty-folder"}
+        {"op": "mkdir", "path": "content/new-folder"}
+        {"op": "move", "path": "content/a.md", "dest_dir": "content/blog"}
+        {"op": "rename", "path": "content/a.md", "name": "b.md"}
+
+    (a move may also have a `name`).  All of them are checked before any is
+    carried out, and if one fails the ones already done are undone.  The
+    whole batch leads to a single build.  Unlike move_or_rename(), a move
+    does not update references to the moved files or take the attachment
+    folder of a page along.  Returns the number of operations
+    and the time taken by each stage (in ms), or `error` and the `index` of
+    the failing operation with status 400 or 409.
     """
-    config_file = os.path.join(dirname, '%s.yaml' % identifier)
-    conf = {}
+    start = time.perf_counter()
+    try:
+        ops = validate_file_ops((request.json or {}).get('ops'))
+    except (ValueError, FileOpError) as e:
+        response.status = 400
+        return {'error': str(e), 'index': getattr(e, 'index', None)}
+    validated = time.perf_counter()
     try:
-        with open(config_file) as f:
-            conf = yaml.safe_load(f)
-    except FileNotFoundError:
-        print("WARNING: File '{}' not found".format(config_file))
-    return conf or {}
+        changed = apply_file_ops(ops)
+    except FileOpError as e:
+        response.status = 409
+        return {'error': str(e), 'index': e.index}
+    applied = time.perf_counter()
+    files_changed(changed)
+    notified = time.perf_counter()
+    counts = collections.Counter(op for op, _, _ in ops)
+    msg = 'Batch of %d file operations (%s)' % (
+        len(ops), ', '.join('%s: %d' % _ for _ in sorted(counts.items())))
+    BUILD_QUEUE.submit(msg, paths=changed)
+    timings = {
+        'validate': round((validated - start) * 1000, 2),
+        'apply': round((applied - validated) * 1000, 2),
+        'index_update': round((notified - applied) * 1000, 2),
+        'total': round((time.perf_counter() - start) * 1000, 2),
+    }
+    with open(os.path.join(BASEDIR, 'tmp/admin.log'), 'a') as f:
+        f.write("\n=====\n%s at %s\n[Timing: %s]\n" % (
+            msg, str(datetime.datetime.now()),
+            '; '.join('%s=%sms' % _ for _ in timings.items())))
+    set_flash_message(request, '%s done in %s ms. The site is being rebuilt.' % (
+        msg, timings['total']))
+    return {'ops': len(ops), 'changed': len(changed), 'timings': timings}
+
+
+# ------ Helpers below ------------
 
 
 def get_configured_password(errors_fatal=True):
@@ -509,102 +850,459 @@ def get_configured_password(errors_fatal=True):
     return conf_pass
 
 
+class SessionStore:
+    """
+    Logged-in sessions, keyed by the value of the session cookie.  A session
+    expires after `ttl` seconds without requests (sliding expiry); expired
+    sessions are removed by a periodic sweep in a background thread.
+
+    Subclasses implement `_add`, `_touch`, `_delete`, `_sweep` and `_count`.
+    """
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sweeper = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def create(self):
+        "Start a new session and return its id."
+        sid = secrets.token_hex(20)
+        self._add(sid, time.time() + self.ttl)
+        self._start_sweeper()
+        return sid
+
+    def valid(self, sid):
+        "True if `sid` is a live session. Extends its lifetime."
+        if not sid:
+            return False
+        if self._touch(sid, time.time()):
+            self.hits += 1
+            self._start_sweeper()
+            return True
+        self.misses += 1
+        return False
+
+    def delete(self, sid):
+        self._delete(sid)
+
+    def sweep(self):
+        "Remove expired sessions."
+        self.expired += self._sweep(time.time())
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'expired': self.expired, 'sessions': self._count()}
+
+    def migrate_files(self, tmpdir):
+        """
+        Import the `tmp/*.session` files used by earlier versions, so that
+        users who are logged in stay logged in, and remove them along with
+        any unread `.flash` files.
+        """
+        try:
+            names = [_ for _ in os.listdir(tmpdir) if _.endswith('.session')]
+        except FileNotFoundError:
+            return
+        expires = time.time() + self.ttl
+        for name in names:
+            sid = name[:-len('.session')]
+            if re.match(r'^\w+$', sid):
+                self._add(sid, expires)
+            for filename in (name, sid + '.flash'):
+                try:
+                    os.remove(os.path.join(tmpdir, filename))
+                except FileNotFoundError:
+                    pass
+
+    def _start_sweeper(self):
+        if self.sweeper is not None:
+            return
+        with self.lock:
+            if self.sweeper is None:
+                self.sweeper = threading.Thread(
+                    target=self._sweep_loop, name='session-sweeper', daemon=True)
+                self.sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                print("WARNING: Session sweep failed:", e)
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions in a dict in this process, evicting the least recently used
+    ones beyond `max_sessions`.  The sweeper saves them to `filename` when
+    they have changed, so that a restart does not log everybody out; a
+    request never causes any disk I/O.
+    """
+
+    def __init__(self, ttl, filename, max_sessions=1000):
+        super().__init__(ttl)
+        self.filename = filename
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        self.dirty = False
+        try:
+            with open(filename) as f:
+                saved = json.load(f)
+            now = time.time()
+            for sid, expires in sorted(saved.items(), key=lambda _: _[1]):
+                if expires > now:
+                    self.sessions[sid] = expires
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def sweep(self):
+        super().sweep()
+        if self.dirty:
+            self.dirty = False
+            with self.lock:
+                saved = dict(self.sessions)
+            atomic_write(self.filename, json.dumps(saved))
+
+    def _add(self, sid, expires):
+        with self.lock:
+            self.sessions[sid] = expires
+            self.sessions.move_to_end(sid)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            self.dirty = True
+
+    def _touch(self, sid, now):
+        with self.lock:
+            expires = self.sessions.get(sid)
+            if expires is None:
+                return False
+            if expires <= now:
+                del self.sessions[sid]
+                self.expired += 1
+                self.dirty = True
+                return False
+            self.sessions[sid] = now + self.ttl
+            self.sessions.move_to_end(sid)
+            self.dirty = True
+            return True
+
+    def _delete(self, sid):
+        with self.lock:
+            if self.sessions.pop(sid, None) is not None:
+                self.dirty = True
+
+    def _sweep(self, now):
+        with self.lock:
+            expired = [sid for sid, expires in self.sessions.items() if expires <= now]
+            for sid in expired:
+                del self.sessions[sid]
+            if expired:
+                self.dirty = True
+        return len(expired)
+
+    def _count(self):
+        return len(self.sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Sessions in an SQLite database (memory-mapped, in WAL mode), shared by
+    all worker processes of the server.  A session found valid is trusted
+    for `RECHECK_SECONDS` without asking the database again, and its expiry
+    time is only written back once `REFRESH_FRACTION` of its lifetime has
+    passed, so most requests neither read from nor write to the database.
+    """
+    RECHECK_SECONDS = 10
+    REFRESH_FRACTION = 0.1
+
+    def __init__(self, ttl, filename):
+        super().__init__(ttl)
+        self.filename = filename
+        self.conn = None
+        self.recent = {}  # sid -> (checked_until, expires)
+
+    def _add(self, sid, expires):
+        with self.lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    'INSERT OR REPLACE INTO sessions (sid, expires) VALUES (?, ?)',
+                    (sid, expires))
+
+    def _touch(self, sid, now):
+        checked_until, expires = self.recent.get(sid, (0, 0))
+        if now < checked_until and now < expires:
+            if expires - now < self.ttl * (1 - self.REFRESH_FRACTION):
+                self._refresh(sid, now)
+            return True
+        with self.lock:
+            row = self._db().execute(
+                'SELECT expires FROM sessions WHERE sid = ?', (sid, )).fetchone()
+        if not row or row[0] <= now:
+            self.recent.pop(sid, None)
+            return False
+        self.recent[sid] = (now + self.RECHECK_SECONDS, row[0])
+        if row[0] - now < self.ttl * (1 - self.REFRESH_FRACTION):
+            self._refresh(sid, now)
+        return True
+
+    def _refresh(self, sid, now):
+        expires = now + self.ttl
+        with self.lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    'UPDATE sessions SET expires = ? WHERE sid = ?', (expires, sid))
+        self.recent[sid] = (now + self.RECHECK_SECONDS, expires)
+
+    def _delete(self, sid):
+        self.recent.pop(sid, None)
+        with self.lock:
+            db = self._db()
+            with db:
+                db.execute('DELETE FROM sessions WHERE sid = ?', (sid, ))
+
+    def _sweep(self, now):
+        for sid, (checked_until, expires) in list(self.recent.items()):
+            if checked_until <= now:
+                self.recent.pop(sid, None)
+        with self.lock:
+            db = self._db()
+            with db:
+                return db.execute(
+                    'DELETE FROM sessions WHERE expires <= ?', (now, )).rowcount
+
+    def _count(self):
+        with self.lock:
+            return self._db().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.filename, check_same_thread=False, timeout=10)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA mmap_size=%d' % (8 * 1024 * 1024))
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, expires REAL)')
+        return self.conn
+
+
+def make_session_store():
+    conf = get_config(BASEDIR, 'wmk_admin')
+    tmpdir = os.path.join(BASEDIR, 'tmp')
+    ttl = int(conf.get('session_ttl', 14 * 24 * 3600))
+    if conf.get('session_backend', 'memory') == 'sqlite':
+        store = SqliteSessionStore(ttl, os.path.join(tmpdir, 'sessions.sqlite'))
+    else:
+        store = MemorySessionStore(ttl, os.path.join(tmpdir, 'sessions.json'))
+    store.migrate_files(tmpdir)
+    return store
+
+
+SESSIONS = make_session_store()
+CACHES['sessions'] = SESSIONS
+
+
 def get_status():
     ret = {
         'deployed_date': None,
         'git_status': '',
         'git_last_commit': '',
+        'git_checked_at': None,
+        'git_refreshing': False,
     }
-    deploy_status_file = os.path.join(BASEDIR, 'tmp', 'deploy.log')
-    if os.path.exists(deploy_status_file):
-        st = os.stat(deploy_status_file)
-        ret['deployed_date'] = datetime.datetime.fromtimestamp(st.st_mtime)
-    if os.path.isdir(os.path.join(BASEDIR, '.git')):
-        gitstatus = subprocess.run(
-            ["git", "status", "-s"], cwd=BASEDIR, capture_output=True, text=True)
-        ret['git_status'] = gitstatus.stdout
-        commitinfo = subprocess.run(
-            ['git', 'log', '-1', '--date=iso', '--pretty=[%h] %ad'],
-            cwd=BASEDIR, capture_output=True, text=True)
-        ret['git_last_commit'] = re.sub(r' [+\-]\d\d\d\d$', '', commitinfo.stdout)
+    ret['deployed_date'] = DEPLOYS.last_success()
+    git = GIT_STATUS.get()
+    if git:
+        ret['git_status'] = git['status']
+        ret['git_last_commit'] = git['last_commit']
+        ret['git_checked_at'] = git['checked_at']
+        ret['git_refreshing'] = git['refreshing']
     return ret
 
 
-def wmk_build(msg=None, hard=False, quick=False):
-    start = datetime.datetime.now()
-    if hard and msg:
-        msg += ' - HARD REBUILD!'
-    if hard:
-        quick = False
-        tmpdir = os.path.join(BASEDIR, 'tmp')
-        tmpfiles = os.listdir(tmpdir)
-        for fn in tmpfiles:
-            if fn.startswith('wmk_render_cache'):
-                os.unlink(os.path.join(tmpdir, fn))
-        shutil.rmtree(os.path.join(BASEDIR, 'htdocs'))
-    old_stdout = sys.stdout
-    tmp_stdout = io.StringIO()
-    sys.stdout = tmp_stdout
-    wmk.main(BASEDIR, quick=quick)
-    sys.stdout = old_stdout
-    if msg:
-        logfile = os.path.join(BASEDIR, 'tmp/admin.log')
-        end = datetime.datetime.now()
-        duration = end - start
-        with open(logfile, 'a') as f:
-            f.write("\n=====\nRan wmk %sbuild. Reason: %s\n" % ('quick ' if quick else '', msg))
-            f.write("[Timing: %s to %s; duration=%s]\n" % (str(start), str(end), str(duration)))
-            show_lines = [_ for _ in tmp_stdout.getvalue().split("\n")
-                          if 'WARN' in _ or 'ERR' in _]
-            if show_lines:
-                f.write("\n".join(show_lines)+"\n")
-    tmp_stdout.close()
+class RequestMetrics:
+    """
+    Bottle plugin which keeps a histogram of the time spent in each route's
+    handler (measured up to the point where the handler returns, so the
+    sending of large files is not included).
+    """
+    name = 'request_metrics'
+    api = 2
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def apply(self, callback, route):
+        key = (route.method, route.rule)
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                self.observe(key, time.perf_counter() - start)
+        return wrapper
+
+    def observe(self, key, seconds):
+        with self.lock:
+            entry = self.routes.get(key)
+            if entry is None:
+                entry = self.routes[key] = {
+                    'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            i = bisect.bisect_left(self.BUCKETS, seconds)
+            if i < len(self.BUCKETS):
+                entry['buckets'][i] += 1
+            entry['sum'] += seconds
+            entry['count'] += 1
+
+    def metrics(self):
+        "Lines in the Prometheus text format."
+        ret = [
+            '# HELP wmk_admin_request_duration_seconds Time spent in request handlers, by route.',
+            '# TYPE wmk_admin_request_duration_seconds histogram',
+        ]
+        name = 'wmk_admin_request_duration_seconds'
+        with self.lock:
+            for (method, rule), entry in sorted(self.routes.items()):
+                cumulative = 0
+                for le, count in zip(self.BUCKETS, entry['buckets']):
+                    cumulative += count
+                    ret.append(metric_line(name + '_bucket', cumulative,
+                                       method=method, route=rule, le=le))
+                ret.append(metric_line(name + '_bucket', entry['count'],
+                                   method=method, route=rule, le='+Inf'))
+                ret.append(metric_line(name + '_sum', entry['sum'],
+                                   method=method, route=rule))
+                ret.append(metric_line(name + '_count', entry['count'],
+                                   method=method, route=rule))
+        return ret
+
+
+REQUEST_METRICS = RequestMetrics()
+bottle.install(REQUEST_METRICS)
+
+
+def cache_metrics():
+    "Hits, misses and hit ratio of each cache in `CACHES` which counts them."
+    hits, misses, ratios = [], [], []
+    for name, cache in sorted(CACHES.items()):
+        stats = cache.stats()
+        if stats.get('hits') is None or stats.get('misses') is None:
+            continue
+        hits.append(metric_line('wmk_admin_cache_hits_total', stats['hits'], cache=name))
+        misses.append(metric_line('wmk_admin_cache_misses_total', stats['misses'], cache=name))
+        total = stats['hits'] + stats['misses']
+        if total:
+            ratios.append(metric_line('wmk_admin_cache_hit_ratio',
+                                  stats['hits'] / total, cache=name))
+    return [
+        '# HELP wmk_admin_cache_hits_total Lookups answered from an in-memory cache.',
+        '# TYPE wmk_admin_cache_hits_total counter',
+    ] + hits + [
+        '# HELP wmk_admin_cache_misses_total Lookups an in-memory cache could not answer.',
+        '# TYPE wmk_admin_cache_misses_total counter',
+    ] + misses + [
+        '# HELP wmk_admin_cache_hit_ratio Share of lookups answered from the cache.',
+        '# TYPE wmk_admin_cache_hit_ratio gauge',
+    ] + ratios
 
 
 def imsiz(f):
-    path = f.path if hasattr(f, 'path') else f
-    with Image.open(path) as im:
-        return im.size
+    "Width and height of an image (a path or DirEntry), via IMAGE_SIZES."
+    return IMAGE_SIZES.get(f)
+
+
+FLASH_COOKIE_NAME = COOKIE_NAME + '_flash'
 
 
 def get_flash_message(request):
-    msg = None
-    filename = (is_logged_in(request) or '').replace('.session', '.flash')
-    if os.path.exists(filename):
-        with open(filename) as f:
-            msg = f.read()
-        os.remove(filename)
-    return msg
+    """
+    Returns the message set by `set_flash_message()` on the previous request
+    as a (text, status) tuple, or ('', None), and removes it.
+    """
+    val = request.get_cookie(FLASH_COOKIE_NAME)
+    if not val:
+        return '', None
+    response.delete_cookie(FLASH_COOKIE_NAME, path='/_/admin/')
+    payload, _, signature = val.rpartition('.')
+    expected = hmac.new(get_secret_key(), payload.encode('ascii'), 'sha256').hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        return '', None
+    try:
+        msg = json.loads(base64.urlsafe_b64decode(payload))
+        return str(msg['text']), str(msg['status'])
+    except (ValueError, KeyError, TypeError):
+        return '', None
+
 
+def set_flash_message(request, msg, status='success'):
+    """
+    Show `msg` on the next page rendered for this browser.  The message is
+    carried in a signed cookie, so no state is kept on the server. `status`
+    is the admonition class, i.e. 'success' or 'warning'.
+    """
+    payload = base64.urlsafe_b64encode(
+        json.dumps({'text': msg[:2000], 'status': status}).encode('utf-8')).decode('ascii')
+    signature = hmac.new(get_secret_key(), payload.encode('ascii'), 'sha256').hexdigest()
+    response.set_cookie(
+        FLASH_COOKIE_NAME, payload + '.' + signature, path='/_/admin/', httponly=True)
 
-def set_flash_message(request, msg, filename=None):
-    if filename is None:
-        filename = is_logged_in(request) or ''
-    filename = filename.replace('.session', '.flash')
-    if filename and filename.endswith('.flash'):
-        with open(filename, 'w') as f:
-            f.write(msg)
+
+@functools.lru_cache(maxsize=None)
+def get_secret_key():
+    """
+    Random key for signing cookies. It is kept in tmp/secret_key so that all
+    worker processes (and restarts) share it.
+    """
+    filename = os.path.join(BASEDIR, 'tmp', 'secret_key')
+    if not os.path.exists(filename):
+        tmp_path = '%s.%d' % (filename, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_bytes(32))
+        try:
+            # Fails if another process got there first; then its key is used
+            os.link(tmp_path, filename)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(filename, 'rb') as f:
+        return f.read()
 
 
 def is_logged_in(request):
-    val = request.get_cookie(COOKIE_NAME) or ''
-    if val and re.match(r'^\w+$', val):
-        tmpdir = os.path.join(BASEDIR, 'tmp')
-        filename = os.path.join(tmpdir, val + '.session')
-        if os.path.exists(filename):
-            return filename
-    else:
-        return False
+    "Returns the session id if the request has a valid session cookie."
+    sid = request.get_cookie(COOKIE_NAME) or ''
+    if sid and SESSIONS.valid(sid):
+        return sid
+    return False
 
 
-def edit_form(section, filename, full_path):
-    with open(full_path) as f:
-        contents = f.read()
+def edit_form(section, filename, full_path, contents=None, version=None, flash=None,
+              diff=None):
+    """
+    The edit page for a file.  Normally the file is read and its version
+    token remembered for save_file(); after a conflicting save, `contents`
+    (with conflict markers), the `version` it is based on, a `flash`
+    message (text, status) and possibly a `diff` to show are passed in.
+    """
+    if contents is None:
+        with open(full_path) as f:
+            contents = f.read()
+        version = EDIT_VERSIONS.remember(contents)
+    response.set_header('ETag', '"%s"' % version)
     is_config = section is None and filename == 'wmk_config.yaml'
     conf = get_config(BASEDIR,  'wmk_admin') or {}
-    msg = get_flash_message(request) or ''
-    if msg.startswith('S:'):
-        msg = msg[2:]
+    msg, msg_status = flash or get_flash_message(request)
     if is_config:
         attachment_dir = None
         fn = filename
@@ -626,10 +1324,47 @@ def edit_form(section, filename, full_path):
                     editable_exts=EDITABLE_EXTENSIONS, ace_modes=ACE_EDITOR_MODES,
                     img_exts=IMG_EXTENSIONS, att_exts=ATTACHMENT_EXTENSIONS,
                     preview_css=conf.get('preview_css', ''), flash_message=msg,
+                    msg_status=msg_status, version=version, diff=diff,
                     potential_attachments=potential_attachments,
                     attachment_dir=attachment_dir, nearby_files=nearby_files,
                     img_to_editor_template=imged_tpl,
-                    attachment_to_editor_template=atted_tpl, imsiz=imsiz)
+                    attachment_to_editor_template=atted_tpl,
+                    imsiz=IMAGE_SIZES.bulk(nearby_files))
+
+
+def scan_dir_page(full_dirname, page, pagesize, sort_by_date=False):
+    """
+    Returns the number of entries in a directory and the entries (DirEntry
+    objects) on the given page, ordered by name or by mtime (newest first).
+
+    Only the entries up to the end of the requested page are kept in
+    memory (via a heap), and each entry is stat-ed at most once (DirEntry
+    caches the result for the template), and only if sorting by date.
+    """
+    total = 0
+    def entries(it):
+        nonlocal total
+        for entry in it:
+            if entry.name in ('.git', '.gitignore'):
+                continue
+            total += 1
+            yield entry
+    keep = page * pagesize
+    with os.scandir(full_dirname) as it:
+        if sort_by_date:
+            selected = heapq.nlargest(keep, entries(it), key=lambda x: x.stat().st_mtime)
+        else:
+            selected = heapq.nsmallest(keep, entries(it), key=lambda x: x.name)
+    return total, selected[(page-1)*pagesize:]
+
+
+def dir_is_empty(path):
+    "True if the directory has no entries; reads at most one of them."
+    try:
+        with os.scandir(path) as it:
+            return next(it, None) is None
+    except OSError:
+        return False
 
 
 def get_potential_attachments(attachment_dir):
@@ -662,12 +1397,8 @@ def get_recently_changed(settings):
     cnt = 0
     i2d = lambda s: datetime.date(*[int(_) for _ in s.split('-')])
     if typ == 'git':
-        cmd = ["git", "log",
-               "--since='{} days ago'".format(days),
-               "--name-only", "--date=iso", "--pretty=format:%ad"]
-        info = subprocess.run(
-            cmd, cwd=BASEDIR, capture_output=True, text=True)
-        lines = info.stdout.splitlines()
+        # Cached and refreshed in the background, like the git status
+        lines = (GIT_STATUS.get(days) or {}).get('log', '').splitlines()
         seen = set()
         curdate = None
         for line in lines:
@@ -687,124 +1418,187 @@ def get_recently_changed(settings):
             seen.add(line)
             ret.append((line, i2d(curdate)))
     elif typ == 'find':
-        # NOTE: This assumes GNU find ('%T+' format)
-        cmd = ["find",
-             "content", "data", "templates", "static",
-             "-mtime", '-'+str(days), "-type", "f",
-             "-printf", '%T+ %h/%f\\n']
-        info = subprocess.run(
-            cmd, cwd=BASEDIR, capture_output=True, text=True)
-        lines = info.stdout.splitlines()
-        lines.sort(reverse=True)
-        for line in lines:
-            if not ' ' in line:
-                continue
-            dags, filename = line.split(' ', 1)
-            if not (filename.startswith(dirs) and filename.endswith(exts)):
-                continue
-            cnt += 1
-            if cnt > limit:
-                break
-            dags = re.sub(r'\+.*', '', dags)
-            ret.append((filename, i2d(dags)))
+        # Modification times of the files, from the in-memory index
+        ret = RECENT_CHANGES.get(dirs, exts, limit=limit, days=days)
     else:
-        raise Execption("Configuration error: unknown type '{}'".format(typ))
+        print("WARNING: Unknown recently_changed type '{}' in wmk_admin.yaml".format(typ))
     return ret
 
 
-def handle_upload(request):
-    dest_dir = request.forms.getunicode('dest_dir')
-    ok_dirs = ('static', 'content', 'data')
-    if not (dest_dir in ok_dirs or dest_dir.startswith(tuple([_+'/' for _ in ok_dirs]))):
-        abort(403, "Invalid destination directory: {}".format(dest_dir))
-    if not os.path.isdir(os.path.join(BASEDIR, dest_dir)):
-        abort(403, "Destination directory '{}' does not exist".format(dest_dir))
-    filename = request.forms.getunicode('dest_name').strip('/') or ''
-    automatic_name = False
-    if '/' in filename:
-        abort(403, "Slashes in filenames not allowed; please create directory first if needed")
-    upload = request.files.get('upload')
-    if not filename:
-        filename = upload.filename.lower()
-        filename = re.sub(r'^.*[/\\]', '', filename)
-        filename = re.sub(r'\s+', '_', filename)
-        filename = re.sub(r'__+', '_', filename)
-        automatic_name = True
-    if filename.startswith('.'):
-        abort(403, "Names of uploaded files must not start with a dot")
-    if not re.search(r'\.\w{1,8}$', filename):
-        abort(403, "Uploaded files must have a valid file extension")
-    if len(filename) > 42:
-        filename = filename[:20] + '__' + filename[-20:]
-    full_path = os.path.join(BASEDIR, dest_dir, filename)
-    if os.path.exists(full_path) and automatic_name:
-        rand = '__' + ''.join(random.choices(string.ascii_uppercase, k=5))
-        full_path = re.sub(r'(\.\w{1,8})$', rand + r'\1', full_path)
-        filename = re.sub(r'(\.\w{1,8})$', rand + r'\1', filename)
-    if os.path.exists(full_path):
-        abort(403, 'Overwriting files via upload is not allowed')
-    #if not os.path.isdir(os.path.dirname(full_path)):
-    #    os.makedirs(os.path.dirname(full_path))
-    upload.save(full_path)
-    msg = "File %s uploaded to %s" % (filename, dest_dir)
-    wmk_build(msg)
-    set_flash_message(request, msg)
-    redirect('/_/admin/list/%s' % dest_dir)
-    #return template('file_saved.tpl', dest_dir=dest_dir, filename=filename)
-
-
-def handle_attachment_upload(request):
-    dest_dir = request.forms.getunicode('attachment_dir') or ''
-    if not dest_dir.startswith('content'):
-        abort(403, "Invalid destination directory: {}".format(dest_dir))
-    full_dest_dir = os.path.join(BASEDIR, dest_dir)
-    if not os.path.isdir(full_dest_dir):
-        os.mkdir(full_dest_dir)
-    upload_count = int(request.forms.get('upload_count', 0))
-    for i in range(upload_count):
-        upload = request.files.get(f'upload_{i}')
-        filename = upload.filename.lower()
-        filename = re.sub(r'^.*[/\\]', '', filename)
-        filename = re.sub(r'\s+', '_', filename)
-        filename = re.sub(r'__+', '_', filename)
-        while filename.startswith('.'):
-             filename = filename[1:]
-        if len(filename) > 42:
-             filename = filename[:20] + '__' + filename[-20:]
-        if not re.search(r'\.\w{1,8}$', filename):
-            filename += '.bin'
-        full_path = os.path.join(full_dest_dir, filename)
-        if os.path.exists(full_path):
-            rand = '__' + ''.join(random.choices(string.ascii_uppercase, k=5))
-            full_path = re.sub(r'(\.\w{1,8})$', rand + r'\1', full_path)
-            filename = re.sub(r'(\.\w{1,8})$', rand + r'\1', filename)
-        upload.save(full_path)
-    if upload_count == 1:
+def attachments_uploaded(dest_dir, saved_paths, refused=()):
+    """
+    Schedule a build for newly uploaded attachments and render the list of
+    them, with a warning about any `refused` (original_name, reason) files.
+    """
+    if not saved_paths:
+        msg = feedback = None
+    elif len(saved_paths) == 1:
+        filename = os.path.basename(saved_paths[0])
         msg = "Attachment file %s uploaded to %s" % (filename, dest_dir)
         feedback = "Uploaded: '%s'" % filename
     else:
-        msg = "%d files uploaded to %s" % (upload_count, dest_dir)
-        feedback = "Uploaded %d files" % upload_count
-    wmk_build(msg)
+        msg = "%d files uploaded to %s" % (len(saved_paths), dest_dir)
+        feedback = "Uploaded %d files" % len(saved_paths)
+    warning = '; '.join("Not uploaded: '%s' (%s)" % _ for _ in refused)
+    if saved_paths:
+        # The folder may have been created for this batch: its event should
+        # not lead to a build of its own
+        files_changed(saved_paths + [os.path.join(BASEDIR, dest_dir)])
+        BUILD_QUEUE.submit(msg, paths=saved_paths)
     files = get_potential_attachments(dest_dir)
     return template('edit-attachments.tpl',
-                    attachment_dir=dest_dir, files=files, msg=feedback,
+                    attachment_dir=dest_dir, files=files, msg=feedback, warning=warning,
                     img_exts=IMG_EXTENSIONS, att_exts=ATTACHMENT_EXTENSIONS,
-                    imsiz=imsiz)
+                    imsiz=IMAGE_SIZES.bulk(files))
 
 
 def get_directories():
     "content, data, static and their subdirectories as a flat, sorted list"
-    dest_dirs = []
-    for d in ('content', 'data', 'static'):
-        dest_dirs.append(d)
-        walker = os.walk(d)
-        for it in walker:
-            if it[1]:
-                for sd in it[1]:
-                    dest_dirs.append(os.path.join(it[0], sd))
-    dest_dirs.sort()
-    return dest_dirs
+    return DIRECTORY_TREE.all()
+
+
+def is_allowed_dir(dirname, okdirs):
+    "True if dirname is one of okdirs or a (relative, normalized) subdirectory of one."
+    if not dirname or dirname.startswith('/') or '\\' in dirname:
+        return False
+    parts = dirname.split('/')
+    return parts[0] in okdirs and not any(_ in ('', '.', '..') for _ in parts)
+
+
+class FileOpError(Exception):
+    "A file operation in a batch which cannot be carried out."
+
+    def __init__(self, index, msg):
+        super().__init__('Operation %d: %s' % (index + 1, msg))
+        self.index = index
+
+
+def validate_file_ops(ops):
+    """
+    Check a batch of file operations (see batch_file_ops()) without
+    touching the disk and return them as (op, path, dest) tuples, with paths
+    relative to BASEDIR.  Raises FileOpError for the first invalid one.
+    """
+    okdirs = ('content', 'data', 'static', 'templates')
+    if not isinstance(ops, list) or not ops:
+        raise ValueError('A non-empty list of operations must be given')
+    ret = []
+    for i, spec in enumerate(ops):
+        if not isinstance(spec, dict):
+            raise FileOpError(i, 'Not an object')
+        op = spec.get('op')
+        path = str(spec.get('path') or '').strip('/')
+        if op not in ('delete', 'rmdir', 'mkdir', 'move', 'rename'):
+            raise FileOpError(i, 'Unknown operation %r' % op)
+        if not is_allowed_dir(path, okdirs) or '/' not in path:
+            raise FileOpError(i, 'Path %r is outside authorized directories' % path)
+        dest = None
+        if op in ('move', 'rename'):
+            name = spec.get('name') or os.path.basename(path)
+            if op == 'rename' and not spec.get('name'):
+                raise FileOpError(i, 'A new name must be given')
+            if '/' in name or name.startswith('.'):
+                raise FileOpError(i, 'Names must not contain slashes or start with a dot')
+            dest_dir = os.path.dirname(path) if op == 'rename' \
+                else str(spec.get('dest_dir') or '').strip('/')
+            if not is_allowed_dir(dest_dir, okdirs):
+                raise FileOpError(i, 'Destination %r is outside authorized directories' % dest_dir)
+            dest = dest_dir + '/' + name
+            if dest == path or dest.startswith(path + '/'):
+                raise FileOpError(i, 'Cannot move %s into itself' % path)
+        elif op == 'mkdir' and os.path.basename(path).startswith('.'):
+            raise FileOpError(i, 'Names must not start with a dot')
+        ret.append((op, path, dest))
+    return ret
+
+
+def apply_file_ops(ops):
+    """
+    Carry out validated file operations in order.  Files are not deleted
+    until all operations have succeeded: they are first moved to a holding
+    directory in tmp, so that everything can be undone if a later operation
+    fails, in which case FileOpError is raised.  Returns the full paths of
+    everything changed.
+    """
+    holding = os.path.join(BASEDIR, 'tmp', 'batch-' + secrets.token_hex(8))
+    undo = []
+    changed = []
+    try:
+        for i, (op, path, dest) in enumerate(ops):
+            full_path = os.path.join(BASEDIR, path)
+            full_dest = os.path.join(BASEDIR, dest) if dest else None
+            if op == 'delete':
+                if not os.path.isfile(full_path):
+                    raise FileOpError(i, 'No such file: %s' % path)
+                os.makedirs(holding, exist_ok=True)
+                held = os.path.join(holding, str(i))
+                os.rename(full_path, held)
+                undo.append(('move', held, full_path))
+            elif op == 'rmdir':
+                if not os.path.isdir(full_path):
+                    raise FileOpError(i, 'No such folder: %s' % path)
+                if not dir_is_empty(full_path):
+                    raise FileOpError(i, 'Folder is not empty: %s' % path)
+                os.rmdir(full_path)
+                undo.append(('mkdir', full_path, None))
+            elif op == 'mkdir':
+                if os.path.lexists(full_path):
+                    raise FileOpError(i, 'Already exists: %s' % path)
+                if not os.path.isdir(os.path.dirname(full_path)):
+                    raise FileOpError(i, 'No such folder: %s' % os.path.dirname(path))
+                os.mkdir(full_path)
+                undo.append(('rmdir', full_path, None))
+            else:
+                if not os.path.lexists(full_path):
+                    raise FileOpError(i, 'No such file or folder: %s' % path)
+                if os.path.lexists(full_dest):
+                    raise FileOpError(i, 'Already exists: %s' % dest)
+                if not os.path.isdir(os.path.dirname(full_dest)):
+                    raise FileOpError(i, 'No such folder: %s' % os.path.dirname(dest))
+                shutil.move(full_path, full_dest)
+                undo.append(('move', full_dest, full_path))
+                changed.append(full_dest)
+            changed.append(full_path)
+    except (FileOpError, OSError) as e:
+        for action, a, b in reversed(undo):
+            try:
+                if action == 'move':
+                    shutil.move(a, b)
+                elif action == 'mkdir':
+                    os.mkdir(a)
+                else:
+                    os.rmdir(a)
+            except OSError as undo_error:
+                print("ERROR: Could not undo batch operation (%s %s): %s" % (
+                    action, a, undo_error))
+        shutil.rmtree(holding, ignore_errors=True)
+        if isinstance(e, FileOpError):
+            raise
+        raise FileOpError(len(undo), str(e))
+    shutil.rmtree(holding, ignore_errors=True)
+    return changed
+
+
+BACKGROUND_LOCK = threading.Lock()
+BACKGROUND_STARTED = False
+
+
+@bottle.hook('before_request')
+def start_background_services():
+    """
+    Start the file watcher and the walk for recently changed files once per
+    process: on startup when run directly, otherwise on the first request
+    (e.g. when the app is served by an external WSGI server).
+    """
+    global BACKGROUND_STARTED
+    if BACKGROUND_STARTED:
+        return
+    with BACKGROUND_LOCK:
+        if BACKGROUND_STARTED:
+            return
+        BACKGROUND_STARTED = True
+        RECENT_CHANGES.start()
+        WATCHER.start()
 
 
 def upload_form():
@@ -863,34 +1657,230 @@ def maybe_add_metadata(text, metafields):
     return text
 
 
+class EditVersions:
+    """
+    Earlier contents of edited files, by version token (a hash of the
+    contents), used as the base when a save from an outdated edit page is
+    merged with the changes saved meanwhile.  Opening the editor only keeps
+    the contents in memory (the last `MEMORY_SIZE` versions); when a save
+    replaces a file, the replaced contents are written to
+    tmp/edit_versions/, where they are kept for `MAX_AGE` seconds.
+    """
+    MEMORY_SIZE = 100
+    MAX_AGE = 7 * 86400
+    CLEANUP_INTERVAL = 3600
+
+    def __init__(self, basedir):
+        self.dirname = os.path.join(basedir, 'tmp', 'edit_versions')
+        self.lock_file = os.path.join(basedir, 'tmp', 'edit.lock')
+        self.thread_lock = threading.Lock()
+        self.recent = collections.OrderedDict()
+        self.last_cleanup = 0
+
+    @staticmethod
+    def token(contents):
+        return hashlib.sha256(contents.encode('utf-8')).hexdigest()[:32]
+
+    def remember(self, contents):
+        "Keep `contents` in memory as a possible merge base; returns its token."
+        token = self.token(contents)
+        with self.thread_lock:
+            self.recent[token] = contents
+            self.recent.move_to_end(token)
+            while len(self.recent) > self.MEMORY_SIZE:
+                self.recent.popitem(last=False)
+        return token
+
+    def keep(self, contents):
+        "Save `contents` (which a save is about to replace) to disk."
+        path = os.path.join(self.dirname, self.token(contents))
+        try:
+            if not os.path.exists(path):
+                os.makedirs(self.dirname, exist_ok=True)
+                atomic_write(path, contents)
+        except OSError as e:
+            print("WARNING: Could not keep earlier version: %s" % e)
+        if time.time() - self.last_cleanup > self.CLEANUP_INTERVAL:
+            self.cleanup()
+
+    def get(self, token):
+        "The contents with the given version token, or None if unknown."
+        if not re.fullmatch(r'[0-9a-f]{32}', token or ''):
+            return None
+        with self.thread_lock:
+            if token in self.recent:
+                return self.recent[token]
+        try:
+            with open(os.path.join(self.dirname, token)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Held while checking the version of a file and saving it; the lock
+        file also serializes saves between several admin processes.
+        """
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def cleanup(self):
+        self.last_cleanup = time.time()
+        try:
+            entries = list(os.scandir(self.dirname))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < self.last_cleanup - self.MAX_AGE:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+EDIT_VERSIONS = EditVersions(BASEDIR)
+
+
+def merge_texts(base, ours, theirs):
+    """
+    Three-way merge by lines of two texts derived from `base`.  Changes made
+    on only one side are taken over; where both sides changed the same lines
+    (or lines next to each other) differently, both versions are kept
+    between conflict markers, as in git.  Returns the merged text and the
+    number of conflicts.
+    """
+    base_lines = base.splitlines(keepends=True)
+    sides = (ours.splitlines(keepends=True), theirs.splitlines(keepends=True))
+    for lines in (base_lines, ) + sides:
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+    # (base start, base end, side, replacement lines) for each change, in order
+    changes = sorted(
+        (i1, i2, side, lines[j1:j2])
+        for side, lines in enumerate(sides)
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+            None, base_lines, lines, autojunk=False).get_opcodes()
+        if tag != 'equal')
+    merged, conflicts, pos, k = [], 0, 0, 0
+    while k < len(changes):
+        start, end = changes[k][0], changes[k][1]
+        group = [changes[k]]
+        k += 1
+        while k < len(changes) and changes[k][0] <= end:
+            end = max(end, changes[k][1])
+            group.append(changes[k])
+            k += 1
+        merged += base_lines[pos:start]
+        pos = end
+        versions = []
+        for side in (0, 1):
+            hunks = [_ for _ in group if _[2] == side]
+            if not hunks:
+                continue
+            lines, i = [], start
+            for i1, i2, _, replacement in hunks:
+                lines += base_lines[i:i1] + replacement
+                i = i2
+            versions.append(lines + base_lines[i:end])
+        if len(versions) == 1 or versions[0] == versions[1]:
+            merged += versions[0]
+        else:
+            conflicts += 1
+            merged += (['<<<<<<< your version\n'] + versions[0] + ['=======\n']
+                       + versions[1] + ['>>>>>>> saved meanwhile\n'])
+    merged += base_lines[pos:]
+    text = ''.join(merged)
+    if text and not ours.endswith('\n') and not theirs.endswith('\n'):
+        text = text[:-1]
+    return text, conflicts
+
+
 def save_file(section, filename, request):
+    """
+    Save the contents posted from the edit form, which carries the version
+    token of the contents it was opened with (an `If-Match` header is also
+    accepted).  If the file has been saved by someone else meanwhile, their
+    changes are merged with these; if the two conflict, nothing is saved and
+    the edit form is shown again (with status 409) with both versions of the
+    conflicting lines.  The file is replaced atomically.
+    """
     is_config = section is None and filename == 'wmk_config.yaml'
     root = BASEDIR if is_config else os.path.join(BASEDIR, section)
     full_path = os.path.join(root, filename)
     new_contents = request.forms.getunicode('contents')
     new_contents = new_contents.replace("\r\n", "\n")
+    base_version = request.forms.get('version') or request.get_header(
+        'If-Match', '').strip().strip('"')
     conf = get_config(BASEDIR, 'wmk_admin') or {}
     auto_metadata = conf.get('auto_metadata') or {}
     ext = os.path.splitext(filename)[1]
-    if auto_metadata and ext[1:] in auto_metadata:
-        # auto_metadata is a map from file extension to list of datetime
-        # fields to be automatically added/updated.
-        new_contents = maybe_add_metadata(
-            new_contents, auto_metadata[ext[1:]])
-    with open(full_path, 'w') as f:
-        f.write(new_contents)
-    quick_build = section and section == 'content'
-    wmk_build('Saved file ' + full_path, quick=quick_build)
+    merged = False
+    with EDIT_VERSIONS.locked():
+        try:
+            with open(full_path) as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if (base_version and base_version != '*' and current is not None
+                and EDIT_VERSIONS.token(current) != base_version):
+            base = EDIT_VERSIONS.get(base_version)
+            if base is None:
+                # Too old to merge: show how the saved file differs instead
+                response.status = 409
+                return edit_form(
+                    section, filename, full_path, contents=new_contents,
+                    version=EDIT_VERSIONS.remember(current), diff=''.join(
+                        difflib.unified_diff(
+                            current.splitlines(keepends=True),
+                            new_contents.splitlines(keepends=True),
+                            'saved meanwhile', 'your version')),
+                    flash=('The file was saved by someone else while you were editing it, '
+                           'and your changes cannot be merged with theirs automatically. '
+                           'Nothing has been saved yet. The differences between the saved '
+                           'file and your version are shown below; saving again will '
+                           'replace the saved file with your version.', 'warning'))
+            new_contents, conflicts = merge_texts(base, new_contents, current)
+            if conflicts:
+                response.status = 409
+                return edit_form(
+                    section, filename, full_path, contents=new_contents,
+                    version=EDIT_VERSIONS.remember(current), flash=(
+                        'The file was saved by someone else while you were editing it, '
+                        'and %d of your changes conflict with theirs. Nothing has been '
+                        'saved yet. Both versions are shown below between <<<<<<< and '
+                        '>>>>>>> lines: keep what you want and save again.' % conflicts,
+                        'warning'))
+            merged = True
+        if auto_metadata and ext[1:] in auto_metadata:
+            # auto_metadata is a map from file extension to list of datetime
+            # fields to be automatically added/updated.
+            new_contents = maybe_add_metadata(
+                new_contents, auto_metadata[ext[1:]])
+        if current is not None and current != new_contents:
+            # Others may still be editing the version being replaced
+            EDIT_VERSIONS.keep(current)
+        atomic_write(full_path, new_contents)
+    if is_config:
+        CONFIG_CACHE.invalidate(full_path)
+    files_changed([full_path])
+    BUILD_QUEUE.submit('Saved file ' + full_path, paths=[full_path])
     redir_url = ''
     if is_config:
-        set_flash_message(
-            request, 'S:Updated main site configuration file, wmk_config.yaml')
+        msg = 'Updated main site configuration file, wmk_config.yaml'
         redir_url = '/_/admin/'
     else:
         display_path = os.path.join(section, filename)
         display_dir, display_filename = os.path.split(display_path)
-        set_flash_message(request, 'Saved file "%s" in %s' % (display_filename, display_dir))
+        msg = 'Saved file "%s" in %s' % (display_filename, display_dir)
         redir_url = '/_/admin/list/%s' % display_dir
+    if merged:
+        msg += ' (it had been changed by someone else meanwhile; your changes were merged with theirs)'
+    set_flash_message(request, msg)
     if 'save_and_edit' in request.forms:
         redir_url = request.url
     redirect(redir_url)
@@ -913,7 +1903,7 @@ def wmk_site(filename='index.html'):
     root = os.path.join(BASEDIR, 'htdocs')
     full_path = os.path.join(root, filename)
     if os.path.isdir(full_path):
-        filename += '/index.html'
+        filename = filename.rstrip('/') + '/index.html'
     conf = get_config(BASEDIR, 'wmk_admin')
     show_admin_overlay = True
     if 'show_admin_overlay' in conf:
@@ -921,37 +1911,167 @@ def wmk_site(filename='index.html'):
             show_admin_overlay = False
         if conf['show_admin_overlay'] in ('logged-in', 'admin', 'admin-only'):
             show_admin_overlay = True if is_logged_in(request) else False
-    resp = static_file(filename, root=root)
-    if 'Content-Type' in resp.headers and resp.headers['Content-Type'].startswith('text/html'):
-        if isinstance(resp.body, str):
-            body = resp.body.encode('utf-8')
-        elif isinstance(resp.body, bytes):
-            body = resp.body
-        else:
-            body = resp.body.read()
-            resp.body.close()
+    edit_url = None
+    if show_admin_overlay:
         edit_url = filename.replace('//', '/').replace('/index.html', '.md').replace('index.html', 'index.md')
         edit_url = '/_/admin/edit/content/%s' % edit_url
-        if show_admin_overlay:
-            body = body.replace(b'</body>', admin_marker(edit_url).encode('utf-8') + b'</body>')
-        resp.body = body
-        resp.headers['Content-Length'] = str(len(body))
+    return serve_htdocs(filename, edit_url)
+
+
+def serve_htdocs(filename, edit_url=None):
+    """
+    Serve a file from htdocs, injecting the admin overlay into HTML pages if
+    `edit_url` is given.  Overlaid pages come from HTML_VARIANTS; other files
+    are handed to the WSGI server as open files (so that servers supporting
+    wsgi.file_wrapper can use sendfile), preferring precompressed .br/.gz
+    siblings where the client accepts them.  Conditional (ETag) and Range
+    requests are supported for both.
+    """
+    root = os.path.abspath(os.path.join(BASEDIR, 'htdocs'))
+    full_path = os.path.abspath(os.path.join(root, filename.strip('/\\')))
+    if not full_path.startswith(root + os.sep):
+        abort(403, "Access denied.")
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        abort(404, "File does not exist.")
+    if not stat.S_ISREG(st.st_mode):
+        abort(404, "File does not exist.")
+    mimetype = guess_mimetype(full_path)
+    headers = {
+        'Last-Modified': bottle.http_date(st.st_mtime),
+        'Cache-Control': 'no-cache',
+    }
+    if edit_url and mimetype == 'text/html':
+        body, etag = HTML_VARIANTS.get(full_path, st, edit_url)
+        headers['ETag'] = etag
+        headers['Content-Type'] = 'text/html; charset=UTF-8'
+        return _bytes_response(body, headers)
+    rel_path = full_path[len(root)+1:]
+    entry = HTDOCS_MANIFEST.get(rel_path, st)
+    encoding = None
+    if not request.environ.get('HTTP_RANGE'):
+        for encoding, ext in _accepted_encodings():
+            if entry is not None:
+                # The manifest knows which siblings are current
+                if [encoding, ext] in entry['encodings']:
+                    rel_path += ext
+                    break
+                continue
+            try:
+                if os.stat(full_path + ext).st_mtime_ns >= st.st_mtime_ns:
+                    rel_path += ext
+                    break
+            except OSError:
+                pass
+        else:
+            encoding = None
+    if entry is not None:
+        etag = '"%s%s"' % (entry['sha256'][:32], '-' + encoding if encoding else '')
+        mimetype = entry['mime']
+    else:
+        etag = '"%x-%x%s"' % (st.st_mtime_ns, st.st_size, '-' + encoding if encoding else '')
+    headers['ETag'] = etag
+    headers['Vary'] = 'Accept-Encoding'
+    if _etag_matches(etag):
+        return bottle.HTTPResponse(status=304, **headers)
+    resp = static_file(rel_path, root=root, mimetype=mimetype)
+    if resp.status_code < 400:
+        for k, v in headers.items():
+            resp.set_header(k, v)
+        if encoding:
+            resp.set_header('Content-Encoding', encoding)
     return resp
 
-def admin_marker(edit_url):
-    return f'''
-    <div id="in-admin-notice"
-         style="background:red;color:yellow;padding:.5em;position:fixed;bottom:0;right:0;width:230px;text-align:center">
-         <strong><small><a href="/_/admin/" style="color:yellow;text-decoration:none">Admin</a></small></strong>
-         | <small><a href="{edit_url}" style="color:yellow;text-decoration:none">edit</a></small>
-    </div>'''
 
+def _accepted_encodings():
+    accepted = set()
+    for part in request.environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        token, _, params = part.strip().partition(';')
+        if re.match(r'\s*q=0(?:\.0*)?\s*$', params):
+            continue
+        accepted.add(token.strip().lower())
+    return [_ for _ in PRECOMPRESSED_EXTENSIONS if _[0] in accepted]
+
+
+def _etag_matches(etag):
+    inm = request.environ.get('HTTP_IF_NONE_MATCH')
+    if not inm:
+        return False
+    tags = [_.strip() for _ in inm.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+
+def _bytes_response(body, headers):
+    "An in-memory response honouring If-None-Match and (single) Range headers."
+    if _etag_matches(headers['ETag']):
+        return bottle.HTTPResponse(status=304, **headers)
+    headers['Accept-Ranges'] = 'bytes'
+    range_header = request.environ.get('HTTP_RANGE')
+    if range_header:
+        ranges = list(bottle.parse_range_header(range_header, len(body)))
+        if not ranges:
+            return HTTPError(416, "Requested Range Not Satisfiable")
+        offset, end = ranges[0]
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, end - 1, len(body))
+        headers['Content-Length'] = str(end - offset)
+        return bottle.HTTPResponse(body[offset:end], status=206, **headers)
+    headers['Content-Length'] = str(len(body))
+    return bottle.HTTPResponse(body, **headers)
+
+
+def precompile_templates():
+    """
+    Compile every template in views/ now rather than on first use. Outside
+    debug mode, bottle then reuses them for all requests.
+    """
+    lookup = bottle.TEMPLATE_PATH
+    for fn in sorted(os.listdir(lookup[0])):
+        if fn.endswith('.tpl'):
+            tpl = bottle.SimpleTemplate(name=fn, lookup=lookup)
+            tpl.co  # compiles the template
+            bottle.TEMPLATES[(id(lookup), fn)] = tpl
+
+
+def print_startup_profile():
+    """
+    Print the time taken by each phase of loading admin.py and the slowest
+    imports (measured by running its import statements again with
+    `python -X importtime`).
+    """
+    print("Startup phases:")
+    for (_, prev), (name, now) in zip(STARTUP_PHASES, STARTUP_PHASES[1:]):
+        print("  %-14s %8.1f ms" % (name, (now - prev) * 1000))
+    print("  %-14s %8.1f ms" % (
+        'total', (STARTUP_PHASES[-1][1] - STARTUP_PHASES[0][1]) * 1000))
+    # Only the import statements of admin.py are run again, so that module
+    # setup (session files, secret key, ...) has no side effects twice
+    import ast
+    with open(__file__) as f:
+        tree = ast.parse(f.read())
+    code = 'import sys; sys.path.insert(0, %r)\n' % os.path.dirname(__file__) + '\n'.join(
+        ast.unparse(_) for _ in tree.body if isinstance(_, (ast.Import, ast.ImportFrom)))
+    info = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=BASEDIR, capture_output=True, text=True)
+    rows = []
+    for line in info.stderr.splitlines():
+        found = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (.*)', line)
+        if found:
+            rows.append((int(found.group(2)), int(found.group(1)), found.group(3)))
+    print("Slowest imports (cumulative / self, in ms):")
+    for cumulative, own, name in sorted(rows, reverse=True)[:20]:
+        print("  %8.1f %8.1f  %s" % (cumulative / 1000, own / 1000, name))
 
 
 if __name__ == '__main__':
+    STARTUP_PHASES.append(('module setup', time.perf_counter()))
+    if '--profile-startup' in sys.argv:
+        print_startup_profile()
+        sys.exit(0)
     host = 'localhost'
     port = 7077
     server = None
+    debug = False
     try:
         basedir = os.path.split(os.path.dirname(__file__))[0]
         config_file = os.path.join(basedir, 'wmk_admin.yaml')
@@ -967,6 +2087,10 @@ if __name__ == '__main__':
             host = conf['host']
         if 'server' in conf:
             server = conf['server']
+        debug = bool(conf.get('debug', False))
     except Exception as e:
         print("WARNING: Error in loading wmk_admin.yaml: %s" % str(e))
-    run(host=host, port=port, debug=True, server=server)
+    if not debug:
+        precompile_templates()
+    start_background_services()
+    run(host=host, port=port, debug=debug, server=server)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Time the upload of a batch of images as attachments in one request.
+
+Usage: python bench/attachment_upload.py [IMAGE_COUNT]
+
+Requires wmk and Pillow (run it from the wmk venv). A project with this
+admin is set up in a temporary directory, and IMAGE_COUNT (default 200)
+photo-sized JPEG images are sent to /_/admin/upload/chunked/ and finished
+as a single batch, first with one saving thread and one worker process and
+then with the default thread and process pools. Building is postponed
+(build_delay), and the number of builds queued by each request is shown.
+"""
+
+import io
+import json
+import os
+import sys
+import shutil
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from PIL import Image
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_project(basedir):
+    for d in ('content', 'data', 'templates', 'static', 'tmp'):
+        os.makedirs(os.path.join(basedir, d))
+    with open(os.path.join(basedir, 'wmk_config.yaml'), 'w') as f:
+        f.write("site:\n  title: Benchmark\n")
+    with open(os.path.join(basedir, 'wmk_admin.yaml'), 'w') as f:
+        f.write("admin_password: bench\nbuild_delay: 3600\n")
+    os.symlink(REPO, os.path.join(basedir, 'admin'))
+
+
+def make_images(count):
+    ret = []
+    for i in range(count):
+        im = Image.merge('RGB', [Image.effect_noise((1600, 1200), 30 + i % 20)] * 3)
+        buf = io.BytesIO()
+        im.save(buf, 'JPEG', quality=85)
+        ret.append(('IMG_%04d.JPG' % i, buf.getvalue()))
+    return ret
+
+
+def upload_chunked(app, cookie, attachment_dir, images):
+    "Send `images` like static/js/chunked-upload.js does and finish the batch."
+    form = 'application/x-www-form-urlencoded'
+    ids = []
+    for name, data in images:
+        status, _, body = call(app, 'POST', '/_/admin/upload/chunked/', urlencode({
+            'kind': 'attachment', 'dest_dir': attachment_dir, 'filename': name,
+            'size': len(data)}).encode(), form, cookie)
+        info = json.loads(body)
+        for offset in range(0, len(data), info['chunk_size']):
+            call(app, 'PUT', '/_/admin/upload/chunked/%s' % info['id'],
+                 data[offset:offset + info['chunk_size']], 'application/octet-stream',
+                 cookie, 'offset=%d' % offset)
+        ids.append(info['id'])
+    status, _, _ = call(app, 'POST', '/_/admin/upload/chunked/finish/',
+                        urlencode({'ids': ','.join(ids)}).encode(), form, cookie)
+    return status
+
+
+def call(app, method, path, body=b'', content_type='', cookie='', query=''):
+    environ = {
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '7077', 'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body), 'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': content_type, 'HTTP_COOKIE': cookie, 'wsgi.errors': sys.stderr}
+    ret = {}
+
+    def start_response(status, headers, exc_info=None):
+        ret['status'] = status
+        ret['headers'] = headers
+    body = b''.join(app(environ, start_response))
+    return ret['status'], ret['headers'], body
+
+
+def main(count):
+    basedir = tempfile.mkdtemp(prefix='wmk-bench-')
+    try:
+        make_project(basedir)
+        sys.path.insert(0, os.path.join(basedir, 'admin'))
+        import admin
+        import bottle
+        from wmkadmin import caches, uploads
+        app = bottle.default_app()
+        status, headers, _ = call(app, 'POST', '/_/admin/login/', b'password=bench',
+                                  'application/x-www-form-urlencoded')
+        cookie = [v.split(';')[0] for k, v in headers if k == 'Set-Cookie'][0]
+        print("Generating %d images..." % count)
+        images = make_images(count)
+        print("%d images, %.1f MB in total" % (
+            count, sum(len(_[1]) for _ in images) / 1024 / 1024))
+        for label, threads, workers in (
+                ('serial (1 thread, 1 process)', 1, 1),
+                ('parallel (default pools)', uploads.AttachmentIngester.SAVE_THREADS,
+                 caches.WorkerPool.MAX_WORKERS)):
+            # The images are the same in both runs, and so would be their thumbnails
+            shutil.rmtree(os.path.join(basedir, 'tmp', 'thumbs'), ignore_errors=True)
+            ingester = uploads.ATTACHMENTS = uploads.AttachmentIngester(basedir)
+            ingester.SAVE_THREADS = threads
+            caches.WORKER_POOL.MAX_WORKERS = workers
+            attachment_dir = 'content/batch%d' % threads
+            before = admin.BUILD_QUEUE.status()['queue_depth']
+            start = time.perf_counter()
+            status = upload_chunked(app, cookie, attachment_dir, images)
+            duration = time.perf_counter() - start
+            saved = len(os.listdir(os.path.join(basedir, attachment_dir)))
+            builds = admin.BUILD_QUEUE.status()['queue_depth'] - before
+            print("%-32s %8.3f s  (%s; %d files saved; %d build request)" % (
+                label, duration, status, saved, builds))
+            caches.WORKER_POOL.shutdown()
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
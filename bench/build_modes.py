@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compare full, quick and targeted wmk builds on a synthetic site.
+
+Usage: python bench/build_modes.py [PAGE_COUNT]
+
+Requires wmk to be installed (run it from the wmk venv). A site with
+PAGE_COUNT pages (default 2000) spread over a few directories is generated
+in a temporary directory. One page is then edited and the site rebuilt
+with a quick build and with a targeted build (as planned by the admin's
+dependency index); finally a template used by a tenth of the pages is
+edited and a targeted build is made for that.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admin  # noqa: F401 (puts wmk on sys.path)
+import wmk
+from wmkadmin.deploy import DependencyIndex
+
+
+def make_site(basedir, page_count):
+    for d in ('content', 'data', 'templates', 'static', 'tmp'):
+        os.makedirs(os.path.join(basedir, d))
+    with open(os.path.join(basedir, 'wmk_config.yaml'), 'w') as f:
+        f.write("site:\n  title: Benchmark\n")
+    with open(os.path.join(basedir, 'wmk_admin.yaml'), 'w') as f:
+        f.write("targeted_builds: true\n")
+    with open(os.path.join(basedir, 'templates', 'md_base.mhtml'), 'w') as f:
+        f.write("<html><body>${ CONTENT }</body></html>\n")
+    with open(os.path.join(basedir, 'templates', 'special.mhtml'), 'w') as f:
+        f.write("<html><body class=\"special\">${ CONTENT }</body></html>\n")
+    for i in range(page_count):
+        subdir = os.path.join(basedir, 'content', 'section%02d' % (i % 20))
+        os.makedirs(subdir, exist_ok=True)
+        template = 'template: special.mhtml\n' if i % 10 == 0 else ''
+        with open(os.path.join(subdir, 'page%05d.md' % i), 'w') as f:
+            f.write("---\ntitle: Page %d\n%s---\n\n# Page %d\n\n%s\n" % (
+                i, template, i, 'Lorem ipsum dolor sit amet. ' * 40))
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        fn()
+    print("%-32s %8.3f s" % (label, time.perf_counter() - start))
+
+
+def touch(path, text):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def main(page_count):
+    basedir = tempfile.mkdtemp(prefix='wmk-bench-')
+    try:
+        make_site(basedir, page_count)
+        deps = DependencyIndex(basedir)
+        page = os.path.join(basedir, 'content', 'section03', 'page00003.md')
+        template = os.path.join(basedir, 'templates', 'special.mhtml')
+
+        def targeted(paths):
+            stale = deps.plan(paths)
+            if stale is None:
+                wmk.main(basedir)
+            else:
+                deps.mark_stale(stale)
+                wmk.main(basedir, quick=True)
+
+        print("Synthetic site with %d pages in %s" % (page_count, basedir))
+        timed('full build (cold)', lambda: wmk.main(basedir))
+        timed('full build (warm)', lambda: wmk.main(basedir))
+        touch(page, "\nEdited.\n")
+        timed('quick build, one page edited', lambda: wmk.main(basedir, quick=True))
+        touch(page, "\nEdited again.\n")
+        timed('targeted build, one page edited', lambda: targeted([page]))
+        touch(template, "<!-- edited -->\n")
+        timed('targeted build, template edited', lambda: targeted([template]))
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Time the rendering of the file manager for large directories.
+
+Usage: python bench/list_dir_render.py [ENTRY_COUNT ...]
+
+Requires wmk (run it from the wmk venv). A project with this admin is set
+up in a temporary directory, with a content directory of ENTRY_COUNT files
+(default: 1000, 10000 and 100000). The first page of each directory is
+requested REPEAT times through the admin app, both with and without the
+fragment cache for the rows, and the median time per request is shown.
+Templates are precompiled first, as when the admin runs outside debug mode.
+"""
+
+import io
+import os
+import sys
+import shutil
+import statistics
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPEAT = 20
+
+
+def make_project(basedir, counts):
+    for d in ('content', 'data', 'templates', 'static', 'tmp'):
+        os.makedirs(os.path.join(basedir, d))
+    with open(os.path.join(basedir, 'wmk_config.yaml'), 'w') as f:
+        f.write("site:\n  title: Benchmark\n")
+    with open(os.path.join(basedir, 'wmk_admin.yaml'), 'w') as f:
+        f.write("admin_password: bench\nbuild_delay: 3600\n")
+    os.symlink(REPO, os.path.join(basedir, 'admin'))
+    for count in counts:
+        subdir = os.path.join(basedir, 'content', 'dir%d' % count)
+        os.makedirs(subdir)
+        for i in range(count):
+            with open(os.path.join(subdir, 'page%06d.md' % i), 'w') as f:
+                f.write("---\ntitle: Page %d\n---\n\nText.\n" % i)
+
+
+def call(app, method, path, body=b'', content_type='', cookie=''):
+    environ = {
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '7077', 'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body), 'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': content_type, 'HTTP_COOKIE': cookie, 'wsgi.errors': sys.stderr}
+    ret = {}
+
+    def start_response(status, headers, exc_info=None):
+        ret['status'] = status
+        ret['headers'] = headers
+    b''.join(app(environ, start_response))
+    return ret['status'], ret['headers']
+
+
+def main(counts):
+    basedir = tempfile.mkdtemp(prefix='wmk-bench-')
+    try:
+        print("Creating %s files..." % ' + '.join(str(_) for _ in counts))
+        make_project(basedir, counts)
+        sys.path.insert(0, os.path.join(basedir, 'admin'))
+        import admin
+        import bottle
+        from wmkadmin.caches import FragmentCache
+        app = bottle.default_app()
+        admin.precompile_templates()
+        status, headers = call(app, 'POST', '/_/admin/login/', b'password=bench',
+                               'application/x-www-form-urlencoded')
+        cookie = [v.split(';')[0] for k, v in headers if k == 'Set-Cookie'][0]
+        for count in counts:
+            path = '/_/admin/list/content/dir%d/' % count
+            for label, max_entries in (('without fragment cache', 0),
+                                       ('with fragment cache', 256)):
+                admin.DIR_ROWS = FragmentCache()
+                admin.DIR_ROWS.MAX_ENTRIES = max_entries
+                times = []
+                for _ in range(REPEAT):
+                    start = time.perf_counter()
+                    status, _ = call(app, 'GET', path, cookie=cookie)
+                    times.append(time.perf_counter() - start)
+                print("%7d entries, %-24s %8.2f ms  (%s)" % (
+                    count, label, statistics.median(times) * 1000, status))
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == '__main__':
+    main([int(_) for _ in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,122 @@
+/*
+ * Chunked, resumable uploads to /_/admin/upload/chunked/ (see the
+ * ChunkedUploads class in admin.py). Each file is sent in chunks together
+ * with their SHA-256 hash (where the browser allows it); an interrupted
+ * upload continues from the offset the server reports, also after the page
+ * has been reloaded. When all files have been sent, the batch is finished
+ * with one request, which returns JSON from the server.
+ */
+const ChunkedUpload = (() => {
+  const base = '/_/admin/upload/chunked/';
+  const max_failures = 5;
+
+  const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+  async function json_or_throw(response) {
+    if (!response.ok) {
+      throw new Error(`Upload failed (${response.status} ${response.statusText})`);
+    }
+    return response.json();
+  }
+
+  async function sha256_hex(buf) {
+    // crypto.subtle is only available on https and localhost
+    if (!(window.crypto && window.crypto.subtle)) return null;
+    const digest = await window.crypto.subtle.digest('SHA-256', buf);
+    return Array.from(new Uint8Array(digest))
+      .map((b) => b.toString(16).padStart(2, '0')).join('');
+  }
+
+  function resume_key(file, fields) {
+    return 'wmk-upload:' + [fields.kind, fields.dest_dir, fields.dest_name || '',
+                            file.name, file.size, file.lastModified].join(':');
+  }
+
+  async function start(file, fields) {
+    const key = resume_key(file, fields);
+    const known = window.localStorage.getItem(key);
+    if (known) {
+      const response = await fetch(base + known);
+      if (response.ok) return [key, await response.json()];
+      window.localStorage.removeItem(key);
+    }
+    const form_data = new FormData();
+    for (const [name, value] of Object.entries(fields)) form_data.append(name, value);
+    form_data.append('filename', file.name);
+    form_data.append('size', file.size);
+    const info = await json_or_throw(await fetch(base, {method: 'POST', body: form_data}));
+    window.localStorage.setItem(key, info.id);
+    return [key, info];
+  }
+
+  async function send(file, fields, progress) {
+    const [key, info] = await start(file, fields);
+    let offset = info.offset;
+    let failures = 0;
+    if (progress) progress(file, offset);
+    while (offset < file.size) {
+      const buf = await file.slice(offset, offset + info.chunk_size).arrayBuffer();
+      const headers = {'Content-Type': 'application/octet-stream'};
+      const hash = await sha256_hex(buf);
+      if (hash) headers['X-Chunk-SHA256'] = hash;
+      try {
+        const response = await fetch(`${base}${info.id}?offset=${offset}`,
+                                     {method: 'PUT', headers: headers, body: buf});
+        offset = (await json_or_throw(response)).offset;
+        failures = 0;
+        if (progress) progress(file, offset);
+      } catch (error) {
+        if (++failures > max_failures) throw error;
+        await sleep(1000 * failures);
+        // Continue from wherever the server got to
+        try {
+          offset = (await json_or_throw(await fetch(base + info.id))).offset;
+        } catch (e) {
+          console.error("Upload Error:", e);
+        }
+      }
+    }
+    return [key, info.id];
+  }
+
+  async function upload(files, fields, progress) {
+    const keys = [];
+    const ids = [];
+    for (const file of files) {
+      const [key, id] = await send(file, fields, progress);
+      keys.push(key);
+      ids.push(id);
+    }
+    const form_data = new FormData();
+    form_data.append('ids', ids.join(','));
+    const ret = await json_or_throw(await fetch(base + 'finish/', {method: 'POST', body: form_data}));
+    for (const key of keys) window.localStorage.removeItem(key);
+    return ret;
+  }
+
+  // Submit handler for a form with `dest_dir`, `dest_name` and `upload`
+  // fields, a submit button and a <progress> element: uploads the file and
+  // goes to the page the server names.
+  function submit_form(ev) {
+    ev.preventDefault();
+    const form = ev.target;
+    const file = form.upload.files[0];
+    if (!file) return false;
+    const bar = form.querySelector('progress');
+    const btn = form.querySelector('input[type=submit]');
+    btn.disabled = true;
+    bar.hidden = false;
+    const fields = {kind: 'file', dest_dir: form.dest_dir.value, dest_name: form.dest_name.value};
+    upload([file], fields, (f, offset) => {
+      bar.value = f.size ? 100 * offset / f.size : 100;
+    }).then((ret) => {
+      window.location = ret.redirect;
+    }).catch((error) => {
+      btn.disabled = false;
+      alert(error.message);
+    });
+    return false;
+  }
+
+  return {upload: upload, submit_form: submit_form};
+})();
@@ -0,0 +1,40 @@
+"""
+The tests run against a throwaway project directory which has this admin in
+its `admin` subdirectory (as a symlink), like bench/*.py.  It is set up here,
+before any test module imports admin.py.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT = tempfile.mkdtemp(prefix='wmk-admin-test-')
+
+for _dirname in ('content', 'data', 'templates', 'static', 'htdocs', 'tmp'):
+    os.makedirs(os.path.join(PROJECT, _dirname))
+with open(os.path.join(PROJECT, 'wmk_config.yaml'), 'w') as f:
+    f.write("site:\n  title: Test\n")
+with open(os.path.join(PROJECT, 'wmk_admin.yaml'), 'w') as f:
+    f.write("admin_password: test\nbuild_delay: 0.3\nwatch_files: false\n")
+# Only the location of wmk is needed: it is imported when a build runs
+os.makedirs(os.path.join(PROJECT, 'wmk_home'))
+open(os.path.join(PROJECT, 'wmk_home', 'wmk.py'), 'w').close()
+os.environ['WMK_HOME'] = os.path.join(PROJECT, 'wmk_home')
+# Set by admin.py, for the tests which only import wmkadmin
+os.environ['WMK_ADMIN_BASEDIR'] = PROJECT
+os.symlink(REPO, os.path.join(PROJECT, 'admin'))
+sys.path.insert(0, os.path.join(PROJECT, 'admin'))
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(PROJECT, ignore_errors=True)
+
+
+@pytest.fixture
+def project():
+    "The project directory (admin.BASEDIR)."
+    return PROJECT
@@ -0,0 +1,75 @@
+import bottle
+import pytest
+
+import admin
+
+
+def test_merge_texts_takes_over_changes_from_both_sides():
+    base = 'one\ntwo\nthree\nfour\n'
+    ours = 'ONE\ntwo\nthree\nfour\n'
+    theirs = 'one\ntwo\nthree\nFOUR\n'
+    assert admin.merge_texts(base, ours, theirs) == ('ONE\ntwo\nthree\nFOUR\n', 0)
+
+
+def test_merge_texts_marks_conflicts():
+    base = 'one\ntwo\nthree\nfour\n'
+    ours = 'one!\ntwo\nthree\nfour\n'
+    theirs = 'one?\ntwo\nthree\nfour?\n'
+    text, conflicts = admin.merge_texts(base, ours, theirs)
+    assert conflicts == 1
+    assert text == ('<<<<<<< your version\none!\n=======\none?\n'
+                    '>>>>>>> saved meanwhile\ntwo\nthree\nfour?\n')
+
+
+def test_merge_texts_changes_next_to_each_other_conflict():
+    text, conflicts = admin.merge_texts('a\nb\n', 'A\nb\n', 'a\nB\n')
+    assert conflicts == 1
+    assert '=======\n' in text
+
+
+def test_merge_texts_same_change_on_both_sides():
+    assert admin.merge_texts('a\nb\nc', 'a\nX\nc', 'a\nX\nc') == ('a\nX\nc', 0)
+
+
+def test_merge_texts_unchanged():
+    assert admin.merge_texts('a\nb\n', 'a\nb\n', 'a\nb\n') == ('a\nb\n', 0)
+
+
+def _flash_round_trip(tamper=None):
+    bottle.response.bind()
+    admin.set_flash_message(bottle.request, 'Saved <b>it</b>', 'warning')
+    cookie = [v for k, v in bottle.response.headerlist
+              if k == 'Set-Cookie' and v.startswith(admin.FLASH_COOKIE_NAME + '=')]
+    assert len(cookie) == 1
+    value = cookie[0].split(';', 1)[0]
+    if tamper:
+        value = tamper(value)
+    bottle.request.bind({'HTTP_COOKIE': value})
+    bottle.response.bind()
+    return admin.get_flash_message(bottle.request)
+
+
+def test_flash_message_round_trip():
+    assert _flash_round_trip() == ('Saved <b>it</b>', 'warning')
+    # The cookie is removed once the message has been read
+    assert any(k == 'Set-Cookie' and v.startswith(admin.FLASH_COOKIE_NAME + '=')
+               and 'expires=Thu, 01 Jan 1970' in v
+               for k, v in bottle.response.headerlist)
+
+
+@pytest.mark.parametrize('tamper', [
+    # Another payload with the original signature
+    lambda v: v.replace('.', 'x.', 1) if '.' in v else v + 'x',
+    # The original payload with another signature
+    lambda v: v[:-1] + ('0' if v[-1] != '0' else '1'),
+    # No signature at all
+    lambda v: v.rpartition('.')[0],
+])
+def test_flash_message_tampered(tamper):
+    assert _flash_round_trip(tamper) == ('', None)
+
+
+def test_flash_message_absent():
+    bottle.request.bind({})
+    bottle.response.bind()
+    assert admin.get_flash_message(bottle.request) == ('', None)
@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from wmkadmin import caches
+
+
+@pytest.fixture
+def htdocs(tmp_path):
+    os.makedirs(os.path.join(str(tmp_path), 'tmp'))
+    root = os.path.join(str(tmp_path), 'htdocs')
+    os.makedirs(os.path.join(root, 'blog'))
+    for rel, text in (('index.html', '<p>Home</p>\n' * 100),
+                      ('blog/index.html', '<p>Blog</p>\n' * 100),
+                      ('small.css', 'p {}\n')):
+        with open(os.path.join(root, rel), 'w') as f:
+            f.write(text)
+    return root
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    "The files hashed and compressed by the manifest."
+    calls = {'hash': [], 'compress': []}
+    hash_file, precompress_file = caches._hash_file, caches._precompress_file
+
+    def fake_hash(full_path):
+        calls['hash'].append(full_path)
+        return hash_file(full_path)
+
+    def fake_precompress(args):
+        calls['compress'].append(args[0])
+        return precompress_file(args)
+    monkeypatch.setattr(caches, '_hash_file', fake_hash)
+    monkeypatch.setattr(caches, '_precompress_file', fake_precompress)
+    return calls
+
+
+def test_update(htdocs, calls):
+    manifest = caches.HtdocsManifest(os.path.dirname(htdocs))
+    stats = manifest.update()
+    assert stats['scan']['files'] == 3 and stats['hash']['files'] == 3
+    assert stats['pages_written'] == 2
+    # Too small to be worth compressing
+    assert sorted(calls['compress']) == [
+        os.path.join(htdocs, 'blog', 'index.html'), os.path.join(htdocs, 'index.html')]
+    assert os.path.isfile(os.path.join(htdocs, 'index.html.gz'))
+    assert not os.path.exists(os.path.join(htdocs, 'small.css.gz'))
+    entry = manifest.entries['index.html']
+    assert entry['mime'] == 'text/html' and ['gzip', '.gz'] in entry['encodings']
+    # The manifest is saved and used by a new instance
+    assert caches.HtdocsManifest(os.path.dirname(htdocs)).update()['hash']['files'] == 0
+
+
+def test_update_skips_unchanged_files(htdocs, calls):
+    manifest = caches.HtdocsManifest(os.path.dirname(htdocs))
+    manifest.update()
+    calls['hash'].clear()
+    calls['compress'].clear()
+    stats = manifest.update()
+    assert stats['hash']['files'] == 0 and stats['compress']['files'] == 0
+    assert stats['pages_written'] == 0
+    assert calls == {'hash': [], 'compress': []}
+
+
+def test_update_same_contents_rewritten(htdocs, calls):
+    manifest = caches.HtdocsManifest(os.path.dirname(htdocs))
+    manifest.update()
+    calls['compress'].clear()
+    page = os.path.join(htdocs, 'index.html')
+    os.utime(page, ns=(0, 1))
+    stats = manifest.update()
+    assert stats['hash']['files'] == 1
+    # Rehashed, but the compressed sibling is kept
+    assert calls['compress'] == []
+    assert ['gzip', '.gz'] in manifest.entries['index.html']['encodings']
+    assert os.path.isfile(page + '.gz')
+
+
+def test_update_changed_and_removed_files(htdocs, calls):
+    manifest = caches.HtdocsManifest(os.path.dirname(htdocs))
+    manifest.update()
+    calls['compress'].clear()
+    page = os.path.join(htdocs, 'index.html')
+    with open(page, 'w') as f:
+        f.write('<p>New home</p>\n' * 100)
+    os.utime(page, ns=(0, 1))
+    os.remove(os.path.join(htdocs, 'blog', 'index.html'))
+    stats = manifest.update()
+    assert calls['compress'] == [page]
+    assert stats['removed_siblings'] == 1
+    assert not os.path.exists(os.path.join(htdocs, 'blog', 'index.html.gz'))
+    assert set(manifest.entries) == {'index.html', 'small.css'}
+
+
+def test_update_missing_sibling(htdocs, calls):
+    manifest = caches.HtdocsManifest(os.path.dirname(htdocs))
+    manifest.update()
+    calls['compress'].clear()
+    os.remove(os.path.join(htdocs, 'index.html.gz'))
+    manifest.update()
+    assert calls['compress'] == [os.path.join(htdocs, 'index.html')]
+    assert os.path.isfile(os.path.join(htdocs, 'index.html.gz'))
@@ -0,0 +1,155 @@
+import os
+import threading
+
+import pytest
+
+from wmkadmin import deploy
+
+
+def write(path, text=''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+@pytest.fixture
+def site(tmp_path):
+    "A small wmk project with a base template, a derived one and three pages."
+    base = str(tmp_path)
+    write(os.path.join(base, 'templates', 'base.mhtml'), '<html>${ self.body() }</html>')
+    write(os.path.join(base, 'templates', 'md_base.mhtml'),
+          '<%inherit file="base.mhtml"/>\n${ CONTENT }')
+    write(os.path.join(base, 'templates', 'people.mhtml'),
+          '<%inherit file="base.mhtml"/>\n% for p in DATA["people.yaml"]:\n% endfor')
+    write(os.path.join(base, 'content', 'index.md'), '# Home\n')
+    write(os.path.join(base, 'content', 'blog', 'post.md'), '# Post\n')
+    write(os.path.join(base, 'content', 'team.md'),
+          '---\ntemplate: people.mhtml\n---\n# Team\n')
+    write(os.path.join(base, 'content', 'about.md'),
+          '---\ntemplate: md_base\n---\n# About\n')
+    write(os.path.join(base, 'data', 'people.yaml'), '- Ann\n')
+    return base
+
+
+def test_plan_content_page(site):
+    plan = deploy.DependencyIndex(site).plan(
+        [os.path.join(site, 'content', 'blog', 'post.md')])
+    htdocs = os.path.join(site, 'htdocs')
+    assert plan == {
+        os.path.join(htdocs, 'blog', 'post', 'index.html'): True,
+        os.path.join(htdocs, 'blog', 'index.html'): True,
+        os.path.join(htdocs, 'index.html'): True,
+    }
+
+
+def test_plan_removed_page(site):
+    page = os.path.join(site, 'content', 'blog', 'post.md')
+    os.remove(page)
+    plan = deploy.DependencyIndex(site).plan([page])
+    assert plan[os.path.join(site, 'htdocs', 'blog', 'post', 'index.html')] is False
+
+
+def test_plan_template(site):
+    index = deploy.DependencyIndex(site)
+    plan = index.plan([os.path.join(site, 'templates', 'people.mhtml')])
+    assert os.path.join(site, 'htdocs', 'team', 'index.html') in plan
+    assert os.path.join(site, 'htdocs', 'about', 'index.html') not in plan
+
+
+def test_plan_data_file(site):
+    plan = deploy.DependencyIndex(site).plan([os.path.join(site, 'data', 'people.yaml')])
+    assert os.path.join(site, 'htdocs', 'team', 'index.html') in plan
+    assert os.path.join(site, 'htdocs', 'blog', 'post', 'index.html') not in plan
+
+
+def test_plan_template_used_by_most_pages(site):
+    # Every page inherits from base.mhtml
+    assert deploy.DependencyIndex(site).plan(
+        [os.path.join(site, 'templates', 'base.mhtml')]) is None
+
+
+@pytest.mark.parametrize('rel', [
+    'wmk_config.yaml', 'content/blog/index.yaml', 'content/old_directory'])
+def test_plan_full_build(site, rel):
+    assert deploy.DependencyIndex(site).plan([os.path.join(site, rel)]) is None
+
+
+def test_plan_static(site):
+    assert deploy.DependencyIndex(site).plan(
+        [os.path.join(site, 'static', 'css', 'site.css')]) == {}
+
+
+def test_plan_follows_changes(site):
+    index = deploy.DependencyIndex(site)
+    data = os.path.join(site, 'data', 'people.yaml')
+    assert os.path.join(site, 'htdocs', 'blog', 'post', 'index.html') not in index.plan([data])
+    post = os.path.join(site, 'content', 'blog', 'post.md')
+    write(post, '# Post\n\nSee data/people.yaml\n')
+    os.utime(post, ns=(0, 1))
+    assert os.path.join(site, 'htdocs', 'blog', 'post', 'index.html') in index.plan([data])
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    "The arguments of the (fake) builds run by the build queue."
+    calls = []
+
+    def fake_build(msg=None, hard=False, quick=False, paths=None, report=None):
+        calls.append({'msg': msg, 'hard': hard, 'quick': quick,
+                      'paths': None if paths is None else set(paths)})
+        if msg == 'fail':
+            raise Exception('wmk failed')
+        return 'targeted'
+    monkeypatch.setattr(deploy, 'wmk_build', fake_build)
+    return calls
+
+
+def test_submit_coalesces_requests(builds):
+    queue = deploy.BuildQueue()
+    queue.submit('a', paths=['x'])
+    queue.submit('b', paths=['y'], quick=True)
+    queue.submit('c', paths=[])
+    job = queue.submit('d', paths=['z'], wait=True)
+    assert job['done'] and job['error'] is None and job['count'] == 4
+    assert job['kind'] == 'targeted'
+    assert builds == [{'msg': '[4 merged requests] a; b; c; d', 'hard': False,
+                       'quick': False, 'paths': {'x', 'y', 'z'}}]
+
+
+def test_submit_without_paths_is_a_full_build(builds):
+    queue = deploy.BuildQueue()
+    queue.submit('a', paths=['x'])
+    queue.submit('b')
+    queue.submit('c', paths=['y'], wait=True)
+    assert builds[0]['paths'] is None
+
+
+def test_submit_hard_and_quick(builds):
+    queue = deploy.BuildQueue()
+    queue.submit(quick=True)
+    queue.submit(quick=True, wait=True)
+    queue.submit(quick=True)
+    queue.submit(hard=True, quick=True, wait=True)
+    assert [(_['hard'], _['quick']) for _ in builds] == [(False, True), (True, False)]
+    # A quick build without paths does not make the merged build a full one
+    assert builds[0]['paths'] == set()
+
+
+def test_submit_waits_for_running_build(builds):
+    queue = deploy.BuildQueue()
+    jobs = []
+    threads = [threading.Thread(target=lambda: jobs.append(queue.submit(paths=['x'])))
+               for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    job = queue.submit(paths=['y'], wait=True)
+    assert len(builds) == 1
+    assert all(_ is job for _ in jobs)
+
+
+def test_submit_reports_error(builds):
+    job = deploy.BuildQueue().submit('fail', paths=['x'], wait=True)
+    assert job['done'] and job['error'] == 'wmk failed'
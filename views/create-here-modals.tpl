@@ -91,7 +91,7 @@
       <h4>Upload file</h4>
     </header>
     <p>The file will be placed inside the currently active folder, <code>{{section}}/{{dirname}}</code>.</p>
-    <form action="/_/admin/upload/" enctype="multipart/form-data" method="POST">
+    <form onsubmit="return ChunkedUpload.submit_form(event)">
       <input type="hidden" name="dest_dir" value="{{ section }}{{ '/' if dirname else '' }}{{ dirname }}">
       <label for="dest-name" class="ta-l">Destination filename (optional):</label>
       <input type="text" name="dest_name" id="dest-name">
@@ -99,6 +99,8 @@
       <label class="ta-l">Upload file:</label>
       <input type="file" name="upload">
       <input type="submit" value="Start upload">
+      <progress max="100" value="0" hidden></progress>
     </form>
   </article>
 </div>
+<script src="/_/js/chunked-upload.js"></script>
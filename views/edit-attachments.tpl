@@ -10,6 +10,9 @@
   % if msg:
   <div class="admonition success bg-contrast">{{ msg }}</div>
   % end
+  % if get('warning'):
+  <div class="admonition warning bg-contrast">{{ warning }}</div>
+  % end
   % if files:
   <div class="x-scroll">
   <table>
@@ -24,7 +27,7 @@
     <tr>
       <td>
         % if is_image(file.name):
-        <img src="{{ htdir }}/{{ file.name }}" loading="lazy" width="80" alt="preview">
+        <img src="/_/admin/thumb/160/{{ attachment_dir }}/{{ file.name }}?v={{ stat.st_mtime_ns }}" loading="lazy" width="80" alt="preview">
         % end
         <a href="{{ htdir }}/{{ file.name }}" target="_blank" class="plain">{{ file.name }}</a>
       </td>
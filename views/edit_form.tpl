@@ -45,9 +45,12 @@
 </hgroup>
 
 % if flash_message:
-  <div class="admonition success">
-    <p class="admonition-title">Success</p>
+  <div class="admonition {{ msg_status }}">
+    <p class="admonition-title">{{ msg_status.title() }}</p>
     <p>{{ flash_message }}</p>
+    % if diff:
+    <pre class="smaller">{{ diff }}</pre>
+    % end
   </div>
 % end
 
@@ -56,6 +59,7 @@
 <form action="/_/admin/{{ form_action }}" method="POST">
   <div id="ace-editor" class="mb-1 ba-1" style="height:596px;max-height:80vh">{{ contents }}</div>
   <div><textarea rows="20" cols="80" id="file-contents" name="contents" style="display:none">{{ contents }}</textarea></div>
+  <input type="hidden" name="version" value="{{ version }}">
   % if filename.endswith(content_exts):
   <div class="grid-sm">
     <a href="#" onclick="return show_preview()">Quick preview</a>
@@ -101,6 +105,7 @@
 % end
 
 <script src="/_/js/ace/ace.js"></script>
+<script src="/_/js/chunked-upload.js"></script>
 <script src="/_/js/ace/theme-textmate.js"></script>
 <script src="/_/js/ace/theme-github_dark.js"></script>
 <script src="/_/js/ace/mode-markdown.js"></script>
@@ -111,9 +116,10 @@
 var editor = ace.edit('ace-editor');
 var textarea = document.getElementById('file-contents');
 var need_preview = true;
+var preview_seq = 0;
 editor.getSession().on("change", function () {
   textarea.value = editor.getSession().getValue();
-  have_preview = false;
+  need_preview = true;
 });
 if (window.matchMedia && window.matchMedia('(prefers-color-scheme: dark)').matches) {
   // dark mode
@@ -130,15 +136,19 @@ editor.session.setMode("ace/mode/{{ ace_modes[ext] }}");
 % end
 
 async function get_preview(source) {
+  // Numbered, so that the server can skip requests superseded by newer ones
+  const seq = ++preview_seq;
   const form_data = new FormData();
   form_data.append("source", source);
   form_data.append("filename", "{{ filename }}");
+  form_data.append("seq", Date.now() * 1000 + seq);
   const response = await fetch('/_/admin/preview/', {
     method: "POST",
     mode: "same-origin",
     cache: "no-cache",
     body: form_data,
   });
+  if (response.status == 204 || seq != preview_seq) return null;
   const ret = await response.blob();
   return ret.text();
 }
@@ -150,7 +160,7 @@ function show_preview() {
   }
   source = textarea.value;
   get_preview(source).then((data) => {
-    // console.log(data);
+    if (data === null) return;  // superseded by a newer preview
     document.getElementById('preview').innerHTML = data;
     document.getElementById('preview-modal').checked = true;
     need_preview = false;
@@ -183,22 +193,11 @@ function img_to_editor(src) {
 
 % if potential_attachments:
 async function upload_attachment() {
-  const form_data = new FormData();
   const filefield = document.getElementById('upload');
-  form_data.append("attachment_dir", "{{ attachment_dir }}");
-  let maxi = -1;
-  for (const [i, file] of Array.from(filefield.files).entries()) {
-     form_data.append(`upload_${i}`, file);
-     maxi = i;
-  }
-  form_data.append('upload_count', maxi+1);
+  const fields = {kind: 'attachment', dest_dir: "{{ attachment_dir }}"};
   try {
-    const response = await fetch("/_/admin/edit-upload/", {
-      method: "POST",
-      body: form_data
-    });
-    const ret = await response.blob();
-    return ret.text();
+    const ret = await ChunkedUpload.upload(Array.from(filefield.files), fields);
+    return ret.html;
   } catch (error) {
     console.error("Upload Error:", error);
   }
@@ -43,10 +43,10 @@
 
       <p class="ta-c">
         <a href="/_/admin/build/" role="button" class="larger">
-          % include('svg/command.svg')
+          {{! svg['command'] }}
           Normal build</a>
         <a href="/_/admin/build/?hard=1" role="button" class="larger bg-error">
-          % include('svg/coffee.svg')
+          {{! svg['coffee'] }}
           Hard rebuild</a>
       </p>
 
@@ -58,7 +58,7 @@
       % if deploy:
         <p class="ta-c">
           <a href="/_/admin/deploy/" role="button" class="larger bg-success">
-          % include('svg/upload-cloud.svg')
+          {{! svg['upload-cloud'] }}
           Publish site</a>
         </p>
       % end
@@ -70,7 +70,7 @@
       </header>
       <p class="ta-c">
         <a href="/_/admin/edit-config/" role="button" class="larger">
-          % include('svg/edit.svg')
+          {{! svg['edit'] }}
           Edit wmk_config.yaml</a>
       </p>
       <p><code>wmk_config.yaml</code> is the main configuration file for each site built with wmk. Take care when you edit it, since an invalid file will prevent your site from being built and thus updated.</p>
@@ -82,13 +82,51 @@
       </header>
       <p class="ta-c">
         <a href="/" role="button" class="larger">
-          % include('svg/eye.svg')
+          {{! svg['eye'] }}
           View the site</a>
       </p>
       <p>In addition to the admin pages, wmkAdmin runs a webserver for previewing the <strong>development version</strong> of the website. (You can see that it is the development version from the prominent link to Admin in the lower right corner of each page.)</p>
     </article>
   </section>
 
+% if deploy_job:
+  <div class="mt-3" id="deploy-panel">
+    <div class="admonition {{ 'info' if not deploy_job['done'] else ('success' if deploy_job['status'] == 'succeeded' else 'warning') }}">
+      <p class="admonition-title">Deployment started {{ deploy_job['started_at'] }}:
+        <span id="deploy-status">{{ deploy_job['status'] }}</span></p>
+      <pre class="smaller"><code id="deploy-log"></code></pre>
+      % if not deploy_job['done']:
+        <p class="ta-c" id="deploy-cancel"><button class="bg-error" onclick="cancel_deploy()">Cancel deployment</button></p>
+      % end
+    </div>
+  </div>
+  <script>
+  const deploy_id = "{{ deploy_job['id'] }}";
+  let deploy_next = 0;
+  async function poll_deploy() {
+    const response = await fetch(`/_/admin/deploy/${deploy_id}/log/?after=${deploy_next}`);
+    if (!response.ok) return;
+    const ret = await response.json();
+    const log = document.getElementById('deploy-log');
+    for (const [n, line] of ret.lines) {
+      log.append(line + "\n");
+    }
+    deploy_next = ret.next;
+    document.getElementById('deploy-status').textContent = ret.status;
+    if (ret.done) {
+      const btn = document.getElementById('deploy-cancel');
+      if (btn) btn.remove();
+    } else {
+      setTimeout(poll_deploy, 1000);
+    }
+  }
+  async function cancel_deploy() {
+    await fetch(`/_/admin/deploy/${deploy_id}/cancel/`, {method: 'POST'});
+  }
+  poll_deploy();
+  </script>
+% end
+
 % show_recent = adm_conf.get('recently_changed')
 % show_status = status_info and (status_info['deployed_date'] or status_info['git_status'])
 
@@ -127,6 +165,9 @@
       % elif status_info['git_last_commit']:
         <p><strong>Up to date:</strong> No pending changes waiting to be published.</p>
       % end
+      % if status_info['git_checked_at']:
+        <p class="smaller text-muted">Git information as of {{ str(status_info['git_checked_at'])[:19] }}{{ ' (being updated)' if status_info['git_refreshing'] else '' }}.</p>
+      % end
     </div>
   </div>
 % end
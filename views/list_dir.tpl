@@ -1,19 +1,12 @@
 % rebase('base.tpl', title='List directory: %s/%s' % (section, dirname))
 
 <%
-import os, datetime, hashlib, re
+import os
 
-fileid = lambda s: hashlib.sha1(s.encode('utf-8')).hexdigest()[:7]
 prefix = '/_/admin/list'
 paths = dirname.strip('/').split('/') if dirname else []
 edit_ok = tuple(['.'+_ for _ in editable_exts])
-view_ok = tuple(['.'+_ for _ in editable_exts[:18]])
 current_path = "%s%s%s" % (section, '/' if dirname else '', dirname)
-
-svg_files = [_ for _ in os.listdir(svg_dir) if _.endswith('.svg')]
-slurp = lambda nam: (f:=open(nam),f.read(),f.close())[1]
-svg = dict([ (os.path.splitext(it)[0], slurp(os.path.join(svg_dir, it))) for it in svg_files ])
-maybe_page = f'?p={page}' if page and page > 1 else ''
 %>
 
 <hgroup>
@@ -30,85 +23,75 @@ maybe_page = f'?p={page}' if page and page > 1 else ''
 </div>
 
 % if flash_message:
-  <div class="admonition success">
-    <p class="admonition-title">Success</p>
+  <div class="admonition {{ msg_status }}">
+    <p class="admonition-title">{{ msg_status.title() }}</p>
     <p>{{ flash_message }}</p>
   </div>
 % end
 
 % include('create-here-modals.tpl', section=section, dirname=dirname, svg=svg, sort_by_date=sort_by_date, search=search)
 
-% if dir_entries:
+% if search_indexing:
+<div class="admonition warning">
+  <p>The search index is still being built. Please try again in a moment.
+    <a href="{{ prefix }}/{{ current_path }}">Show all files</a></p>
+</div>
+% elif search_results is not None:
+<div class="admonition info">
+  <p>{{ entry_count }} match{{ '' if entry_count == 1 else 'es' }} for <strong>{{ search }}</strong> in <code>{{ current_path }}</code> and its subfolders.
+    <a href="{{ prefix }}/{{ current_path }}">Show all files</a></p>
+</div>
+  % if search_results:
 <div class="x-scroll">
 <table class="dir-entries mt-0">
   <tr>
-    <th style="width:36px" class="icn"></th>
-    <th class="nam"><a href="?sort=name">Name</a></th>
-    <th class="ta-r size">Size</th>
-    <th class="mtime"><a href="?sort=date">Modified</a></th>
+    <th class="nam">Name</th>
+    <th>Title and matching text</th>
     <th class="ta-r">Actions</th>
-   </tr>
   </tr>
-  % for it in dir_entries:
-    % stat = it.stat()
-    % typ = 'dir' if it.is_dir() else 'file' if it.is_file() else 'link' if it.is_symlink() else '?'
-    % mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
+  % for res in search_results:
+    % res_dir = os.path.dirname(res['path'])
   <tr>
-    <td class="icn">
-      % svgkey = 'file-text' if it.name.endswith(edit_ok) else 'file' if typ == 'file' else 'folder' if typ == 'dir' else 'minus'
-      {{! svg[svgkey] }}
-    </td>
     <td class="nam">
-      % if typ == 'file' and it.name.endswith(edit_ok):
-        <a href="/_/admin/edit/{{ current_path }}/{{ it.name }}">{{ it.name }}</a>
-      % elif typ == 'dir':
-        <a href="{{ prefix }}/{{ current_path }}/{{ it.name }}">{{ it.name }}</a>
+      % if res['name'].endswith(edit_ok):
+        <a href="/_/admin/edit/{{ res['path'] }}">{{ res['path'][len(current_path)+1:] }}</a>
       % else:
-        {{ it.name }}
+        {{ res['path'][len(current_path)+1:] }}
       % end
     </td>
-    <td class="ta-r size">
-      {{ stat.st_size }}
-      % if it.name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-      <br><small>({{ '%dx%d' % imsiz(it) }})</small>
+    <td>
+      % if res['title']:
+        <strong>{{ res['title'] }}</strong><br>
       % end
+      <small>{{! res['snippet'] }}</small>
     </td>
-    <td class="mtime">{{ str(mtime)[:16] }}</td>
     <td class="actions ta-r">
-    % if typ == 'file':
-      % if it.name.endswith(edit_ok):
-        <a href="/_/admin/edit/{{ current_path }}/{{ it.name }}" title="Edit">{{! svg['edit'] }}</a>
-      % end
-      <a href="/_/admin/delete/{{ current_path }}/{{ it.name }}{{ maybe_page }}" onclick="return confirm('Are you sure you want to delete this?')" title="Delete">{{! svg['trash']}}</a>
-      <label role="link" class="d-inl" for="move-{{ fileid(it.name) }}-modal" title="Move/Rename">{{! svg['copy'] }}</label>
-      % if section == 'content' and it.name.endswith(view_ok):
-        % if it.name.startswith('index.'):
-          <a href="/{{ dirname }}{{ '/' if dirname else ''}}" target="_blank" title="View">{{! svg['eye'] }}</a>
-        % else:
-          <a href="/{{ dirname }}{{ '/' if dirname else ''}}{{ os.path.splitext(it.name)[0] }}/" target="_blank" title="View">{{! svg['eye'] }}</a>
-        % end
-      % elif section in ('content', 'static'):
-        <a href="/{{ dirname }}{{ '/' if dirname else ''}}{{ it.name }}" target="_blank" title="View">{{! svg['eye'] }}</a>
-      % end
-    % elif typ == 'dir':
-      <a href="{{ prefix }}/{{ current_path }}/{{ it.name }}" title="Open">{{! svg['arrow-right'] }}</a>
-      % if not os.listdir(os.path.join(full_dirname, it.name)):
-        <a href="/_/admin/rmdir/{{ current_path }}/{{ it.name }}" title="Remove folder">{{! svg['trash'] }}</a>
-      % end
-      <label role="link" class="d-inl" for="move-{{ fileid(it.name) }}-modal" title="Move/Rename">{{! svg['copy'] }}</label>
-    % end
+      <a href="{{ prefix }}/{{ res_dir }}" title="Open folder">{{! svg['folder'] }}</a>
     </td>
   </tr>
   % end
 </table>
 </div>
+  % end
+% elif dir_entries:
+<div id="batch-bar" class="p-half pl-1 bg-contrast mb-1" hidden>
+  <strong><span id="batch-count">0</span> selected:</strong>
+  <button class="bg-error" onclick="batch_delete()">{{! svg['trash'] }} Delete</button>
+  <input type="text" id="batch-dest" value="{{ current_path }}" size="30" aria-label="Destination folder">
+  <button onclick="batch_move()" title="Use Rename/Move on a single page to have the references to it updated">{{! svg['copy'] }} Move to folder (links not updated)</button>
+</div>
+{{! rows_html }}
 % else:
 <div class="admonition"><p>No files or subdirectories in this directory</p></div>
 % end
 
 % if paginated:
 <div class="prevnext mt-2 mb-4 bg-contrast ta-c p-1">
+  % if search_results is not None:
+  <div class="smaller">Page {{page}} of {{pagecount}} ({{entry_count}} matches)</div>
+  % else:
   <div class="smaller">Page {{page}} of {{pagecount}} ({{entry_count}} files/directories{{ f' (out of a total of {total_entries})' if total_entries != entry_count else ''}})</div>
+  % end
   <div>[<strong>
     % if page == 1:
     <span class="text-muted">« Previous</span>
@@ -123,14 +106,120 @@ maybe_page = f'?p={page}' if page and page > 1 else ''
     % end
     </strong>]</div>
 </div>
-% elif total_entries != entry_count:
+% elif search_results is None and total_entries != entry_count:
 <div class="prevnext mt-2 mb-4 bg-contrast ta-c p-1">
   <div class="smaller">Showing {{ entry_count }} entries (out of a total of {{ total_entries }} in this folder)</div>
 </div>
 % end
 
-% for it in dir_entries:
-  % if it.is_dir() or it.is_file():
-    % include("rename-move-modal.tpl", section=section, dirname=dirname, is_dir=it.is_dir(), orig_name=it.name, directories=directories, fileid=fileid(it.name))
-  % end
-% end
+<script>
+// Selecting several files/folders and deleting or moving them in one request.
+function batch_selected() {
+  return Array.from(document.querySelectorAll('input.batch-sel:checked'));
+}
+function batch_select_all(checked) {
+  for (const box of document.querySelectorAll('input.batch-sel')) box.checked = checked;
+  batch_update();
+}
+function batch_update() {
+  const count = batch_selected().length;
+  document.getElementById('batch-count').textContent = count;
+  document.getElementById('batch-bar').hidden = count == 0;
+}
+async function batch_apply(ops) {
+  const response = await fetch('/_/admin/batch/', {
+    method: 'POST', headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({ops: ops})});
+  let ret = {};
+  try {
+    ret = await response.json();
+  } catch (e) {}
+  if (!response.ok) {
+    alert('Nothing was changed. ' + (ret.error || `${response.status} ${response.statusText}`));
+    return;
+  }
+  location.reload();
+}
+function batch_delete() {
+  const selected = batch_selected();
+  if (!confirm(`Are you sure you want to delete ${selected.length} files/folders? Folders must be empty.`)) return;
+  batch_apply(selected.map((box) => ({op: box.dataset.dir == '1' ? 'rmdir' : 'delete', path: box.value})));
+}
+function batch_move() {
+  const dest_dir = document.getElementById('batch-dest').value.trim();
+  batch_apply(batch_selected().map((box) => ({op: 'move', path: box.value, dest_dir: dest_dir})));
+}
+
+// What a rename/move would change: files moved and references rewritten.
+async function preview_move(form) {
+  const out = form.querySelector('.move-preview');
+  const response = await fetch('/_/admin/move/preview/', {method: 'POST', body: new FormData(form)});
+  out.hidden = false;
+  out.replaceChildren();
+  if (!response.ok) {
+    out.textContent = `Cannot move: ${response.status} ${response.statusText}`;
+    return;
+  }
+  const plan = await response.json();
+  const add = (parent, tag, text) => {
+    const el = document.createElement(tag);
+    if (text) el.textContent = text;
+    parent.appendChild(el);
+    return el;
+  };
+  if (!plan.moves.length) {
+    out.textContent = 'Nothing to do.';
+    return;
+  }
+  const moves = add(out, 'ul');
+  for (const [from, to] of plan.moves) add(moves, 'li', `${from} → ${to}`);
+  if (!form.update_links.checked || !plan.rewrites.length) {
+    add(out, 'p', 'No references will be changed.');
+    return;
+  }
+  add(out, 'p', `References to update in ${plan.rewrites.length} page(s):`);
+  const pages = add(out, 'ul');
+  for (const page of plan.rewrites) {
+    const li = add(pages, 'li', page.path);
+    const changes = add(li, 'ul');
+    for (const [from, to] of page.changes) add(changes, 'li', `${from} → ${to}`);
+  }
+}
+
+// Folder tree for the Rename/Move dialogs, fetched one level at a time.
+async function get_subdirs(parent) {
+  const url = '/_/admin/dirs/' + (parent ? '?parent=' + encodeURIComponent(parent) : '');
+  const response = await fetch(url, {mode: "same-origin"});
+  const ret = await response.json();
+  return ret.dirs;
+}
+function add_dir_level(container, input, parent) {
+  get_subdirs(parent).then((dirs) => {
+    const ul = document.createElement('ul');
+    for (const d of dirs) {
+      const li = document.createElement('li');
+      const pick = document.createElement('a');
+      pick.href = '#';
+      pick.textContent = d.name;
+      pick.onclick = () => { input.value = d.path; return false; };
+      li.appendChild(pick);
+      if (d.has_children) {
+        const expand = document.createElement('a');
+        expand.href = '#';
+        expand.className = 'plain';
+        expand.textContent = ' [+]';
+        expand.onclick = () => { expand.remove(); add_dir_level(li, input, d.path); return false; };
+        li.appendChild(expand);
+      }
+      ul.appendChild(li);
+    }
+    container.appendChild(ul);
+  });
+}
+function open_dir_picker(link) {
+  const picker = link.closest('.dir-picker');
+  link.remove();
+  add_dir_level(picker, document.getElementById(picker.dataset.target), null);
+  return false;
+}
+</script>
@@ -0,0 +1,90 @@
+<%
+# The table of directory entries and their Rename/Move dialogs. Rendered
+# separately from list_dir.tpl so that it can be kept in the fragment cache.
+import os, datetime
+
+prefix = '/_/admin/list'
+current_path = "%s%s%s" % (section, '/' if dirname else '', dirname)
+edit_ok = tuple(['.'+_ for _ in editable_exts])
+view_ok = tuple(['.'+_ for _ in editable_exts[:18]])
+maybe_page = f'?p={page}' if page and page > 1 else ''
+%>
+<div class="x-scroll">
+<table class="dir-entries mt-0">
+  <tr>
+    <th class="sel"><input type="checkbox" title="Select all" onclick="batch_select_all(this.checked)"></th>
+    <th style="width:36px" class="icn"></th>
+    <th class="nam"><a href="?sort=name">Name</a></th>
+    <th class="ta-r size">Size</th>
+    <th class="mtime"><a href="?sort=date">Modified</a></th>
+    <th class="ta-r">Actions</th>
+   </tr>
+  </tr>
+  % for i, it in enumerate(dir_entries):
+    % stat = it.stat()
+    % typ = 'dir' if it.is_dir() else 'file' if it.is_file() else 'link' if it.is_symlink() else '?'
+    % mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
+  <tr>
+    <td class="sel">
+      % if typ in ('file', 'dir'):
+      <input type="checkbox" class="batch-sel" value="{{ current_path }}/{{ it.name }}" data-dir="{{ 1 if typ == 'dir' else 0 }}" onchange="batch_update()">
+      % end
+    </td>
+    <td class="icn">
+      % if typ == 'file' and section != 'templates' and it.name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
+      <img src="/_/admin/thumb/80/{{ current_path }}/{{ it.name }}?v={{ stat.st_mtime_ns }}" loading="lazy" width="36" alt="">
+      % else:
+      % svgkey = 'file-text' if it.name.endswith(edit_ok) else 'file' if typ == 'file' else 'folder' if typ == 'dir' else 'minus'
+      {{! svg[svgkey] }}
+      % end
+    </td>
+    <td class="nam">
+      % if typ == 'file' and it.name.endswith(edit_ok):
+        <a href="/_/admin/edit/{{ current_path }}/{{ it.name }}">{{ it.name }}</a>
+      % elif typ == 'dir':
+        <a href="{{ prefix }}/{{ current_path }}/{{ it.name }}">{{ it.name }}</a>
+      % else:
+        {{ it.name }}
+      % end
+    </td>
+    <td class="ta-r size">
+      {{ stat.st_size }}
+      % if it.name.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
+      <br><small>({{ '%dx%d' % imsiz(it) }})</small>
+      % end
+    </td>
+    <td class="mtime">{{ str(mtime)[:16] }}</td>
+    <td class="actions ta-r">
+    % if typ == 'file':
+      % if it.name.endswith(edit_ok):
+        <a href="/_/admin/edit/{{ current_path }}/{{ it.name }}" title="Edit">{{! svg['edit'] }}</a>
+      % end
+      <a href="/_/admin/delete/{{ current_path }}/{{ it.name }}{{ maybe_page }}" onclick="return confirm('Are you sure you want to delete this?')" title="Delete">{{! svg['trash']}}</a>
+      <label role="link" class="d-inl" for="move-{{ i }}-modal" title="Move/Rename">{{! svg['copy'] }}</label>
+      % if section == 'content' and it.name.endswith(view_ok):
+        % if it.name.startswith('index.'):
+          <a href="/{{ dirname }}{{ '/' if dirname else ''}}" target="_blank" title="View">{{! svg['eye'] }}</a>
+        % else:
+          <a href="/{{ dirname }}{{ '/' if dirname else ''}}{{ os.path.splitext(it.name)[0] }}/" target="_blank" title="View">{{! svg['eye'] }}</a>
+        % end
+      % elif section in ('content', 'static'):
+        <a href="/{{ dirname }}{{ '/' if dirname else ''}}{{ it.name }}" target="_blank" title="View">{{! svg['eye'] }}</a>
+      % end
+    % elif typ == 'dir':
+      <a href="{{ prefix }}/{{ current_path }}/{{ it.name }}" title="Open">{{! svg['arrow-right'] }}</a>
+      % if it.name in empty_dirs:
+        <a href="/_/admin/rmdir/{{ current_path }}/{{ it.name }}" title="Remove folder">{{! svg['trash'] }}</a>
+      % end
+      <label role="link" class="d-inl" for="move-{{ i }}-modal" title="Move/Rename">{{! svg['copy'] }}</label>
+    % end
+    </td>
+  </tr>
+  % end
+</table>
+</div>
+
+% for i, it in enumerate(dir_entries):
+  % if it.is_dir() or it.is_file():
+    % include("rename-move-modal.tpl", section=section, dirname=dirname, is_dir=it.is_dir(), orig_name=it.name, fileid=str(i))
+  % end
+% end
@@ -13,7 +13,7 @@
       <h4>Rename or move {{ typ_name }}</h4>
     </header>
     <div class="ta-l">
-      <p class="smaller">If you want to rename the {{ typ_name }} but keep it in the same place, just edit the name. Conversely, if you want to move it to a new location but not change the name, just pick the destination folder before pressing the Rename/Move button.</p>
+      <p class="smaller">If you want to rename the {{ typ_name }} but keep it in the same place, just edit the name. Conversely, if you want to move it to a new location but not change the name, just choose the destination folder before pressing the Rename/Move button.</p>
       <p><strong>Original name:</strong> {{ orig_name }}</p>
       <form action="/_/admin/move/" method="POST">
         <input type="hidden" name="from_dir" value="{{ from_dir }}">
@@ -21,12 +21,17 @@
         <input type="hidden" name="is_dir" value="{{ '1' if is_dir else '0' }}">
         <label>New name</label>
         <input type="text" name="new_name" value="{{ orig_name }}">
-        <label>Destination folder</label>
-        <select name="dest_dir">
-          % for d in directories:
-            <option value="{{ d }}"{{ ' selected' if d == from_dir else '' }}>{{ d }}</option>
-          % end
-        </select>
+        <label for="{{ modal_id }}-dest">Destination folder</label>
+        <input type="text" name="dest_dir" id="{{ modal_id }}-dest" value="{{ from_dir }}" required>
+        <div class="dir-picker smaller mb-1" data-target="{{ modal_id }}-dest">
+          <a href="#" onclick="return open_dir_picker(this)">Choose folder...</a>
+        </div>
+        <label><input type="checkbox" name="update_links" value="1" checked> Update links and image references in other pages</label>
+        % if not is_dir:
+        <p class="smaller">A page's attachment folder (with the same name, minus the extension) is moved along with it.</p>
+        % end
+        <div class="move-preview smaller mb-1" hidden></div>
+        <button type="button" onclick="preview_move(this.form)">Preview changes</button>
         <input type="submit" value="Rename/Move">
       </form>
     </div>
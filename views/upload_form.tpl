@@ -1,6 +1,6 @@
 % rebase('base.tpl', title='Upload file')
 
-<form action="/_/admin/upload/" enctype="multipart/form-data" method="POST">
+<form id="upload-form" onsubmit="return ChunkedUpload.submit_form(event)">
   <div>Root folder:
     <select name="dest_dir">
     % for dir in dest_dirs:
@@ -12,6 +12,9 @@
     <label for="dest-name">Destination filename (leave blank to keep same name):</label>
     <input type="text" name="dest_name" id="dest-name">
   </div>
-  <div>Upload file: <input type="file" name="upload"></div>
-  <div><input type="submit" value="Start upload"></div>
+  <div>Upload file: <input type="file" name="upload" id="upload"></div>
+  <div><input type="submit" value="Start upload" id="start-upload"></div>
+  <progress id="upload-progress" max="100" value="0" hidden></progress>
 </form>
+
+<script src="/_/js/chunked-upload.js"></script>
@@ -0,0 +1,4 @@
+"""
+The machinery behind the admin app (admin.py): caches and indexes, the
+file watcher, building and deploying, and uploads.
+"""
@@ -0,0 +1,1641 @@
+"""
+The caches and indexes which keep the admin fast: git status, image sizes
+and thumbnails, recently changed files, full-text search, the folder tree,
+previews, references between pages, rendered fragments and the manifest of
+htdocs.  Each registers itself in CACHES (for the metrics) and, if it
+depends on files, in CHANGE_LISTENERS.
+"""
+
+import os
+import re
+import time
+import datetime
+import functools
+import hashlib
+import collections
+import json
+import posixpath
+import threading
+import urllib.parse
+
+from .common import (
+    BASEDIR, CACHES, EDITABLE_EXTENSIONS, Image, atomic_write, bisect, get_config,
+    gzip, heapq, html, mimetypes, sqlite3, subprocess, wmk)
+from .watcher import CHANGE_LISTENERS, WATCHER
+
+
+class GitStatus:
+    """
+    Output of `git status` and `git log` for the front page, produced by a
+    background thread so that rendering the page never waits for git.  The
+    values are recomputed when `.git/index`, `.git/HEAD` or `.git/logs/HEAD`
+    change, when files are changed through the admin, after each build and
+    in any case when they are more than `MAX_AGE` seconds old.
+    """
+    MAX_AGE = 300
+    FIRST_WAIT = 2
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.gitdir = os.path.join(basedir, '.git')
+        self.cond = threading.Condition()
+        self.data = None
+        self.signature = None
+        self.checked_at = None
+        self.checked_mono = 0
+        self.stale = True
+        self.log_days = None
+        self.thread = None
+        self.hits = 0
+        self.refreshes = 0
+
+    def get(self, log_days=None):
+        """
+        Returns a dict with the keys `status` (from `git status -s`),
+        `last_commit`, `log` (from `git log --name-only` for the last
+        `log_days` days; only if requested), `checked_at` and `refreshing`,
+        or None if the project is not a git repository.  A refresh is
+        started in the background if the values are out of date; only the
+        first call (or the first asking for `log_days`) waits briefly for it.
+        """
+        if not os.path.isdir(self.gitdir):
+            return None
+        with self.cond:
+            if log_days is not None and log_days != self.log_days:
+                self.log_days = log_days
+                self.stale = True
+            if (self.stale or self.signature != self._signature()
+                    or time.monotonic() - self.checked_mono > self.MAX_AGE):
+                self._start_refresh()
+                self.cond.wait_for(lambda: self._has_data(log_days), self.FIRST_WAIT)
+            else:
+                self.hits += 1
+            ret = dict(self.data or {'status': '', 'last_commit': '', 'log': ''})
+            ret['checked_at'] = self.checked_at
+            ret['refreshing'] = self.thread is not None
+            return ret
+
+    def invalidate(self, paths=None):
+        "Recompute in the background (e.g. after `paths` have changed)."
+        if os.path.isdir(self.gitdir):
+            with self.cond:
+                self._start_refresh()
+
+    def stats(self):
+        return {'hits': self.hits, 'refreshes': self.refreshes,
+                'checked_at': str(self.checked_at) if self.checked_at else None}
+
+    def _has_data(self, log_days):
+        if self.data is None:
+            return False
+        return log_days is None or self.data['log_days'] == log_days
+
+    def _signature(self):
+        ret = []
+        for fn in ('index', 'HEAD', os.path.join('logs', 'HEAD')):
+            try:
+                ret.append(os.stat(os.path.join(self.gitdir, fn)).st_mtime_ns)
+            except OSError:
+                ret.append(None)
+        return tuple(ret)
+
+    def _start_refresh(self):
+        self.stale = True
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._refresh, name='git-status', daemon=True)
+            self.thread.start()
+
+    def _refresh(self):
+        try:
+            while True:
+                with self.cond:
+                    self.stale = False
+                    log_days = self.log_days
+                signature = self._signature()
+                try:
+                    data = self._run_git(log_days)
+                except Exception as e:
+                    print("WARNING: Could not get git status: %s" % e)
+                    data = {'status': '', 'last_commit': '', 'log': '',
+                            'log_days': log_days, 'error': str(e)}
+                with self.cond:
+                    self.data = data
+                    self.signature = signature
+                    self.checked_at = datetime.datetime.now()
+                    self.checked_mono = time.monotonic()
+                    self.refreshes += 1
+                    if not self.stale:
+                        return
+                    self.cond.notify_all()
+        finally:
+            # Also on errors, so that the next call can start a new thread
+            with self.cond:
+                self.thread = None
+                self.cond.notify_all()
+
+    def _run_git(self, log_days):
+        def git(*args):
+            try:
+                return subprocess.run(
+                    ('git', ) + args, cwd=self.basedir, capture_output=True,
+                    text=True).stdout
+            except OSError as e:
+                print("WARNING: Could not run git: %s" % e)
+                return ''
+        ret = {
+            'status': git('status', '-s'),
+            'last_commit': re.sub(
+                r' [+\-]\d\d\d\d$', '',
+                git('log', '-1', '--date=iso', '--pretty=[%h] %ad')),
+            'log': '',
+            'log_days': log_days,
+        }
+        if log_days is not None:
+            ret['log'] = git('log', "--since='{} days ago'".format(log_days),
+                             '--name-only', '--date=iso', '--pretty=format:%ad')
+        return ret
+
+
+GIT_STATUS = GitStatus(BASEDIR)
+CACHES['git_status'] = GIT_STATUS
+
+
+class WorkerPool:
+    """
+    The process pool shared by thumbnailing, the post-processing of
+    uploaded images and the post-build pass over htdocs, created on first
+    use.  Its workers are started by a fork server (spawned where there is
+    none) instead of being forked from this multi-threaded process, so they
+    import this module afresh: the functions they run must be module-level
+    ones which do not depend on anything set up after import.
+    """
+    MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        return self._executor().submit(fn, *args)
+
+    def map(self, fn, args, chunksize=1):
+        return self._executor().map(fn, args, chunksize=chunksize)
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                import concurrent.futures
+                import multiprocessing
+                method = ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                          else 'spawn')
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.MAX_WORKERS,
+                    mp_context=multiprocessing.get_context(method))
+            return self.executor
+
+
+WORKER_POOL = WorkerPool()
+
+
+class ImageSizeCache:
+    """
+    Image dimensions, persisted in tmp/image_sizes.sqlite and keyed by path,
+    size and mtime, so that listing a folder of images does not require
+    opening each of them.  `bulk()` fetches the dimensions for all images
+    about to be shown on a page with a single query (beyond the stat calls,
+    which are shared with the template when given DirEntry objects);
+    `warm()` fills the cache for new files in a background thread.
+    """
+    IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, f, st=None):
+        path = f.path if hasattr(f, 'path') else f
+        if st is None:
+            st = f.stat() if hasattr(f, 'stat') else os.stat(path)
+        with self.lock:
+            row = self._db().execute(
+                'SELECT width, height FROM images WHERE path=? AND size=? AND mtime_ns=?',
+                (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row:
+            self.hits += 1
+            return tuple(row)
+        return self._probe([(path, st)])[path]
+
+    def bulk(self, entries):
+        """
+        Look up the dimensions of all images among `entries` at once and
+        return a function like imsiz() which answers from that result.
+        """
+        wanted = {}
+        for it in entries:
+            path = it.path if hasattr(it, 'path') else it
+            if path.lower().endswith(self.IMAGE_SUFFIXES):
+                try:
+                    wanted[path] = it.stat() if hasattr(it, 'stat') else os.stat(path)
+                except OSError:
+                    pass
+        found = {}
+        paths = list(wanted)
+        with self.lock:
+            db = self._db()
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i+500]
+                rows = db.execute(
+                    'SELECT path, size, mtime_ns, width, height FROM images WHERE path IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk)
+                for path, size, mtime_ns, width, height in rows:
+                    st = wanted[path]
+                    if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                        found[path] = (width, height)
+        self.hits += len(found)
+        missing = [(p, st) for p, st in wanted.items() if p not in found]
+        if missing:
+            found.update(self._probe(missing))
+
+        def lookup(f):
+            path = f.path if hasattr(f, 'path') else f
+            return found[path] if path in found else self.get(f)
+        return lookup
+
+    def warm(self, paths):
+        "Add new images to the cache in the background."
+        paths = [_ for _ in paths if _.lower().endswith(self.IMAGE_SUFFIXES)]
+        if paths:
+            threading.Thread(
+                target=self.bulk, args=(paths,), name='imsiz-warm', daemon=True).start()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def store(self, rows):
+        "Remember dimensions probed elsewhere: (path, size, mtime_ns, width, height) rows."
+        with self.lock:
+            db = self._db()
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO images (path, size, mtime_ns, width, height) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def _probe(self, items):
+        "Open the images in `items` (path, stat pairs) and store their sizes."
+        ret = {}
+        rows = []
+        for path, st in items:
+            try:
+                with Image.open(path) as im:
+                    ret[path] = im.size
+            except Exception:
+                ret[path] = (0, 0)
+            rows.append((path, st.st_size, st.st_mtime_ns) + tuple(ret[path]))
+        self.misses += len(items)
+        self.store(rows)
+        return ret
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, '
+                'size INTEGER, mtime_ns INTEGER, width INTEGER, height INTEGER)')
+        return self.conn
+
+
+IMAGE_SIZES = ImageSizeCache(os.path.join(BASEDIR, 'tmp', 'image_sizes.sqlite'))
+CACHES['image_sizes'] = IMAGE_SIZES
+
+
+class Thumbnailer:
+    """
+    Downscaled versions of images for the file manager and the attachment
+    pane, stored in tmp/thumbs/ under the SHA-1 of the source image and the
+    thumbnail size (so identical images share thumbnails and a changed image
+    gets new ones).  The hash of each source is remembered by path, size and
+    mtime in the image_sizes database.  Thumbnails are made in WORKER_POOL,
+    either on demand or (via `warm()`) right after upload.
+    """
+    SIZES = (80, 160)
+    IMAGE_SUFFIXES = ImageSizeCache.IMAGE_SUFFIXES
+
+    def __init__(self, basedir):
+        self.dirname = os.path.join(basedir, 'tmp', 'thumbs')
+        self.db_filename = os.path.join(basedir, 'tmp', 'image_sizes.sqlite')
+        self.conn = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @functools.cached_property
+    def format(self):
+        from PIL import features
+        return 'WEBP' if features.check('webp') else 'JPEG'
+
+    @property
+    def mimetype(self):
+        return 'image/webp' if self.format == 'WEBP' else 'image/jpeg'
+
+    def get(self, full_path, size):
+        "Path of the thumbnail for an image, making it first if necessary."
+        thumb_path = self.thumb_path(full_path, size)
+        if os.path.exists(thumb_path):
+            self.hits += 1
+            return thumb_path
+        self.misses += 1
+        self._submit(full_path, thumb_path, size).result()
+        return thumb_path
+
+    def warm(self, paths):
+        "Start making thumbnails of all sizes for new images."
+        paths = [_ for _ in paths if _.lower().endswith(self.IMAGE_SUFFIXES)]
+        if paths:
+            threading.Thread(target=self._warm, args=(paths,),
+                             name='thumbs-warm', daemon=True).start()
+
+    def _warm(self, paths):
+        for path in paths:
+            for size in self.SIZES:
+                try:
+                    thumb_path = self.thumb_path(path, size)
+                    if not os.path.exists(thumb_path):
+                        self._submit(path, thumb_path, size)
+                except OSError:
+                    pass
+
+    def thumb_path(self, full_path, size):
+        return thumbnail_path(self.dirname, self._source_hash(full_path), size, self.format)
+
+    def store_hashes(self, rows):
+        "Remember the SHA-1 of images hashed elsewhere: (path, size, mtime_ns, sha1) rows."
+        with self.lock:
+            db = self._db()
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO source_hashes (path, size, mtime_ns, sha1) '
+                    'VALUES (?, ?, ?, ?)', rows)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _submit(self, full_path, thumb_path, size):
+        return WORKER_POOL.submit(make_thumbnail, full_path, thumb_path, size, self.format)
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_filename, check_same_thread=False)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS source_hashes (path TEXT PRIMARY KEY, '
+                'size INTEGER, mtime_ns INTEGER, sha1 TEXT)')
+        return self.conn
+
+    def _source_hash(self, full_path):
+        st = os.stat(full_path)
+        with self.lock:
+            row = self._db().execute(
+                'SELECT sha1 FROM source_hashes WHERE path=? AND size=? AND mtime_ns=?',
+                (full_path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        h = hashlib.sha1()
+        with open(full_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        self.store_hashes([(full_path, st.st_size, st.st_mtime_ns, digest)])
+        return digest
+
+
+def thumbnail_path(dirname, digest, size, fmt):
+    ext = '.webp' if fmt == 'WEBP' else '.jpg'
+    return os.path.join(dirname, digest[:2], '%s-%d%s' % (digest, size, ext))
+
+
+def make_thumbnail(full_path, thumb_path, size, fmt):
+    """
+    Write a thumbnail fitting within size x size pixels. For JPEG sources,
+    draft() lets the decoder do most of the downscaling.
+    """
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    with Image.open(full_path) as im:
+        im.draft('RGB', (size, size))
+        im.thumbnail((size, size))
+        if fmt == 'JPEG' and im.mode != 'RGB':
+            im = im.convert('RGBA')
+            bg = Image.new('RGB', im.size, (255, 255, 255))
+            bg.paste(im, mask=im.split()[-1])
+            im = bg
+        elif im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA')
+        tmp_path = thumb_path + '.%d.tmp' % os.getpid()
+        im.save(tmp_path, fmt, quality=80)
+    os.replace(tmp_path, thumb_path)
+
+
+THUMBNAILS = Thumbnailer(BASEDIR)
+CACHES['thumbnails'] = THUMBNAILS
+
+
+class RecentChanges:
+    """
+    Modification times of the files in content, data, templates and static,
+    kept in memory for the "Recently changed files" list on the front page.
+
+    The files are found by one walk of the tree, started in the background
+    when the server starts (or on first use).  Changes are applied via
+    files_changed(), both those made through the admin and those reported by
+    the file watcher; if the watcher is not running, other changes are
+    picked up by a new walk in the background at most every
+    `SCAN_INTERVAL` seconds.  For each
+    combination of directories and extensions asked for, the `VIEW_SIZE` (or
+    `limit`, if larger) most recently changed files are kept in order, so
+    that a query only looks at the files it returns.
+    """
+    SECTIONS = ('content', 'data', 'templates', 'static')
+    SCAN_INTERVAL = 300
+    VIEW_SIZE = 50
+    FIRST_WAIT = 10
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.files = None
+        self.views = {}
+        self.lock = threading.RLock()
+        self.scanned = threading.Event()
+        self.scanning = False
+        self.last_scan = None
+        self.hits = 0
+        self.rebuilds = 0
+
+    def start(self):
+        """
+        Walk the tree in the background if it has not been walked within
+        the last `SCAN_INTERVAL` seconds (or at all) and no walk is underway.
+        """
+        with self.lock:
+            if self.scanning or (
+                    self.last_scan is not None and (
+                        WATCHER.active
+                        or time.monotonic() - self.last_scan <= self.SCAN_INTERVAL)):
+                return
+            self.scanning = True
+        threading.Thread(target=self._background_scan, name='recent-scan',
+                         daemon=True).start()
+
+    def get(self, dirs, exts, limit=20, days=30):
+        """
+        Returns the `limit` most recently modified files (relative paths)
+        in the given sections with one of the extensions `exts` which have
+        been modified within the last `days` days, newest first, as
+        (path, date) tuples.
+        """
+        self.start()
+        if not self.scanned.wait(self.FIRST_WAIT) or self.files is None:
+            # The background walk failed or is taking too long
+            self.scan()
+        key = (tuple(sorted(dirs)), tuple(sorted(exts)))
+        cutoff = time.time() - days * 86400
+        ret = []
+        with self.lock:
+            view = self.views.get(key)
+            if view is None or view['stale'] or view['size'] < limit:
+                view = self.views[key] = self._build_view(
+                    key, max(limit, self.VIEW_SIZE))
+            else:
+                self.hits += 1
+            for mtime, rel in reversed(view['top']):
+                if mtime < cutoff or len(ret) >= limit:
+                    break
+                ret.append((rel, datetime.date.fromtimestamp(mtime)))
+        return ret
+
+    def update_paths(self, paths):
+        "Record that the given files or directories were changed or removed."
+        with self.lock:
+            if self.files is None:
+                return  # Not scanned yet; the scan will see the change
+            for path in paths:
+                rel = os.path.relpath(path, self.basedir)
+                if rel.split(os.sep, 1)[0] not in self.SECTIONS:
+                    continue
+                if os.path.isfile(path):
+                    self._set(rel, os.stat(path).st_mtime)
+                elif os.path.isdir(path):
+                    for sub_rel, mtime in self._walk(path):
+                        self._set(sub_rel, mtime)
+                else:
+                    for known in [_ for _ in self.files
+                                  if _ == rel or _.startswith(rel + '/')]:
+                        self._forget(known)
+
+    def scan(self):
+        files = {}
+        for section in self.SECTIONS:
+            files.update(self._walk(os.path.join(self.basedir, section)))
+        with self.lock:
+            self.files = files
+            self.views = {}
+            self.last_scan = time.monotonic()
+        self.scanned.set()
+
+    def stats(self):
+        return {'hits': self.hits, 'rebuilds': self.rebuilds,
+                'files': len(self.files) if self.files is not None else None}
+
+    def _background_scan(self):
+        try:
+            self.scan()
+        except Exception as e:
+            print("WARNING: Could not scan for recently changed files: %s" % e)
+        finally:
+            self.scanning = False
+            self.scanned.set()
+
+    def _build_view(self, key, size):
+        self.rebuilds += 1
+        top = heapq.nlargest(
+            size, ((mtime, rel) for rel, mtime in self.files.items()
+                   if self._matches(key, rel)))
+        top.reverse()
+        return {'top': top, 'size': size, 'stale': False}
+
+    def _matches(self, key, rel):
+        dirs, exts = key
+        return rel.split('/', 1)[0] in dirs and rel.endswith(exts)
+
+    def _set(self, rel, mtime):
+        old = self.files.get(rel)
+        self.files[rel] = mtime
+        for key, view in self.views.items():
+            if view['stale'] or not self._matches(key, rel):
+                continue
+            top = view['top']
+            if old is not None:
+                i = bisect.bisect_left(top, (old, rel))
+                if i < len(top) and top[i] == (old, rel):
+                    del top[i]
+            bisect.insort(top, (mtime, rel))
+            if len(top) > view['size']:
+                del top[0]
+
+    def _forget(self, rel):
+        old = self.files.pop(rel)
+        for key, view in self.views.items():
+            top = view['top']
+            i = bisect.bisect_left(top, (old, rel))
+            if i < len(top) and top[i] == (old, rel):
+                # A file from outside the view might now belong in it
+                view['stale'] = True
+
+    def _walk(self, root):
+        stack = [root]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            yield (os.path.relpath(entry.path, self.basedir),
+                                   entry.stat().st_mtime)
+                    except OSError:
+                        pass
+
+
+RECENT_CHANGES = RecentChanges(BASEDIR)
+CACHES['recent_changes'] = RECENT_CHANGES
+
+
+class SearchIndex:
+    """
+    Full-text index of the files in content, data, templates and static
+    (filenames, front matter titles and the text of editable files),
+    stored as an SQLite FTS5 table in tmp/search_index.sqlite.
+
+    The index is built in the background when first needed (searches are
+    answered from what is already in the file meanwhile, or not at all if
+    it is empty) and afterwards kept current by `update_paths()`, called via
+    files_changed() for changes made through the admin or reported by the
+    file watcher.  If the watcher is not running, changes made by other
+    means are found by an mtime scan (run in the background at most every
+    `SCAN_INTERVAL` seconds).  Scans index `BATCH_SIZE` files at a time, so
+    that searches are not held up for long.
+    """
+    SECTIONS = ('content', 'data', 'templates', 'static')
+    SCAN_INTERVAL = 60
+    BATCH_SIZE = 200
+    MAX_BODY = 256 * 1024
+    TEXT_EXTS = tuple('.' + _ for _ in EDITABLE_EXTENSIONS)
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.filename = os.path.join(basedir, 'tmp', 'search_index.sqlite')
+        self.conn = None
+        self.lock = threading.RLock()
+        self.last_scan = None
+        self.scanning = False
+        self.has_data = None
+
+    def search(self, query, prefix='', page=1, pagesize=50):
+        """
+        Returns the total number of hits below the directory `prefix` (e.g.
+        'content/blog/') and one page of them, best matches first, as dicts
+        with the keys path, name, title and snippet (HTML); or None while
+        the index is first being built.
+        """
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return 0, []
+        self._maybe_scan()
+        if self.last_scan is None and not self._has_data():
+            return None
+        fts_query = ' '.join('"%s"*' % _ for _ in terms)
+        where = 'docs MATCH ? AND files.path >= ? AND files.path < ?'
+        args = (fts_query, prefix, prefix + '\uffff')
+        with self.lock:
+            db = self._db()
+            total = db.execute(
+                'SELECT COUNT(*) FROM docs JOIN files ON files.rowid = docs.rowid WHERE '
+                + where, args).fetchone()[0]
+            rows = db.execute(
+                "SELECT files.path, docs.title, snippet(docs, 2, '\x02', '\x03', '...', 12) "
+                'FROM docs JOIN files ON files.rowid = docs.rowid WHERE ' + where
+                + ' ORDER BY bm25(docs, 10.0, 5.0, 1.0) LIMIT ? OFFSET ?',
+                args + (pagesize, (max(page, 1) - 1) * pagesize)).fetchall()
+        results = []
+        for path, title, snippet in rows:
+            snippet = html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')
+            results.append({'path': path, 'name': os.path.basename(path),
+                            'title': title, 'snippet': snippet})
+        return total, results
+
+    def update_paths(self, paths):
+        "Reindex (or remove from the index) the given files and directories."
+        with self.lock:
+            if self.last_scan is None and not self.scanning:
+                return  # Not being built yet; the first scan will see the change
+            db = self._db()
+            with db:
+                for path in paths:
+                    rel = os.path.relpath(path, self.basedir)
+                    if rel.split(os.sep, 1)[0] not in self.SECTIONS:
+                        continue
+                    if os.path.isfile(path):
+                        self._index_file(db, rel, os.stat(path))
+                    elif os.path.isdir(path):
+                        for sub_rel, st in self._walk(path):
+                            self._index_file(db, sub_rel, st)
+                    else:
+                        for rowid, in db.execute(
+                                'SELECT rowid FROM files WHERE path = ? OR (path >= ? AND path < ?)',
+                                (rel, rel + '/', rel + '/\uffff')).fetchall():
+                            self._remove(db, rowid)
+
+    def scan(self):
+        "Bring the whole index up to date by comparing mtimes and sizes."
+        with self.lock:
+            known = dict((path, (rowid, mtime_ns, size)) for rowid, path, mtime_ns, size
+                         in self._db().execute('SELECT rowid, path, mtime_ns, size FROM files'))
+        batch = []
+
+        def index_batch():
+            with self.lock:
+                db = self._db()
+                with db:
+                    for rel, st in batch:
+                        self._index_file(db, rel, st)
+            batch.clear()
+        for section in self.SECTIONS:
+            for rel, st in self._walk(os.path.join(self.basedir, section)):
+                old = known.pop(rel, None)
+                if old and old[1] == st.st_mtime_ns and old[2] == st.st_size:
+                    continue
+                batch.append((rel, st))
+                if len(batch) >= self.BATCH_SIZE:
+                    index_batch()
+        index_batch()
+        with self.lock:
+            db = self._db()
+            with db:
+                for rowid, _, _ in known.values():
+                    self._remove(db, rowid)
+            self.last_scan = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            count = self._db().execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        return {'files': count, 'building': self.last_scan is None and self.scanning,
+                'last_scan_age': (
+                    round(time.monotonic() - self.last_scan, 1) if self.last_scan else None)}
+
+    def _has_data(self):
+        if not self.has_data:
+            with self.lock:
+                self.has_data = self._db().execute(
+                    'SELECT 1 FROM files LIMIT 1').fetchone() is not None
+        return self.has_data
+
+    def _maybe_scan(self):
+        with self.lock:
+            if self.scanning or (
+                    self.last_scan is not None and (
+                        WATCHER.active
+                        or time.monotonic() - self.last_scan <= self.SCAN_INTERVAL)):
+                return
+            self.scanning = True
+        threading.Thread(target=self._background_scan, name='search-scan',
+                         daemon=True).start()
+
+    def _background_scan(self):
+        try:
+            self.scan()
+        except Exception as e:
+            print("WARNING: Could not update the search index: %s" % e)
+        finally:
+            self.scanning = False
+
+    def _walk(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [_ for _ in dirnames if not _.startswith('.')]
+            for fn in filenames:
+                if fn.startswith('.'):
+                    continue
+                full_path = os.path.join(dirpath, fn)
+                try:
+                    yield os.path.relpath(full_path, self.basedir), os.stat(full_path)
+                except OSError:
+                    pass
+
+    def _index_file(self, db, rel, st):
+        name = os.path.basename(rel)
+        title = body = ''
+        if name.endswith(self.TEXT_EXTS):
+            try:
+                with open(os.path.join(self.basedir, rel), errors='replace') as f:
+                    body = f.read(self.MAX_BODY)
+            except OSError:
+                pass
+            meta = re.match(r'---\r?\n(.*?)\r?\n---', body, flags=re.S)
+            if meta:
+                found = re.search(r'^title:\s*[\'"]?(.*?)[\'"]?\s*$', meta.group(1), flags=re.M)
+                if found:
+                    title = found.group(1)
+        row = db.execute('SELECT rowid FROM files WHERE path = ?', (rel,)).fetchone()
+        if row:
+            db.execute('UPDATE files SET mtime_ns = ?, size = ? WHERE rowid = ?',
+                       (st.st_mtime_ns, st.st_size, row[0]))
+            db.execute('DELETE FROM docs WHERE rowid = ?', row)
+            rowid = row[0]
+        else:
+            rowid = db.execute('INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)',
+                               (rel, st.st_mtime_ns, st.st_size)).lastrowid
+        # Split names like my-first_page.md into words as well
+        names = name + ' ' + re.sub(r'[\W_]+', ' ', name)
+        db.execute('INSERT INTO docs (rowid, name, title, body) VALUES (?, ?, ?, ?)',
+                   (rowid, names, title, body))
+
+    def _remove(self, db, rowid):
+        db.execute('DELETE FROM docs WHERE rowid = ?', (rowid,))
+        db.execute('DELETE FROM files WHERE rowid = ?', (rowid,))
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS files (rowid INTEGER PRIMARY KEY, '
+                'path TEXT UNIQUE, mtime_ns INTEGER, size INTEGER)')
+            self.conn.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5('
+                "name, title, body, tokenize='unicode61 remove_diacritics 2')")
+        return self.conn
+
+
+SEARCH_INDEX = SearchIndex(BASEDIR)
+CACHES['search_index'] = SEARCH_INDEX
+CHANGE_LISTENERS.extend([
+    SEARCH_INDEX.update_paths, GIT_STATUS.invalidate, RECENT_CHANGES.update_paths])
+
+
+class DirectoryTree:
+    """
+    The directories below content, data and static, walked once and then
+    kept in memory.  Changes made through the admin or reported by the file
+    watcher update the affected part of the tree via files_changed(); if
+    the watcher is not running, changes made by other means are noticed by
+    comparing the mtime of each known directory (which changes when a
+    subdirectory is added or removed), at most every `CHECK_INTERVAL`
+    seconds.
+    """
+    ROOTS = ('content', 'data', 'static')
+    CHECK_INTERVAL = 10
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.dirs = None
+        self.lock = threading.RLock()
+        self.last_check = 0
+        self.hits = 0
+        self.rescans = 0
+
+    def all(self):
+        with self.lock:
+            self._ensure_current()
+            return sorted(self.dirs)
+
+    def children(self, parent=None):
+        """
+        Subdirectories of `parent` (or the roots), as dicts with the keys
+        path, name and has_children.
+        """
+        with self.lock:
+            self._ensure_current()
+            if parent is None:
+                names = [_ for _ in self.ROOTS if _ in self.dirs]
+                paths = names
+            elif parent in self.dirs:
+                names = self.dirs[parent][1]
+                paths = [parent + '/' + _ for _ in names]
+            else:
+                return None
+            return [{'path': path, 'name': name, 'has_children': bool(self.dirs[path][1])}
+                    for path, name in zip(paths, names) if path in self.dirs]
+
+    def update_paths(self, paths):
+        "Rescan the parts of the tree affected by changes to these paths."
+        with self.lock:
+            if self.dirs is None:
+                return
+            for path in paths:
+                rel = os.path.relpath(path, self.basedir)
+                if rel.split(os.sep, 1)[0] not in self.ROOTS:
+                    continue
+                if rel in self.dirs or os.path.isdir(path):
+                    self._rescan(os.path.dirname(rel) or rel)
+
+    def stats(self):
+        return {'hits': self.hits, 'rescans': self.rescans,
+                'dirs': len(self.dirs) if self.dirs else 0}
+
+    def _ensure_current(self):
+        if self.dirs is None:
+            self.dirs = {}
+            for root in self.ROOTS:
+                self._scan(root)
+            self.last_check = time.monotonic()
+            return
+        if WATCHER.active or time.monotonic() - self.last_check < self.CHECK_INTERVAL:
+            self.hits += 1
+            return
+        changed = []
+        for rel, (mtime_ns, _) in self.dirs.items():
+            try:
+                if os.stat(os.path.join(self.basedir, rel)).st_mtime_ns != mtime_ns:
+                    changed.append(rel)
+            except OSError:
+                changed.append(rel)
+        for rel in changed:
+            self._rescan(rel)
+        if not changed:
+            self.hits += 1
+        self.last_check = time.monotonic()
+
+    def _rescan(self, rel):
+        "Update the subdirectory list of rel, walking new and dropping removed subtrees."
+        self.rescans += 1
+        old = self.dirs.get(rel)
+        if not os.path.isdir(os.path.join(self.basedir, rel)):
+            self._drop(rel)
+            parent = os.path.dirname(rel)
+            if parent in self.dirs:
+                self._rescan(parent)
+            return
+        self._scan(rel, recursive=False)
+        if old and rel in self.dirs:
+            for gone in set(old[1]) - set(self.dirs[rel][1]):
+                self._drop(rel + '/' + gone)
+
+    def _drop(self, rel):
+        for known in [_ for _ in self.dirs if _ == rel or _.startswith(rel + '/')]:
+            del self.dirs[known]
+
+    def _scan(self, rel, recursive=True):
+        full_path = os.path.join(self.basedir, rel)
+        try:
+            mtime_ns = os.stat(full_path).st_mtime_ns
+            with os.scandir(full_path) as it:
+                subdirs = sorted(_.name for _ in it
+                                 if _.is_dir() and not _.name.startswith('.'))
+        except OSError:
+            return
+        self.dirs[rel] = (mtime_ns, subdirs)
+        for name in subdirs:
+            sub = rel + '/' + name
+            if recursive or sub not in self.dirs:
+                self._scan(sub)
+
+
+DIRECTORY_TREE = DirectoryTree(BASEDIR)
+CACHES['directory_tree'] = DIRECTORY_TREE
+CHANGE_LISTENERS.append(DIRECTORY_TREE.update_paths)
+
+
+class PreviewService:
+    """
+    Renders the quick previews on the edit page via wmk.preview_single().
+
+    Rendered previews are kept (up to `MAX_ENTRIES`) under a hash of the
+    filename, the source and a signature of the templates, data files and
+    wmk_config.yaml, so that asking again for an unchanged preview costs
+    nothing.  The signature (modification times and sizes of those files)
+    is recomputed when files_changed() reports a change to one of them, and
+    (if the file watcher is not running) at most every `SIGNATURE_TTL`
+    seconds.
+
+    Each browser session renders one preview at a time.  The editor numbers
+    its requests (`seq`); a request which is still waiting when a newer one
+    from the same session has arrived is dropped (render() returns None),
+    so that a burst of requests leads to one render of the latest source.
+    """
+    MAX_ENTRIES = 64
+    SIGNATURE_TTL = 2
+    DEPENDENCY_DIRS = ('templates', 'data')
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.signature = None
+        self.signature_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.superseded = 0
+
+    def render(self, filename, source, session=None, seq=0):
+        key = hashlib.sha256('\0'.join(
+            (filename or '', source or '', self._signature())).encode('utf-8')).hexdigest()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            state = self.sessions.setdefault(session, {'seq': 0, 'lock': threading.Lock()})
+            state['seq'] = max(state['seq'], seq)
+        with state['lock']:
+            with self.lock:
+                if seq < state['seq']:
+                    self.superseded += 1
+                    return None
+                if key in self.cache:
+                    # Rendered while this request was waiting
+                    self.hits += 1
+                    return self.cache[key]
+            html = wmk.preview_single(self.basedir, filename, source)
+            with self.lock:
+                self.misses += 1
+                self.cache[key] = html
+                while len(self.cache) > self.MAX_ENTRIES:
+                    self.cache.popitem(last=False)
+        return html
+
+    def update_paths(self, paths):
+        "Recompute the signature if templates, data or the configuration changed."
+        for path in paths:
+            rel = os.path.relpath(path, self.basedir)
+            if rel.split(os.sep, 1)[0] in self.DEPENDENCY_DIRS or rel == 'wmk_config.yaml':
+                self.signature_at = 0
+                return
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'superseded': self.superseded, 'entries': len(self.cache)}
+
+    def _signature(self):
+        if self.signature_at and (
+                WATCHER.active or time.monotonic() - self.signature_at < self.SIGNATURE_TTL):
+            return self.signature
+        h = hashlib.sha256()
+        paths = [os.path.join(self.basedir, 'wmk_config.yaml')]
+        for dirname in self.DEPENDENCY_DIRS:
+            for root, dirs, files in os.walk(os.path.join(self.basedir, dirname)):
+                dirs.sort()
+                paths.extend(os.path.join(root, _) for _ in sorted(files))
+        for path in paths:
+            try:
+                st = os.stat(path)
+                h.update(('%s %d %d\n' % (path, st.st_mtime_ns, st.st_size)).encode('utf-8'))
+            except OSError:
+                pass
+        self.signature = h.hexdigest()
+        self.signature_at = time.monotonic()
+        return self.signature
+
+
+PREVIEWS = PreviewService(BASEDIR)
+CACHES['previews'] = PREVIEWS
+CHANGE_LISTENERS.append(PREVIEWS.update_paths)
+
+
+PAGE_EXTENSIONS = EDITABLE_EXTENSIONS[:18]
+
+
+def site_url(rel):
+    """
+    The URL path (without a trailing slash) at which wmk publishes a file in
+    content or static, given relative to BASEDIR; None for other files.
+    Pages get "pretty" URLs: content/blog/post.md becomes /blog/post.
+    """
+    section, _, sub = rel.partition('/')
+    if section not in ('content', 'static') or not sub:
+        return None
+    base, ext = posixpath.splitext(sub)
+    if section == 'content' and ext[1:] in PAGE_EXTENSIONS:
+        if posixpath.basename(base) == 'index':
+            base = posixpath.dirname(base)
+        return '/' + base
+    return '/' + sub
+
+
+def page_attachment_dir(rel):
+    """
+    The folder holding the attachments of a page (content/a/b.md ->
+    content/a/b), or None if `rel` is not a page or is an index page.
+    """
+    base, ext = posixpath.splitext(rel)
+    if ext[1:] not in PAGE_EXTENSIONS or posixpath.basename(base) == 'index':
+        return None
+    return base
+
+
+class ReferenceIndex:
+    """
+    The links and image/asset references in each page in content, stored in
+    tmp/references.sqlite, so that the pages referring to a file can be
+    found without reading the whole content tree.  Each reference is stored
+    as written and as an absolute URL path (relative URLs are resolved
+    against the URL of the page); which file it points to is only worked
+    out when needed, so references do not go stale when files come and go.
+
+    The index is built in one pass on first use and afterwards kept current
+    by `update_paths()`, called via files_changed().  If the file watcher is
+    not running, an mtime scan precedes each use.
+    """
+    LINK_RE = re.compile(
+        r'\]\(\s*<?(?P<md>[^)\s>]+)'  # [text](url) and ![alt](url)
+        r'|^[ ]{0,3}\[[^\]\n]+\]:[ \t]*<?(?P<ref>[^\s>]+)'  # [id]: url
+        r'|\b(?:href|src)\s*=\s*(?P<q>["\'])(?P<attr>.*?)(?P=q)',  # HTML attributes
+        re.M | re.I)
+    EXTERNAL_RE = re.compile(r'^(?:[a-z][a-z0-9+.\-]*:|//|#)', re.I)
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.filename = os.path.join(basedir, 'tmp', 'references.sqlite')
+        self.conn = None
+        self.lock = threading.RLock()
+        self.built = False
+
+    def plan_move(self, src, dest, rewrite=True):
+        """
+        What moving `src` to `dest` (paths relative to BASEDIR) entails.
+        Returns a dict with `moves`, a list of (from, to) paths in which a
+        page is followed by its attachment folder (unless something is in
+        the way), and `rewrites`, a dict from the path of each page after
+        the move to a dict of old -> new URLs in it: both pages referring
+        to the moved files and moved pages with relative references.
+        """
+        moves = [(src, dest)]
+        src_att, dest_att = page_attachment_dir(src), page_attachment_dir(dest)
+        if (src_att and dest_att and os.path.isdir(os.path.join(self.basedir, src_att))
+                and not os.path.lexists(os.path.join(self.basedir, dest_att))):
+            moves.append((src_att, dest_att))
+        plan = {'moves': moves, 'rewrites': {}}
+        if not rewrite:
+            return plan
+
+        def moved(rel):
+            for old, new in moves:
+                if rel == old or rel.startswith(old + '/'):
+                    return new + rel[len(old):]
+            return rel
+        where, args = [], []
+        for old, _ in moves:
+            url = site_url(old)
+            if url is not None:
+                prefix = url.rstrip('/') + '/'
+                where.append('target = ? OR (target >= ? AND target < ?)')
+                args += [url, prefix, prefix + '\uffff']
+            where.append('source = ? OR (source >= ? AND source < ?)')
+            args += [old, old + '/', old + '/\uffff']
+        self._ensure_current()
+        with self.lock:
+            rows = self._db().execute(
+                'SELECT DISTINCT source, url, target FROM refs WHERE '
+                + ' OR '.join('(%s)' % _ for _ in where), args).fetchall()
+        resolved = {}
+        for source, url, target in rows:
+            if target not in resolved:
+                resolved[target] = self._resolve(target)
+            if resolved[target] is None:
+                continue  # A broken reference; leave it alone
+            new_source, new_target = moved(source), moved(resolved[target])
+            if new_source == source and new_target == resolved[target]:
+                continue
+            new_url = self._new_url(url, new_source, new_target)
+            if self._target(new_source, new_url) != self._target(new_source, url):
+                plan['rewrites'].setdefault(new_source, {})[url] = new_url
+        return plan
+
+    def rewrite(self, rel, changes):
+        "Replace references in a file according to `changes` (old URL -> new URL)."
+        full_path = os.path.join(self.basedir, rel)
+        with open(full_path) as f:
+            text = f.read()
+
+        def replace(m):
+            group = 'md' if m.group('md') else 'ref' if m.group('ref') else 'attr'
+            if m.group(group) not in changes:
+                return m.group(0)
+            start, end = m.start(group) - m.start(0), m.end(group) - m.start(0)
+            return m.group(0)[:start] + changes[m.group(group)] + m.group(0)[end:]
+        new_text = self.LINK_RE.sub(replace, text)
+        if new_text == text:
+            return False
+        atomic_write(full_path, new_text)
+        return True
+
+    def update_paths(self, paths):
+        "Reindex (or remove from the index) the given files and directories."
+        with self.lock:
+            if not self.built:
+                return  # Not built yet; the first scan will see the change
+            db = self._db()
+            with db:
+                for path in paths:
+                    rel = os.path.relpath(path, self.basedir).replace(os.sep, '/')
+                    if not rel.startswith('content/'):
+                        continue
+                    args = (rel, rel + '/', rel + '/\uffff')
+                    db.execute('DELETE FROM refs WHERE source = ? OR '
+                               '(source >= ? AND source < ?)', args)
+                    db.execute('DELETE FROM files WHERE path = ? OR '
+                               '(path >= ? AND path < ?)', args)
+                    if os.path.isdir(path):
+                        for sub_rel, st in self._walk(path):
+                            self._index(db, sub_rel, st)
+                    elif os.path.isfile(path) and self._is_page(rel):
+                        self._index(db, rel, os.stat(path))
+
+    def scan(self):
+        "Index new and modified pages and forget removed ones."
+        with self.lock:
+            db = self._db()
+            known = {path: (mtime_ns, size) for path, mtime_ns, size
+                     in db.execute('SELECT path, mtime_ns, size FROM files')}
+            with db:
+                for rel, st in self._walk(os.path.join(self.basedir, 'content')):
+                    if known.pop(rel, None) == (st.st_mtime_ns, st.st_size):
+                        continue
+                    db.execute('DELETE FROM refs WHERE source = ?', (rel, ))
+                    self._index(db, rel, st)
+                for rel in known:
+                    db.execute('DELETE FROM refs WHERE source = ?', (rel, ))
+                    db.execute('DELETE FROM files WHERE path = ?', (rel, ))
+            self.built = True
+
+    def stats(self):
+        with self.lock:
+            if not self.built:
+                return {'pages': None, 'references': None}
+            db = self._db()
+            return {'pages': db.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+                    'references': db.execute('SELECT COUNT(*) FROM refs').fetchone()[0]}
+
+    def _ensure_current(self):
+        if not (self.built and WATCHER.active):
+            self.scan()
+
+    def _resolve(self, target):
+        "The file (relative to BASEDIR) served at the URL path `target`, if any."
+        sub = target.strip('/')
+        if sub == 'index.html' or sub.endswith('/index.html'):
+            sub = posixpath.dirname(sub)
+        candidates = ['content/%s.%s' % (sub, ext) for ext in PAGE_EXTENSIONS if sub]
+        candidates += [posixpath.join('content', sub, 'index.' + ext) for ext in PAGE_EXTENSIONS]
+        if sub:
+            candidates += ['content/' + sub, 'static/' + sub]
+        for rel in candidates:
+            if os.path.isfile(os.path.join(self.basedir, rel)):
+                return rel
+        return None
+
+    def _new_url(self, url, source, target):
+        """
+        `url`, as written in the page `source`, changed to point to the file
+        `target`, keeping its query string and fragment, whether it is
+        relative or absolute and how it ends (/, /index.html or neither).
+        """
+        path, suffix = re.match(r'([^?#]*)(.*)$', url, re.S).groups()
+        new_path = site_url(target)
+        if self._is_page(target):
+            if path.endswith('index.html'):
+                new_path = new_path.rstrip('/') + '/index.html'
+            elif path.endswith('/') or path in ('.', '..'):
+                new_path = new_path.rstrip('/') + '/'
+        if not path.startswith('/'):
+            base = site_url(source).rstrip('/') + '/'
+            rel = posixpath.relpath(new_path, base)
+            if new_path.endswith('/') and new_path != base:
+                rel += '/'
+            new_path = './' if rel == '.' else rel
+        return new_path.replace(' ', '%20') + suffix
+
+    def _target(self, source, url):
+        "The absolute URL path a reference in `source` points to, or None."
+        if self.EXTERNAL_RE.match(url):
+            return None
+        path = urllib.parse.unquote(re.split(r'[?#]', url, maxsplit=1)[0])
+        if not path:
+            return None
+        if not path.startswith('/'):
+            path = site_url(source).rstrip('/') + '/' + path
+        return posixpath.normpath(path).replace('//', '/')
+
+    def _index(self, db, rel, st):
+        try:
+            with open(os.path.join(self.basedir, rel), errors='replace') as f:
+                text = f.read()
+        except OSError:
+            return
+        refs = set()
+        for m in self.LINK_RE.finditer(text):
+            url = m.group('md') or m.group('ref') or m.group('attr')
+            target = self._target(rel, url) if url else None
+            if target:
+                refs.add((rel, url, target))
+        db.execute('INSERT OR REPLACE INTO files (path, mtime_ns, size) VALUES (?, ?, ?)',
+                   (rel, st.st_mtime_ns, st.st_size))
+        db.executemany('INSERT INTO refs (source, url, target) VALUES (?, ?, ?)', refs)
+
+    def _is_page(self, rel):
+        return rel.startswith('content/') and posixpath.splitext(rel)[1][1:] in PAGE_EXTENSIONS
+
+    def _walk(self, root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [_ for _ in dirnames if not _.startswith('.')]
+            for fn in filenames:
+                full_path = os.path.join(dirpath, fn)
+                rel = os.path.relpath(full_path, self.basedir).replace(os.sep, '/')
+                if fn.startswith('.') or not self._is_page(rel):
+                    continue
+                try:
+                    yield rel, os.stat(full_path)
+                except OSError:
+                    pass
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+                'mtime_ns INTEGER, size INTEGER)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS refs (source TEXT, url TEXT, target TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS refs_source ON refs (source)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS refs_target ON refs (target)')
+        return self.conn
+
+
+REFERENCES = ReferenceIndex(BASEDIR)
+CACHES['references'] = REFERENCES
+CHANGE_LISTENERS.append(REFERENCES.update_paths)
+
+
+PRECOMPRESSED_EXTENSIONS = (('br', '.br'), ('gzip', '.gz'))
+
+
+@functools.lru_cache(maxsize=256)
+def _mimetype_for_ext(ext):
+    return mimetypes.guess_type('x' + ext)[0] or 'application/octet-stream'
+
+
+def guess_mimetype(path):
+    return _mimetype_for_ext(os.path.splitext(path)[1].lower())
+
+
+class HtmlVariantCache:
+    """
+    HTML pages from htdocs with the admin overlay injected, keyed by
+    (path, mtime, size, overlay) and limited to `MAX_BYTES` in total,
+    least recently used first out.  Emptied whenever a build finishes.
+    """
+    MAX_BYTES = 32 * 1024 * 1024
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, full_path, st, edit_url):
+        "Returns the overlaid page and its ETag."
+        key = (full_path, st.st_mtime_ns, st.st_size, edit_url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        with open(full_path, 'rb') as f:
+            body = f.read()
+        body = body.replace(b'</body>', admin_marker(edit_url).encode('utf-8') + b'</body>')
+        entry = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = entry
+                self.size += len(body)
+            while self.size > self.MAX_BYTES and self.entries:
+                _, (old_body, _) = self.entries.popitem(last=False)
+                self.size -= len(old_body)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'bytes': self.size}
+
+
+HTML_VARIANTS = HtmlVariantCache()
+CACHES['html_variants'] = HTML_VARIANTS
+
+
+class FragmentCache:
+    """
+    Rendered pieces of admin pages, keyed by everything they depend on (so
+    that they never need to be invalidated) and limited to `MAX_ENTRIES`,
+    least recently used first out.  What cannot cheaply be part of a key is
+    covered by the generation of a directory, which goes up whenever
+    files_changed() reports a change in it or in one of its subdirectories.
+    """
+    MAX_ENTRIES = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, dirname):
+        return self.generations.get(os.path.normpath(dirname), 0)
+
+    def update_paths(self, paths):
+        with self.lock:
+            for path in paths:
+                parent = os.path.dirname(os.path.normpath(path))
+                for dirname in (parent, os.path.dirname(parent)):
+                    self.generations[dirname] = self.generations.get(dirname, 0) + 1
+
+    def get(self, key, render):
+        "The fragment for `key`, made by calling `render()` if needed."
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = render()
+        with self.lock:
+            self.entries[key] = html
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+        return html
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries)}
+
+
+DIR_ROWS = FragmentCache()
+CACHES['dir_rows'] = DIR_ROWS
+CHANGE_LISTENERS.append(DIR_ROWS.update_paths)
+
+
+class HtdocsManifest:
+    """
+    Size, mtime, SHA-256 hash, MIME type and available precompressed
+    variants of every file in htdocs, brought up to date after each build
+    and saved in tmp/htdocs_manifest.json.
+
+    Files whose size and mtime match the previous manifest are not read
+    again.  For files whose hash has changed, gzip (and, if the brotli
+    module is installed, brotli) siblings are written next to them, unless
+    `precompress` is false in wmk_admin.yaml.  Hashing and compression run
+    in WORKER_POOL.
+    """
+    COMPRESSIBLE_TYPES = (
+        'text/', 'application/javascript', 'application/json',
+        'application/xml', 'application/rss+xml', 'application/atom+xml',
+        'image/svg+xml')
+    MIN_COMPRESS_SIZE = 256
+    POOL_THRESHOLD = 16
+
+    def __init__(self, basedir):
+        self.root = os.path.join(basedir, 'htdocs')
+        self.filename = os.path.join(basedir, 'tmp', 'htdocs_manifest.json')
+        self.entries = None
+
+    def get(self, rel_path, st):
+        "The manifest entry for a file, if it is still current."
+        if self.entries is None:
+            self.entries = self._load()
+        entry = self.entries.get(rel_path)
+        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry
+        return None
+
+    def update(self):
+        "Rescan htdocs; returns the number of files and time taken per stage."
+        if self.entries is None:
+            self.entries = self._load()
+        old = self.entries
+        precompress = get_config(BASEDIR, 'wmk_admin').get('precompress', True)
+        encodings = [_ for _ in PRECOMPRESSED_EXTENSIONS
+                     if _[0] == 'gzip' or (_[0] == 'br' and _have_brotli())]
+        stats = {}
+        # Stage 1: stat every file
+        t = time.monotonic()
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            names = set(filenames)
+            for fn in filenames:
+                full_path = os.path.join(dirpath, fn)
+                rel = os.path.relpath(full_path, self.root)
+                if fn.endswith(('.gz', '.br')) and (
+                        fn[:-3] in names
+                        or any(ext == fn[-3:] for _, ext
+                               in old.get(rel[:-3], {}).get('encodings', []))):
+                    # A sibling; those of removed files are deleted below
+                    continue
+                try:
+                    st = os.stat(full_path)
+                except OSError:
+                    continue
+                found[rel] = {
+                    'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                    'mime': guess_mimetype(fn), 'encodings': [],
+                    'siblings': [ext for _, ext in PRECOMPRESSED_EXTENSIONS
+                                 if fn + ext in names]}
+        stats['scan'] = {'files': len(found), 'seconds': round(time.monotonic() - t, 3)}
+        # Stage 2: hash files which are new or have a new size/mtime
+        t = time.monotonic()
+        to_hash = []
+        for rel, entry in found.items():
+            prev = old.get(rel)
+            if prev and prev['size'] == entry['size'] and prev['mtime_ns'] == entry['mtime_ns']:
+                entry['sha256'] = prev['sha256']
+                entry['encodings'] = prev['encodings']
+                entry['tried'] = prev.get('tried', [])
+            else:
+                to_hash.append(rel)
+        hashes = self._map(_hash_file, [os.path.join(self.root, _) for _ in to_hash])
+        for rel, digest in zip(to_hash, hashes):
+            found[rel]['sha256'] = digest
+            prev = old.get(rel)
+            if prev and prev['sha256'] == digest:
+                # Rewritten with the same contents: the siblings are still valid
+                found[rel]['encodings'] = prev['encodings']
+                found[rel]['tried'] = prev.get('tried', [])
+        stats['hash'] = {'files': len(to_hash), 'seconds': round(time.monotonic() - t, 3)}
+        stats['pages_written'] = sum(1 for _ in to_hash if found[_]['mime'] == 'text/html')
+        # Stage 3: (re)compress files with a new hash or missing siblings
+        t = time.monotonic()
+        to_compress = []
+        tried = [_[0] for _ in encodings]
+        for rel, entry in found.items():
+            if not (precompress and entry['size'] >= self.MIN_COMPRESS_SIZE
+                    and entry['mime'].startswith(self.COMPRESSIBLE_TYPES)):
+                entry['encodings'] = entry['tried'] = []
+                continue
+            prev = old.get(rel)
+            if (prev and prev['sha256'] == entry['sha256']
+                    and entry.get('tried') == tried
+                    and all(ext in entry['siblings'] for _, ext in entry['encodings'])):
+                continue
+            to_compress.append(rel)
+        results = self._map(
+            _precompress_file,
+            [(os.path.join(self.root, _), encodings) for _ in to_compress])
+        for rel, made in zip(to_compress, results):
+            found[rel]['encodings'] = made
+            found[rel]['tried'] = tried
+        stats['compress'] = {'files': len(to_compress), 'seconds': round(time.monotonic() - t, 3)}
+        # Remove siblings of files which are gone or no longer compressed
+        removed = 0
+        for rel, prev in old.items():
+            keep = [tuple(_) for _ in found[rel]['encodings']] if rel in found else []
+            for enc in prev['encodings']:
+                if tuple(enc) not in keep:
+                    try:
+                        os.remove(os.path.join(self.root, rel + enc[1]))
+                        removed += 1
+                    except OSError:
+                        pass
+        stats['removed_siblings'] = removed
+        for entry in found.values():
+            del entry['siblings']
+        self.entries = found
+        atomic_write(self.filename, json.dumps(found))
+        logfile = os.path.join(BASEDIR, 'tmp/admin.log')
+        with open(logfile, 'a') as f:
+            f.write("[Post-build: %s]\n" % '; '.join(
+                '%s: %d files in %ss' % (k, v['files'], v['seconds'])
+                for k, v in stats.items() if isinstance(v, dict)))
+        return stats
+
+    def _map(self, fn, args):
+        if len(args) < self.POOL_THRESHOLD:
+            return [fn(_) for _ in args]
+        return list(WORKER_POOL.map(fn, args, chunksize=32))
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+def _hash_file(full_path):
+    h = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _precompress_file(args):
+    """
+    Write compressed siblings of a file (only keeping those which are
+    noticeably smaller than the original); returns the list of
+    (encoding, extension) pairs written.
+    """
+    full_path, encodings = args
+    with open(full_path, 'rb') as f:
+        data = f.read()
+    made = []
+    for encoding, ext in encodings:
+        if encoding == 'br':
+            import brotli
+            compressed = brotli.compress(data)
+        else:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) > len(data) * 0.9:
+            continue
+        tmp_path = full_path + ext + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, full_path + ext)
+        made.append([encoding, ext])
+    return made
+
+
+@functools.lru_cache(maxsize=1)
+def _have_brotli():
+    import importlib.util
+    return importlib.util.find_spec('brotli') is not None
+
+
+HTDOCS_MANIFEST = HtdocsManifest(BASEDIR)
+
+
+def admin_marker(edit_url):
+    return f'''
+    <div id="in-admin-notice"
+         style="background:red;color:yellow;padding:.5em;position:fixed;bottom:0;right:0;width:230px;text-align:center">
+         <strong><small><a href="/_/admin/" style="color:yellow;text-decoration:none">Admin</a></small></strong>
+         | <small><a href="{edit_url}" style="color:yellow;text-decoration:none">edit</a></small>
+    </div>'''
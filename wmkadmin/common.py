@@ -0,0 +1,198 @@
+"""
+What the other modules of the admin share: the project directory, lazily
+imported modules, configuration files and the registry of caches.
+"""
+
+import os
+import random
+import shutil
+import string
+import importlib
+import threading
+
+import yaml
+
+# The project directory.  admin.py sets WMK_ADMIN_BASEDIR before importing
+# this package, since the path of the package may have had symlinks resolved.
+BASEDIR = os.environ.get('WMK_ADMIN_BASEDIR')
+if BASEDIR is None:
+    BASEDIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EDITABLE_EXTENSIONS = (
+    # wmk content which can be handled without pandoc:
+    'md', 'mdwn', 'mdown', 'markdown', 'mmd', 'gfm', 'html', 'htm',
+    # wmk content which requires pandoc:
+    'org', 'rst', 'tex', 'man', 'rtf', 'textile', 'xml', 'jats', 'tei', 'docbook',
+    # other common text-based formats:
+    'yaml', 'yml', 'json', 'js', 'css', 'scss',
+    'csv', 'txt', 'sgml', 'ini', 'toml', 'svg',
+    # Mako templates:
+    'mhtml', 'mc', 'mako', )
+
+
+class LazyModule:
+    """
+    Stands in for a module which is only imported when one of its attributes
+    is first used, so that heavy modules do not slow down startup.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Standard library modules which only some features need
+secrets = LazyModule('secrets')
+subprocess = LazyModule('subprocess')
+sqlite3 = LazyModule('sqlite3')
+difflib = LazyModule('difflib')
+hmac = LazyModule('hmac')
+base64 = LazyModule('base64')
+heapq = LazyModule('heapq')
+bisect = LazyModule('bisect')
+html = LazyModule('html')
+gzip = LazyModule('gzip')
+logging = LazyModule('logging')
+mimetypes = LazyModule('mimetypes')
+struct = LazyModule('struct')
+select = LazyModule('select')
+errno = LazyModule('errno')
+signal = LazyModule('signal')
+fcntl = LazyModule('fcntl')
+
+# Imported on first use; admin.py adds the location of wmk to sys.path
+wmk = LazyModule('wmk')
+Image = LazyModule('PIL.Image')
+
+
+def get_config(dirname, identifier='wmk_config'):
+    """
+    Will NOT raise an error if the yaml file is not at the expected location,
+    only print a warning to the console.
+
+    The parsed configuration comes from CONFIG_CACHE and is shared between
+    requests, so it must not be modified by the caller.
+    """
+    config_file = os.path.join(dirname, '%s.yaml' % identifier)
+    return CONFIG_CACHE.get(config_file)
+
+
+class ConfigCache:
+    """
+    Parsed YAML configuration files, kept in memory and only reloaded when
+    a stat shows that the file has changed.  A new version replaces the old
+    one only once it has been parsed successfully, so a file which is being
+    written (and thus fails to parse) does not hide the previous contents.
+    While the file watcher (set as `watcher` by the watcher module) runs,
+    files it watches are not stat-ed; it reports their changes through
+    update_paths() instead.
+    """
+    STALE = 'stale'
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def get(self, config_file):
+        entry = self.entries.get(config_file)
+        if (entry and entry[0] != self.STALE and self.watcher is not None
+                and self.watcher.watches_file(config_file)):
+            self.hits += 1
+            return entry[1]
+        try:
+            st = os.stat(config_file)
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            signature = None
+        entry = self.entries.get(config_file)
+        if entry and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+        with self.lock:
+            entry = self.entries.get(config_file)
+            if entry and entry[0] == signature:
+                self.hits += 1
+                return entry[1]
+            if entry:
+                self.reloads += 1
+            else:
+                self.misses += 1
+            conf = {}
+            try:
+                with open(config_file) as f:
+                    conf = yaml.safe_load(f)
+            except FileNotFoundError:
+                print("WARNING: File '{}' not found".format(config_file))
+            except yaml.YAMLError:
+                if entry:
+                    # Keep the previous version until the file changes again
+                    print("WARNING: Could not parse '{}'; using previous version".format(
+                        config_file))
+                    self.entries[config_file] = (signature, entry[1])
+                    return entry[1]
+                raise
+            self.entries[config_file] = (signature, conf or {})
+            return conf or {}
+
+    def update_paths(self, paths):
+        "Check the given configuration files for changes when next asked for."
+        with self.lock:
+            for path in paths:
+                entry = self.entries.get(path)
+                if entry:
+                    self.entries[path] = (self.STALE, entry[1])
+
+    def invalidate(self, config_file=None):
+        with self.lock:
+            if config_file is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(config_file, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'reloads': self.reloads, 'files': len(self.entries)}
+
+
+CONFIG_CACHE = ConfigCache()
+CACHES = {'config': CONFIG_CACHE}
+
+
+def atomic_write(full_path, contents):
+    """
+    Write a file via a temporary file in the same directory which is then
+    renamed into place, so that readers never see a partially written file.
+    """
+    dirname, basename = os.path.split(full_path)
+    tmp_path = os.path.join(
+        dirname, '.%s.%s.tmp' % (basename, ''.join(random.choices(string.ascii_letters, k=8))))
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(full_path):
+            shutil.copymode(full_path, tmp_path)
+        os.replace(tmp_path, full_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def metric_line(name, value, **labels):
+    "A sample line in the Prometheus text format."
+    if labels:
+        name += '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in labels.items())
+    return '%s %s' % (name, repr(float(value)) if isinstance(value, float) else value)
@@ -0,0 +1,755 @@
+"""
+Building the site with wmk (queued, so that requests arriving close
+together lead to a single build), the dependency index which decides what
+a build must render, telemetry of past builds, and deploy jobs.
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import datetime
+import shutil
+import collections
+import contextlib
+import json
+import threading
+
+from .common import (
+    BASEDIR, EDITABLE_EXTENSIONS, fcntl, get_config, logging, metric_line, secrets,
+    signal, subprocess, wmk)
+from .caches import GIT_STATUS, HTDOCS_MANIFEST, HTML_VARIANTS
+
+
+class ThreadOutput:
+    """
+    Stand-in for `sys.stdout` which lets a thread capture what it prints
+    without affecting other threads: while a thread is inside `capture()`,
+    its writes (and the records it sends to the `logging` module) go to its
+    own buffer, while everything else goes to the real stdout.  It is
+    installed the first time it is used.
+    """
+
+    def __init__(self):
+        self.stream = None
+        self.buffers = {}
+
+    def install(self):
+        if sys.stdout is not self:
+            self.stream = sys.stdout
+            sys.stdout = self
+
+    @contextlib.contextmanager
+    def capture(self):
+        self.install()
+        ident = threading.get_ident()
+        buf = self.buffers[ident] = io.StringIO()
+        handler = logging.StreamHandler(buf)
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        handler.addFilter(lambda record: record.thread == ident)
+        logging.getLogger().addHandler(handler)
+        try:
+            yield buf
+        finally:
+            logging.getLogger().removeHandler(handler)
+            del self.buffers[ident]
+
+    def write(self, s):
+        buf = self.buffers.get(threading.get_ident())
+        if buf is not None:
+            return buf.write(s)
+        return self.stream.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+BUILD_OUTPUT = ThreadOutput()
+
+
+def wmk_build(msg=None, hard=False, quick=False, paths=None, report=None):
+    """
+    Run wmk on the project. If `paths` (the changed files) is given, the
+    dependency index decides whether a targeted build suffices: the pages
+    affected by the change are marked as stale and a quick build is run.
+    Returns the kind of build performed ('full', 'quick' or 'targeted').
+    If `report` (a dict) is given, the warnings and errors printed by wmk
+    are put into it.
+    """
+    start = datetime.datetime.now()
+    kind = 'quick' if quick else 'full'
+    if paths is not None and not hard:
+        stale = DEPENDENCIES.plan(paths)
+        quick = stale is not None
+        if quick:
+            DEPENDENCIES.mark_stale(stale)
+            kind = 'targeted'
+            if msg:
+                msg += ' (%d affected pages)' % len(stale)
+        else:
+            kind = 'full'
+    if hard and msg:
+        msg += ' - HARD REBUILD!'
+    if hard:
+        quick = False
+        kind = 'full'
+        tmpdir = os.path.join(BASEDIR, 'tmp')
+        tmpfiles = os.listdir(tmpdir)
+        for fn in tmpfiles:
+            if fn.startswith('wmk_render_cache'):
+                os.unlink(os.path.join(tmpdir, fn))
+        shutil.rmtree(os.path.join(BASEDIR, 'htdocs'))
+    with BUILD_OUTPUT.capture() as output:
+        try:
+            wmk.main(BASEDIR, quick=quick)
+        finally:
+            lines = output.getvalue().split("\n")
+            if report is not None:
+                report['warnings'] = [_ for _ in lines if 'WARN' in _]
+                report['errors'] = [_ for _ in lines if 'ERR' in _]
+    if msg:
+        logfile = os.path.join(BASEDIR, 'tmp/admin.log')
+        end = datetime.datetime.now()
+        duration = end - start
+        with open(logfile, 'a') as f:
+            f.write("\n=====\nRan wmk %sbuild. Reason: %s\n" % (
+                '' if kind == 'full' else kind + ' ', msg))
+            f.write("[Timing: %s to %s; duration=%s]\n" % (str(start), str(end), str(duration)))
+            show_lines = [_ for _ in lines if 'WARN' in _ or 'ERR' in _]
+            if show_lines:
+                f.write("\n".join(show_lines)+"\n")
+    return kind
+
+
+class DependencyIndex:
+    """
+    Knows which content pages depend on which templates and data files, so
+    that a build can be limited to the pages affected by a set of changed
+    paths.  What is learned about each file is cached by mtime, so after the
+    first scan only a stat per file is needed.
+
+    The dependants of a changed file are:
+
+    - for a content page: the page itself and the index pages of the
+      directories above it (which typically list it);
+    - for a template: the pages rendered with it, or with any template that
+      inherits, includes or imports it;
+    - for a data file: the pages and templates mentioning its filename
+      (and the pages using those templates).
+
+    Anything else (wmk_config.yaml, directory-level metadata, removed
+    directories, ...) requires a full build, as does a change affecting
+    more than `FULL_BUILD_RATIO` of all pages.
+    """
+    DEFAULT_TEMPLATE = 'md_base.mhtml'
+    FULL_BUILD_RATIO = 0.5
+    CONTENT_EXTS = tuple('.' + _ for _ in EDITABLE_EXTENSIONS[:18])
+    DATA_REF_RE = re.compile(r'[\w./-]+\.(?:ya?ml|json|csv|toml)\b')
+    TEMPLATE_META_RE = re.compile(
+        r'^(?:template|layout): *[\'"]?([^\'"\n]+)', flags=re.M)
+    TEMPLATE_REF_RE = re.compile(
+        r'<%(?:inherit|include|namespace)\s[^>]*file=[\'"]([^\'"]+)[\'"]')
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def plan(self, paths):
+        """
+        Returns None if a full build is needed, or otherwise a dict mapping
+        each affected htdocs file to whether its source page still exists.
+        """
+        if not get_config(self.basedir, 'wmk_admin').get('targeted_builds', True):
+            # Same behaviour as before the dependency index existed:
+            # a quick build for content pages and a full one otherwise.
+            if all(self._section(p) == 'content'
+                   and p.endswith(self.CONTENT_EXTS) for p in paths):
+                return {}
+            return None
+        pages = set()
+        templates = set()
+        data = set()
+        for path in paths:
+            section = self._section(path)
+            if section == 'static':
+                continue
+            elif section == 'content':
+                if path.endswith(self.CONTENT_EXTS):
+                    pages.add(path)
+                elif os.path.isdir(path):
+                    if any(self._walk(path)):
+                        return None
+                elif not os.path.exists(path) and not os.path.splitext(path)[1]:
+                    # Probably a removed or moved directory
+                    return None
+                elif path.endswith(('.yaml', '.yml')):
+                    # Directory-level metadata may affect any page below it
+                    return None
+            elif section == 'templates':
+                templates.add(self._tpl_name(path))
+            elif section == 'data':
+                data.add(os.path.basename(path))
+            else:
+                return None
+        with self.lock:
+            if templates or data:
+                all_pages = list(self._walk(os.path.join(self.basedir, 'content')))
+                affected = self._affected_templates(templates, data)
+                for page in all_pages:
+                    info = self._info(page, 'content')
+                    if info and (info['template'] in affected
+                                 or info['data'] & data):
+                        pages.add(page)
+                if len(pages) > self.FULL_BUILD_RATIO * max(len(all_pages), 1):
+                    return None
+            stale = {}
+            for page in pages:
+                exists = os.path.exists(page)
+                stale[self.output_path(page)] = exists
+                for index_out in self._index_outputs(page):
+                    stale.setdefault(index_out, True)
+            return stale
+
+    def mark_stale(self, stale):
+        """
+        Make a quick build re-render the given outputs by backdating them,
+        and remove the outputs of pages which no longer exist.
+        """
+        for out, source_exists in stale.items():
+            if not os.path.isfile(out):
+                continue
+            if source_exists:
+                os.utime(out, (0, 0))
+            else:
+                os.remove(out)
+                try:
+                    os.rmdir(os.path.dirname(out))
+                except OSError:
+                    pass
+
+    def output_path(self, page):
+        "The htdocs file which wmk renders a content page to."
+        rel = os.path.relpath(page, os.path.join(self.basedir, 'content'))
+        stem = os.path.splitext(rel)[0]
+        if os.path.basename(stem) == 'index':
+            stem = os.path.dirname(stem)
+        return os.path.join(self.basedir, 'htdocs', stem, 'index.html')
+
+    def _index_outputs(self, page):
+        content_dir = os.path.join(self.basedir, 'content')
+        d = os.path.dirname(page)
+        while d.startswith(content_dir):
+            rel = os.path.relpath(d, content_dir)
+            yield os.path.normpath(
+                os.path.join(self.basedir, 'htdocs', rel, 'index.html'))
+            if d == content_dir:
+                break
+            d = os.path.dirname(d)
+
+    def _affected_templates(self, templates, data):
+        "Changed templates plus all templates depending on them (transitively)."
+        tpl_dir = os.path.join(self.basedir, 'templates')
+        infos = {}
+        for path in self._walk(tpl_dir, exts=None):
+            info = self._info(path, 'templates')
+            if info:
+                infos[self._tpl_name(path)] = info
+        affected = set(templates)
+        affected.update(name for name, info in infos.items() if info['data'] & data)
+        changed = True
+        while changed:
+            changed = False
+            for name, info in infos.items():
+                if name not in affected and info['templates'] & affected:
+                    affected.add(name)
+                    changed = True
+        # Page metadata may refer to templates without extension
+        affected.update([os.path.splitext(_)[0] for _ in affected])
+        return affected
+
+    def _info(self, path, kind):
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.files.pop(path, None)
+            return None
+        cached = self.files.get(path)
+        if cached and cached[0] == st.st_mtime_ns:
+            return cached[1]
+        try:
+            with open(path, errors='replace') as f:
+                text = f.read()
+        except OSError:
+            return None
+        info = {'data': set(os.path.basename(_)
+                            for _ in self.DATA_REF_RE.findall(text))}
+        if kind == 'content':
+            meta = re.search(r'^---\n(.*?)\n---', text, flags=re.S)
+            found = self.TEMPLATE_META_RE.search(meta.group(1)) if meta else None
+            info['template'] = found.group(1).strip() if found else self.DEFAULT_TEMPLATE
+        else:
+            info['templates'] = set(_.lstrip('/') for _ in self.TEMPLATE_REF_RE.findall(text))
+        self.files[path] = (st.st_mtime_ns, info)
+        return info
+
+    def _walk(self, root, exts=CONTENT_EXTS):
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [_ for _ in dirnames if not _.startswith('.')]
+            for fn in filenames:
+                if exts is None or fn.endswith(exts):
+                    yield os.path.join(dirpath, fn)
+
+    def _section(self, path):
+        return os.path.relpath(path, self.basedir).split(os.sep, 1)[0]
+
+    def _tpl_name(self, path):
+        return os.path.relpath(path, os.path.join(self.basedir, 'templates'))
+
+
+DEPENDENCIES = DependencyIndex(BASEDIR)
+
+
+class BuildQueue:
+    """
+    Runs wmk builds in a background thread so that request handlers can
+    return as soon as their change is on disk.
+
+    Build requests which arrive while a previous one is still pending are
+    merged into it: the build starts once no new request has arrived for
+    `build_delay` seconds (from wmk_admin.yaml; default 1), but never later
+    than `MAX_WAIT_FACTOR` times that after the first one.  A hard rebuild
+    makes the merged build hard, and the build is only quick if every
+    merged request asked for a quick build.  The changed paths of the merged
+    requests are collected so that a targeted build can be made; a request
+    without paths makes the build a full one.
+    """
+    MAX_WAIT_FACTOR = 5
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = None
+        self.running = None
+        self.last = None
+        self.thread = None
+
+    def submit(self, msg=None, hard=False, quick=False, paths=None, wait=False):
+        """
+        Add a build request to the queue. `paths` are the files or
+        directories affected by the change (possibly none); without them,
+        a full build is made.  If `wait` is true, the build is
+        started immediately and the call blocks until it has finished; the
+        returned job then has the build's `error` (None if it succeeded).
+        """
+        delay = float(get_config(BASEDIR, 'wmk_admin').get('build_delay', 1))
+        now = time.monotonic()
+        with self.cond:
+            job = self.pending
+            if job is None:
+                job = self.pending = {
+                    'msgs': [], 'hard': False, 'quick': True, 'count': 0,
+                    'paths': set(), 'kind': None,
+                    'first': now, 'due': now, 'done': False, 'error': None,
+                    'queued_at': str(datetime.datetime.now())}
+            if msg:
+                job['msgs'].append(msg)
+            job['count'] += 1
+            job['hard'] = job['hard'] or bool(hard)
+            job['quick'] = job['quick'] and bool(quick) and not job['hard']
+            if paths is not None:
+                if job['paths'] is not None:
+                    job['paths'].update(paths)
+            elif not quick:
+                job['paths'] = None
+            if wait:
+                job['due'] = now
+            else:
+                job['due'] = min(now + delay,
+                                 job['first'] + delay * self.MAX_WAIT_FACTOR)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._worker, name='wmk-build', daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+            while wait and not job['done']:
+                self.cond.wait()
+        return job
+
+    def status(self):
+        with self.cond:
+            pending = self.pending
+            running = self.running
+            return {
+                'queue_depth': pending['count'] if pending else 0,
+                'pending': self._describe(pending) if pending else None,
+                'running': self._describe(running) if running else None,
+                'last': dict(self.last) if self.last else None,
+            }
+
+    def _describe(self, job):
+        return {
+            'reasons': list(job['msgs']),
+            'requests': job['count'],
+            'hard': job['hard'],
+            'quick': job['quick'],
+            'changed_paths': len(job['paths']) if job['paths'] is not None else None,
+            'kind': job['kind'],
+            'queued_at': job['queued_at'],
+        }
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while (self.pending is None
+                       or self.pending['due'] > time.monotonic()):
+                    timeout = None
+                    if self.pending is not None:
+                        timeout = self.pending['due'] - time.monotonic()
+                    self.cond.wait(timeout)
+                job = self.running = self.pending
+                self.pending = None
+            msg = '; '.join(job['msgs']) or None
+            if msg and job['count'] > 1:
+                msg = '[%d merged requests] %s' % (job['count'], msg)
+            start = time.monotonic()
+            error = None
+            report = {'warnings': [], 'errors': []}
+            try:
+                job['kind'] = wmk_build(msg, hard=job['hard'], quick=job['quick'],
+                                        paths=job['paths'], report=report)
+            except (Exception, SystemExit) as e:
+                error = str(e) or e.__class__.__name__
+                print("ERROR: Build failed: %s" % error)
+            duration = time.monotonic() - start
+            HTML_VARIANTS.clear()
+            GIT_STATUS.invalidate()
+            postprocess = None
+            if not error:
+                try:
+                    postprocess = HTDOCS_MANIFEST.update()
+                except Exception as e:
+                    print("ERROR: Post-processing of htdocs failed: %s" % e)
+            with self.cond:
+                self.last = dict(self._describe(job))
+                self.last['finished_at'] = str(datetime.datetime.now())
+                self.last['duration'] = round(duration, 3)
+                self.last['error'] = error
+                self.last['warnings'] = report['warnings']
+                self.last['errors'] = report['errors']
+                self.last['pages_written'] = (
+                    postprocess['pages_written'] if postprocess else None)
+                self.last['postprocess'] = postprocess
+                record = dict(self.last)
+                self.running = None
+                job['error'] = error
+                job['done'] = True
+                self.cond.notify_all()
+            BUILD_TELEMETRY.record(record)
+
+
+BUILD_QUEUE = BuildQueue()
+
+
+class DeployJobs:
+    """
+    Runs the `deploy` command as a background job, so that the request
+    which starts it returns at once.  Only one deployment runs at a time:
+    the job holds an exclusive lock on `tmp/deploy.lock` (which also keeps
+    other admin processes from starting one) until it has finished.
+
+    The site is rebuilt first; then the command is run with its output
+    (stdout and stderr merged) appended line by line to `tmp/deploy.log` and
+    kept in memory, where `tail()` picks it up for the front page.  A job is
+    killed when it exceeds `deploy_timeout` seconds (from wmk_admin.yaml;
+    default 600) or is cancelled.  A successful deployment touches
+    `tmp/deploy.ok`, which is where the front page gets its "Last deployment"
+    date from.
+    """
+    MAX_LINES = 2000
+    KILL_GRACE = 5
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.tmpdir = os.path.join(basedir, 'tmp')
+        self.log_file = os.path.join(self.tmpdir, 'deploy.log')
+        self.ok_file = os.path.join(self.tmpdir, 'deploy.ok')
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.current = None
+
+    def start(self, command, timeout=600):
+        """
+        Start a deployment and return `(job, started)`.  If one is already
+        running, that job is returned with `started` set to False; if one is
+        running in another admin process, `job` is None.
+        """
+        with self.lock:
+            if self.current is not None:
+                return self._describe(self.current), False
+            lock_fd = os.open(os.path.join(self.tmpdir, 'deploy.lock'),
+                              os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(lock_fd)
+                return None, False
+            job = {
+                'id': secrets.token_hex(8),
+                'command': command,
+                'timeout': timeout,
+                'status': 'building',
+                'started_at': datetime.datetime.now(),
+                'finished_at': None,
+                'returncode': None,
+                'lines': collections.deque(maxlen=self.MAX_LINES),
+                'line_count': 0,
+                'proc': None,
+                'cancelled': False,
+                'lock_fd': lock_fd,
+            }
+            self.jobs[job['id']] = job
+            while len(self.jobs) > 10:
+                self.jobs.popitem(last=False)
+            self.current = job
+        threading.Thread(target=self._run, args=(job, ),
+                         name='deploy-' + job['id'], daemon=True).start()
+        return self._describe(job), True
+
+    def cancel(self, job_id):
+        "Stop a running job. Returns False if there is no such running job."
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['finished_at'] is not None:
+                return False
+            job['cancelled'] = True
+            proc = job['proc']
+        if proc is not None:
+            self._kill(proc)
+        return True
+
+    def tail(self, job_id, after=0):
+        """
+        The job's status and the output lines numbered above `after`, or None
+        for an unknown job.  Lines which have already dropped out of memory
+        are skipped.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            ret = self._describe(job)
+            ret['lines'] = [(n, line) for n, line in job['lines'] if n > after]
+            ret['next'] = job['line_count']
+            return ret
+
+    def latest(self):
+        "The running or most recently started job, if any."
+        with self.lock:
+            if not self.jobs:
+                return None
+            return self._describe(next(reversed(self.jobs.values())))
+
+    def last_success(self):
+        try:
+            return datetime.datetime.fromtimestamp(os.stat(self.ok_file).st_mtime)
+        except OSError:
+            pass
+        # Deployments made by earlier versions only left their date here
+        try:
+            return datetime.datetime.fromtimestamp(os.stat(self.log_file).st_mtime)
+        except OSError:
+            return None
+
+    def _describe(self, job):
+        return {
+            'id': job['id'],
+            'status': job['status'],
+            'started_at': str(job['started_at'])[:19],
+            'finished_at': str(job['finished_at'])[:19] if job['finished_at'] else None,
+            'returncode': job['returncode'],
+            'timeout': job['timeout'],
+            'done': job['finished_at'] is not None,
+        }
+
+    def _add_line(self, job, log, line):
+        line = line.rstrip('\n')
+        log.write(line + '\n')
+        log.flush()
+        with self.lock:
+            job['line_count'] += 1
+            job['lines'].append((job['line_count'], line))
+
+    def _set_status(self, job, status):
+        with self.lock:
+            job['status'] = status
+
+    def _run(self, job):
+        deadline = time.monotonic() + job['timeout']
+        status = 'failed'
+        try:
+            with open(self.log_file, 'a') as log:
+                log.write("\n===== DEPLOY %s (job %s) =====\n" % (
+                    str(job['started_at'])[:19], job['id']))
+                try:
+                    self._add_line(job, log, 'Rebuilding site before deployment...')
+                    # Deployment needs an up-to-date htdocs
+                    build = BUILD_QUEUE.submit('Rebuilding before DEPLOY action', wait=True)
+                    if build['error']:
+                        self._add_line(job, log, 'ERROR: Build failed: %s' % build['error'])
+                        status = 'failed'
+                    elif job['cancelled']:
+                        status = 'cancelled'
+                    elif time.monotonic() > deadline:
+                        status = 'timeout'
+                    else:
+                        self._add_line(job, log, 'Running deployment command...')
+                        status = self._run_command(job, log, deadline)
+                except Exception as e:
+                    self._add_line(job, log, 'ERROR: %s' % e)
+                    status = 'failed'
+                self._add_line(job, log, 'Deployment %s.' % status)
+            if status == 'succeeded':
+                with open(self.ok_file, 'w') as f:
+                    f.write(str(datetime.datetime.now()) + "\n")
+            with open(os.path.join(self.tmpdir, 'admin.log'), 'a') as f:
+                f.write("\n=====\nRan DEPLOY at %s (job %s): %s. Output is in tmp/deploy.log\n" % (
+                    str(job['started_at']), job['id'], status))
+        except Exception as e:
+            print("ERROR: Deployment %s: %s" % (job['id'], e))
+        finally:
+            with self.lock:
+                job['status'] = status
+                job['finished_at'] = datetime.datetime.now()
+                job['proc'] = None
+                self.current = None
+                os.close(job['lock_fd'])
+
+    def _run_command(self, job, log, deadline):
+        proc = subprocess.Popen(
+            job['command'], cwd=self.basedir, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, text=True,
+            errors='replace', bufsize=1, start_new_session=True)
+        with self.lock:
+            job['proc'] = proc
+            job['status'] = 'running'
+        if job['cancelled']:
+            self._kill(proc)
+        timer = threading.Timer(max(0, deadline - time.monotonic()),
+                                self._timed_out, args=(job, proc))
+        timer.daemon = True
+        timer.start()
+        try:
+            for line in proc.stdout:
+                self._add_line(job, log, line)
+            job['returncode'] = proc.wait()
+        finally:
+            timer.cancel()
+        if job['status'] == 'timeout':
+            return 'timeout'
+        if job['cancelled']:
+            return 'cancelled'
+        return 'succeeded' if job['returncode'] == 0 else 'failed'
+
+    def _timed_out(self, job, proc):
+        self._set_status(job, 'timeout')
+        self._kill(proc)
+
+    def _kill(self, proc):
+        "SIGTERM the command and its children, then SIGKILL if needed."
+        def signal_group(sig):
+            try:
+                os.killpg(proc.pid, sig)
+            except OSError:
+                pass
+        signal_group(signal.SIGTERM)
+        def force():
+            if proc.poll() is None:
+                signal_group(signal.SIGKILL)
+        timer = threading.Timer(self.KILL_GRACE, force)
+        timer.daemon = True
+        timer.start()
+
+
+DEPLOYS = DeployJobs(BASEDIR)
+
+
+class BuildTelemetry:
+    """
+    One JSON record per finished build (reasons, kind, quick/hard, duration,
+    pages written, warnings and errors), appended to `tmp/builds.jsonl`,
+    which is rotated to `tmp/builds.jsonl.1` when it grows beyond
+    `MAX_FILE_SIZE`.  The durations of the last `WINDOW` builds are kept in
+    memory for the percentiles shown by `/_/admin/metrics`.
+    """
+    MAX_FILE_SIZE = 5 * 1024 * 1024
+    WINDOW = 500
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.durations = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.WINDOW))
+        self.counts = collections.Counter()
+        self.sums = collections.Counter()
+        self.warnings = 0
+        self.pages = 0
+
+    def record(self, entry):
+        kind = entry.get('kind') or 'unknown'
+        result = 'error' if entry.get('error') else 'ok'
+        with self.lock:
+            self.durations[kind].append(entry['duration'])
+            self.counts[(kind, result)] += 1
+            self.sums[kind] += entry['duration']
+            self.warnings += len(entry.get('warnings') or [])
+            self.pages += entry.get('pages_written') or 0
+            try:
+                if os.path.getsize(self.filename) > self.MAX_FILE_SIZE:
+                    os.replace(self.filename, self.filename + '.1')
+            except OSError:
+                pass
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def metrics(self):
+        "Lines in the Prometheus text format."
+        ret = [
+            '# HELP wmk_admin_build_duration_seconds Duration of recent builds, by kind.',
+            '# TYPE wmk_admin_build_duration_seconds summary',
+        ]
+        with self.lock:
+            for kind, durations in sorted(self.durations.items()):
+                ordered = sorted(durations)
+                for q in self.QUANTILES:
+                    value = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+                    ret.append(metric_line('wmk_admin_build_duration_seconds', value,
+                                       kind=kind, quantile=q))
+                ret.append(metric_line('wmk_admin_build_duration_seconds_sum',
+                                   self.sums[kind], kind=kind))
+                ret.append(metric_line('wmk_admin_build_duration_seconds_count',
+                                   sum(v for k, v in self.counts.items() if k[0] == kind),
+                                   kind=kind))
+            ret += [
+                '# HELP wmk_admin_builds_total Finished builds, by kind and result.',
+                '# TYPE wmk_admin_builds_total counter',
+            ]
+            for (kind, result), count in sorted(self.counts.items()):
+                ret.append(metric_line('wmk_admin_builds_total', count,
+                                   kind=kind, result=result))
+            ret += [
+                '# HELP wmk_admin_build_warnings_total Warnings printed by wmk during builds.',
+                '# TYPE wmk_admin_build_warnings_total counter',
+                metric_line('wmk_admin_build_warnings_total', self.warnings),
+                '# HELP wmk_admin_build_pages_written_total HTML files changed by builds.',
+                '# TYPE wmk_admin_build_pages_written_total counter',
+                metric_line('wmk_admin_build_pages_written_total', self.pages),
+            ]
+        return ret
+
+
+BUILD_TELEMETRY = BuildTelemetry(os.path.join(BASEDIR, 'tmp', 'builds.jsonl'))
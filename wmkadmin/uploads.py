@@ -0,0 +1,461 @@
+"""
+Uploads: files sent in resumable chunks (ChunkedUploads), batches of
+attachments saved in parallel with their images post-processed
+(AttachmentIngester), and the naming of uploaded files.
+"""
+
+import os
+import re
+import time
+import random
+import string
+import shutil
+import functools
+import hashlib
+import collections
+import json
+import threading
+
+from bottle import abort
+
+from .common import BASEDIR, Image, atomic_write, get_config, secrets
+from .caches import (
+    IMAGE_SIZES, THUMBNAILS, WORKER_POOL, ImageSizeCache, make_thumbnail, thumbnail_path)
+from .watcher import files_changed
+
+
+class AttachmentIngester:
+    """
+    Saves a batch of uploaded attachments in four steps: the names of all
+    files are decided at once (see batch_attachment_names()); the files are
+    written concurrently by a thread pool to temporary files in tmp/uploads/;
+    the images among them are post-processed in WORKER_POOL (EXIF data
+    removed if `strip_exif` is set in wmk_admin.yaml, dimensions probed,
+    thumbnails made), and finally all files are linked into place, so the
+    site never sees a half-written or unprocessed file.  With `strip_exif`,
+    an image whose EXIF data could not be removed is not saved at all.  The
+    caller schedules a single build for the batch.
+    """
+    SAVE_THREADS = 4
+
+    def __init__(self, basedir):
+        self.tmpdir = os.path.join(basedir, 'tmp', 'uploads')
+
+    def ingest(self, dest_dir, uploads):
+        """
+        `uploads` is a list of (original_name, save) pairs, where save(path)
+        writes the file to `path`. Returns the full paths of the saved files
+        and a list of (original_name, reason) for files which were refused.
+        """
+        if not uploads:
+            return [], []
+        import concurrent.futures
+        names = batch_attachment_names(dest_dir, [_[0] for _ in uploads])
+        os.makedirs(self.tmpdir, exist_ok=True)
+        token = secrets.token_hex(8)
+        tmp_paths = [os.path.join(self.tmpdir, '%s-%d-%s' % (token, i, filename))
+                     for i, (filename, _) in enumerate(names)]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.SAVE_THREADS) as threads:
+                list(threads.map(lambda job: job[0](job[1]),
+                                 [(save, tmp_path) for (_, save), tmp_path
+                                  in zip(uploads, tmp_paths)]))
+            processed, refused = self._postprocess(tmp_paths)
+            full_paths = [link_into_place(tmp_path, filename, full_path, True)
+                          for tmp_path, (filename, full_path) in zip(tmp_paths, names)
+                          if tmp_path not in refused]
+        finally:
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        # A hard link shares size and mtime, so the results apply to the final paths
+        sizes, hashes = [], []
+        kept = [_ for _ in tmp_paths if _ not in refused]
+        for tmp_path, full_path in zip(kept, full_paths):
+            if processed.get(tmp_path):
+                (width, height), digest, size, mtime_ns = processed[tmp_path]
+                sizes.append((full_path, size, mtime_ns, width, height))
+                hashes.append((full_path, size, mtime_ns, digest))
+        IMAGE_SIZES.store(sizes)
+        THUMBNAILS.store_hashes(hashes)
+        return full_paths, [
+            (original_name, refused[tmp_path])
+            for (original_name, _), tmp_path in zip(uploads, tmp_paths) if tmp_path in refused]
+
+    def _postprocess(self, paths):
+        """
+        Process the images among `paths`.  Returns a dict of the results
+        (None for images which could not be processed) and one of the
+        reasons for refusing images whose EXIF data could not be removed.
+        """
+        paths = [_ for _ in paths if _.lower().endswith(ImageSizeCache.IMAGE_SUFFIXES)]
+        if not paths:
+            return {}, {}
+        import concurrent.futures
+        strip_exif = bool(get_config(BASEDIR, 'wmk_admin').get('strip_exif', False))
+        futures = dict(
+            (WORKER_POOL.submit(_ingest_image, path, strip_exif, THUMBNAILS.dirname,
+                              THUMBNAILS.SIZES, THUMBNAILS.format), path)
+            for path in paths)
+        ret, refused = {}, {}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                ret[futures[future]] = future.result()
+            except Exception as e:
+                # Only a failure to strip EXIF data (or a crashed worker, after
+                # which it is unknown whether it was stripped) gets here
+                name = os.path.basename(futures[future])
+                if strip_exif:
+                    print("WARNING: Refused image %s: EXIF data could not be removed: %s" % (
+                        name, e))
+                    refused[futures[future]] = 'EXIF data could not be removed'
+                else:
+                    print("WARNING: Could not process image %s: %s" % (name, e))
+                    ret[futures[future]] = None
+        return ret, refused
+
+
+def _ingest_image(path, strip_exif, thumb_dir, sizes, fmt):
+    """
+    Post-process an uploaded image (in a worker process): optionally remove
+    its EXIF data, then make its thumbnails.  Returns its dimensions, SHA-1,
+    size and mtime_ns, or None if only the thumbnails etc. failed (left for
+    IMAGE_SIZES and THUMBNAILS to deal with on demand).  If the EXIF data
+    cannot be removed, the exception is raised.
+    """
+    if strip_exif:
+        _strip_exif(path)
+    try:
+        with Image.open(path) as im:
+            dimensions = im.size
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        for size in sizes:
+            thumb_path = thumbnail_path(thumb_dir, digest, size, fmt)
+            if not os.path.exists(thumb_path):
+                make_thumbnail(path, thumb_path, size, fmt)
+        st = os.stat(path)
+    except Exception as e:
+        print("WARNING: Could not process image %s: %s" % (os.path.basename(path), e))
+        return None
+    return dimensions, digest, st.st_size, st.st_mtime_ns
+
+
+def _strip_exif(path):
+    """
+    Remove the EXIF data (camera, GPS position etc.) from a JPEG, PNG or
+    WebP image, turning it according to its orientation tag first. Unturned
+    JPEGs keep their original quantization (quality='keep').
+    """
+    from PIL import ImageOps
+    with Image.open(path) as im:
+        fmt = im.format
+        exif = im.getexif()
+        if fmt not in ('JPEG', 'PNG', 'WEBP') or not exif:
+            return
+        options = {}
+        if im.info.get('icc_profile'):
+            options['icc_profile'] = im.info['icc_profile']
+        if exif.get(0x0112, 1) != 1:
+            out = ImageOps.exif_transpose(im)
+            if fmt != 'PNG':
+                options['quality'] = 92
+        else:
+            out = im
+            if fmt == 'JPEG':
+                options['quality'] = 'keep'
+            elif fmt == 'WEBP':
+                options['quality'] = 92
+        out.info.pop('exif', None)
+        tmp_path = path + '.exif.tmp'
+        out.save(tmp_path, fmt, **options)
+    os.replace(tmp_path, path)
+
+
+def _link_or_copy(src_path, dest_path):
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copyfile(src_path, dest_path)
+
+
+ATTACHMENTS = AttachmentIngester(BASEDIR)
+
+
+def upload_destination(kind, dest_dir, original_name, dest_name=''):
+    """
+    Check where an uploaded file is going and decide its name. `kind` is
+    either 'file' (from the upload form; `dest_dir` must be an existing
+    directory below static, content or data and `dest_name` may give the
+    filename) or 'attachment' (below content; the directory is created if
+    needed). Returns (filename, full_path, automatic_name).
+    """
+    if kind == 'attachment':
+        if not dest_dir.startswith('content'):
+            abort(403, "Invalid destination directory: {}".format(dest_dir))
+        full_dest_dir = os.path.join(BASEDIR, dest_dir)
+        if not os.path.isdir(full_dest_dir):
+            os.mkdir(full_dest_dir)
+            files_changed([full_dest_dir])
+        filename = attachment_filename(original_name)
+        return filename, os.path.join(full_dest_dir, filename), True
+    ok_dirs = ('static', 'content', 'data')
+    if not (dest_dir in ok_dirs or dest_dir.startswith(tuple([_+'/' for _ in ok_dirs]))):
+        abort(403, "Invalid destination directory: {}".format(dest_dir))
+    if not os.path.isdir(os.path.join(BASEDIR, dest_dir)):
+        abort(403, "Destination directory '{}' does not exist".format(dest_dir))
+    filename = dest_name.strip('/')
+    automatic_name = False
+    if '/' in filename:
+        abort(403, "Slashes in filenames not allowed; please create directory first if needed")
+    if not filename:
+        filename = clean_upload_filename(original_name)
+        automatic_name = True
+    if filename.startswith('.'):
+        abort(403, "Names of uploaded files must not start with a dot")
+    if not re.search(r'\.\w{1,8}$', filename):
+        abort(403, "Uploaded files must have a valid file extension")
+    if len(filename) > 42:
+        filename = filename[:20] + '__' + filename[-20:]
+    return filename, os.path.join(BASEDIR, dest_dir, filename), automatic_name
+
+
+def attachment_filename(original_name):
+    filename = clean_upload_filename(original_name)
+    while filename.startswith('.'):
+         filename = filename[1:]
+    if len(filename) > 42:
+         filename = filename[:20] + '__' + filename[-20:]
+    if not re.search(r'\.\w{1,8}$', filename):
+        filename += '.bin'
+    return filename
+
+
+def batch_attachment_names(dest_dir, original_names):
+    """
+    Decide the names of a batch of attachments at once, against a single
+    listing of the destination directory. Returns (filename, full_path)
+    pairs in the same order as `original_names`.
+    """
+    upload_destination('attachment', dest_dir, '')
+    full_dest_dir = os.path.join(BASEDIR, dest_dir)
+    taken = set(os.listdir(full_dest_dir))
+    ret = []
+    for original_name in original_names:
+        filename = attachment_filename(original_name)
+        while filename in taken:
+            filename = add_random_suffix(filename)
+        taken.add(filename)
+        ret.append((filename, os.path.join(full_dest_dir, filename)))
+    return ret
+
+
+def add_random_suffix(filename):
+    rand = '__' + ''.join(random.choices(string.ascii_uppercase, k=5))
+    return re.sub(r'(\.\w{1,8})$', rand + r'\1', filename)
+
+
+def clean_upload_filename(filename):
+    "Lowercase, without any directory part, with underscores for whitespace."
+    filename = filename.lower()
+    filename = re.sub(r'^.*[/\\]', '', filename)
+    filename = re.sub(r'\s+', '_', filename)
+    filename = re.sub(r'__+', '_', filename)
+    return filename
+
+
+def free_upload_path(filename, full_path, automatic_name):
+    """
+    If a file already exists at `full_path`, add a random suffix to an
+    automatic name or refuse the upload. Returns (filename, full_path).
+    """
+    if os.path.exists(full_path) and automatic_name:
+        filename = add_random_suffix(filename)
+        full_path = os.path.join(os.path.dirname(full_path), filename)
+    if os.path.exists(full_path):
+        abort(403, 'Overwriting files via upload is not allowed')
+    return filename, full_path
+
+
+def link_into_place(src_path, filename, full_path, automatic_name):
+    """
+    Hard-link a completely written file to its final name, which fails
+    rather than overwriting a file created in the meantime (in which case an
+    automatic name gets another suffix), and remove `src_path`. Returns the
+    final path.
+    """
+    for attempt in range(5):
+        filename, full_path = free_upload_path(filename, full_path, automatic_name)
+        try:
+            try:
+                os.link(src_path, full_path)
+            except OSError as e:
+                if isinstance(e, FileExistsError):
+                    raise
+                # E.g. tmp is on another filesystem: copy next to the target first
+                tmp_path = os.path.join(
+                    os.path.dirname(full_path), '.%s.upload' % os.path.basename(src_path))
+                shutil.copyfile(src_path, tmp_path)
+                try:
+                    os.link(tmp_path, full_path)
+                finally:
+                    os.remove(tmp_path)
+            os.remove(src_path)
+            return full_path
+        except FileExistsError:
+            continue
+    abort(409, 'Could not find a free name for the uploaded file')
+
+
+def max_upload_size():
+    "In bytes, from the `max_upload_size` setting (in MB; default 1024)."
+    conf = get_config(BASEDIR, 'wmk_admin')
+    return int(float(conf.get('max_upload_size', 1024)) * 1024 * 1024)
+
+
+def check_upload_size(size):
+    if size and size > max_upload_size():
+        abort(413, 'The upload is larger than max_upload_size (%d MB)' % (
+            max_upload_size() // (1024 * 1024)))
+
+
+class ChunkedUploads:
+    """
+    Uploads sent in chunks (see static/js/chunked-upload.js), which are
+    written straight from the request to tmp/uploads/<id>.part without
+    being buffered by bottle.  Each chunk is sent with the offset at which
+    it belongs, so that an interrupted upload can be resumed from the
+    current size of the part file, and optionally with its SHA-256 hash,
+    which is checked before the chunk is accepted.  The upload's metadata
+    is kept in tmp/uploads/<id>.json, so an upload survives a restart of
+    the server.  Unfinished uploads are removed after `MAX_AGE` seconds.
+
+    When all files of a batch have been sent, `finish()` links each of them
+    into place (so that the site never sees a partial file) and the batch
+    is built once.
+    """
+    CHUNK_SIZE = 4 * 1024 * 1024
+    MAX_CHUNK_SIZE = 16 * 1024 * 1024
+    MAX_AGE = 24 * 3600
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, basedir):
+        self.dirname = os.path.join(basedir, 'tmp', 'uploads')
+        self.locks = collections.defaultdict(threading.Lock)
+
+    def start(self, kind, dest_dir, original_name, size, dest_name=''):
+        "Validate a new upload and return its id."
+        if size < 0:
+            abort(400, 'Invalid size')
+        check_upload_size(size)
+        upload_destination(kind, dest_dir, original_name, dest_name)
+        self.sweep()
+        os.makedirs(self.dirname, exist_ok=True)
+        upload_id = secrets.token_hex(16)
+        meta = {'kind': kind, 'dest_dir': dest_dir, 'name': original_name,
+                'dest_name': dest_name, 'size': size}
+        open(self._path(upload_id, '.part'), 'wb').close()
+        atomic_write(self._path(upload_id, '.json'), json.dumps(meta))
+        return upload_id
+
+    def info(self, upload_id):
+        "The metadata of an unfinished upload, including its current `offset`."
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                meta = json.load(f)
+            meta['offset'] = os.path.getsize(self._path(upload_id, '.part'))
+        except (OSError, ValueError):
+            abort(404, 'No such upload')
+        return meta
+
+    def write_chunk(self, upload_id, offset, stream, length, sha256=None):
+        """
+        Append `length` bytes from `stream` at `offset`, which must be the
+        current size of the part file.  Returns the new offset.
+        """
+        if length > self.MAX_CHUNK_SIZE:
+            abort(413, 'Chunks may be at most %d bytes' % self.MAX_CHUNK_SIZE)
+        with self.locks[upload_id]:
+            meta = self.info(upload_id)
+            if offset != meta['offset']:
+                abort(409, 'Expected offset %d' % meta['offset'])
+            if offset + length > meta['size']:
+                abort(413, 'More data than the declared size of the upload')
+            digest = hashlib.sha256()
+            with open(self._path(upload_id, '.part'), 'r+b') as f:
+                f.seek(offset)
+                remaining = length
+                while remaining > 0:
+                    block = stream.read(min(self.BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    f.write(block)
+                    digest.update(block)
+                    remaining -= len(block)
+                if remaining or (sha256 and digest.hexdigest() != sha256.lower()):
+                    # Incomplete or corrupted chunk: the client should resend it
+                    f.truncate(offset)
+                    abort(400, 'Chunk incomplete or hash mismatch')
+            return offset + length
+
+    def finish(self, upload_ids):
+        """
+        Move a batch of completed uploads, which must all have the same
+        destination, into place. Attachments go through ATTACHMENTS.
+        Returns (kind, dest_dir, full_paths, refused), where `refused` lists
+        the (name, reason) of attachments which were not saved.
+        """
+        metas = [(_, self.info(_)) for _ in upload_ids]
+        for upload_id, meta in metas:
+            if meta['offset'] != meta['size']:
+                abort(409, 'Upload of %s is incomplete' % meta['name'])
+        destinations = set((meta['kind'], meta['dest_dir']) for _, meta in metas)
+        if len(destinations) != 1:
+            abort(400, 'All files in a batch must have the same destination')
+        kind, dest_dir = destinations.pop()
+        refused = []
+        if kind == 'attachment':
+            full_paths, refused = ATTACHMENTS.ingest(dest_dir, [
+                (meta['name'], functools.partial(_link_or_copy, self._path(upload_id, '.part')))
+                for upload_id, meta in metas])
+        else:
+            full_paths = []
+            for upload_id, meta in metas:
+                with self.locks[upload_id]:
+                    filename, full_path, automatic_name = upload_destination(
+                        kind, dest_dir, meta['name'], meta['dest_name'])
+                    full_paths.append(link_into_place(
+                        self._path(upload_id, '.part'), filename, full_path, automatic_name))
+        for upload_id, meta in metas:
+            self.locks.pop(upload_id, None)
+            for suffix in ('.part', '.json'):
+                try:
+                    os.remove(self._path(upload_id, suffix))
+                except FileNotFoundError:
+                    pass
+        return kind, dest_dir, full_paths, refused
+
+    def sweep(self):
+        "Remove uploads which were started more than `MAX_AGE` seconds ago."
+        cutoff = time.time() - self.MAX_AGE
+        try:
+            entries = list(os.scandir(self.dirname))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _path(self, upload_id, suffix):
+        if not re.match(r'^[0-9a-f]{32}$', upload_id):
+            abort(404, 'No such upload')
+        return os.path.join(self.dirname, upload_id + suffix)
+
+
+UPLOADS = ChunkedUploads(BASEDIR)
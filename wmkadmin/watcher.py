@@ -0,0 +1,328 @@
+"""
+The file watcher, which notices changes made outside the admin, and
+files_changed(), through which all changes reach the in-memory indexes.
+"""
+
+import os
+import sys
+import time
+import threading
+
+from .common import BASEDIR, CONFIG_CACHE, errno, get_config, select, struct
+
+# Called by files_changed() with the list of changed paths; the caches
+# module adds its indexes
+CHANGE_LISTENERS = [CONFIG_CACHE.update_paths]
+
+
+def files_changed(paths, external=False):
+    """
+    Tell the in-process indexes that the given files or directories were
+    created, modified or removed.  Unless the change was made outside the
+    admin (`external`, as reported by the file watcher), the watcher is told
+    not to report it again.
+    """
+    if not external:
+        WATCHER.ignore(paths)
+    for listener in CHANGE_LISTENERS:
+        try:
+            listener(paths)
+        except Exception as e:
+            print("WARNING: Could not update index after change: %s" % e)
+
+
+class FileWatcher:
+    """
+    Notices changes to content, data, templates, static, wmk_config.yaml and
+    wmk_admin.yaml made by other means than the admin (git pull, rsync, an
+    editor over SSH, ...) and publishes them through files_changed(), which
+    keeps the in-memory indexes and caches current, and BUILD_QUEUE, which
+    rebuilds the site.  While the watcher runs, those indexes rely on it
+    instead of rescanning the tree now and then.
+
+    On Linux, inotify is used (through ctypes), with a watch on each
+    directory; elsewhere, or if no more inotify watches can be added, the
+    tree is polled every `watch_interval` seconds (from wmk_admin.yaml;
+    default 5).  Events are collected until none has arrived for
+    `DEBOUNCE` seconds (but for no longer than `MAX_DELAY`) and then
+    published together.  Changes which the admin has itself announced
+    through files_changed() are not published again.
+    """
+    SECTIONS = ('content', 'data', 'templates', 'static')
+    CONFIG_FILES = ('wmk_config.yaml', 'wmk_admin.yaml')
+    DEBOUNCE = 0.5
+    MAX_DELAY = 5
+    IGNORE_TTL = 60
+
+    # From <sys/inotify.h>
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = 'iIII'
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.lock = threading.Lock()
+        self.active = False
+        self.mode = None
+        self.ignored = {}
+        self.pending = set()
+        self.first_event = self.last_event = None
+        self.ctypes = self.libc = None
+        self.fd = None
+        self.watches = {}
+        self.snapshot = None
+        self.published = 0
+        self.suppressed = 0
+
+    def start(self):
+        """
+        Start watching in a background thread, unless `watch_files` in
+        wmk_admin.yaml is false.  With `watch_files: poll`, inotify is not
+        tried.
+        """
+        setting = get_config(self.basedir, 'wmk_admin').get('watch_files', True)
+        if self.active or setting is False:
+            return
+        if setting == 'poll' or not self._start_inotify():
+            self.mode = 'poll'
+            self.snapshot = self._poll_snapshot()
+        self.active = True
+        threading.Thread(target=self._run, name='file-watcher', daemon=True).start()
+
+    def watches_file(self, path):
+        "True if changes to this configuration file are being watched."
+        return self.active and os.path.dirname(path) == self.basedir \
+            and os.path.basename(path) in self.CONFIG_FILES
+
+    def ignore(self, paths):
+        "Do not publish events for these paths while they stay as they are now."
+        if not self.active:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for path in paths:
+                self.ignored[os.path.normpath(path)] = (self._signature(path), now)
+            for path, (_, when) in list(self.ignored.items()):
+                if now - when > self.IGNORE_TTL:
+                    del self.ignored[path]
+
+    def stats(self):
+        return {'mode': self.mode if self.active else None,
+                'watches': len(self.watches), 'published': self.published,
+                'suppressed': self.suppressed}
+
+    def _signature(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _add(self, path):
+        with self.lock:
+            if self.first_event is None:
+                self.first_event = time.monotonic()
+            self.last_event = time.monotonic()
+            self.pending.add(os.path.normpath(path))
+
+    def _due(self):
+        "Seconds until pending events should be published (None if there are none)."
+        with self.lock:
+            if self.first_event is None:
+                return None
+            return max(0, min(self.last_event + self.DEBOUNCE,
+                              self.first_event + self.MAX_DELAY) - time.monotonic())
+
+    def _publish(self):
+        with self.lock:
+            pending, self.pending = self.pending, set()
+            self.first_event = self.last_event = None
+            paths = []
+            for path in sorted(pending):
+                known = self.ignored.get(path)
+                if known and known[0] == self._signature(path):
+                    self.suppressed += 1
+                    continue
+                paths.append(path)
+        if not paths:
+            return
+        self.published += len(paths)
+        files_changed(paths, external=True)
+        admin_conf = os.path.join(self.basedir, 'wmk_admin.yaml')
+        build_paths = [_ for _ in paths if _ != admin_conf]
+        if build_paths:
+            # Imported here because the deploy module depends on this one
+            from .deploy import BUILD_QUEUE
+            names = [os.path.relpath(_, self.basedir) for _ in build_paths]
+            BUILD_QUEUE.submit('Changed outside the admin: %s%s' % (
+                ', '.join(names[:3]), ' (+%d more)' % (len(names) - 3) if len(names) > 3 else ''),
+                paths=build_paths)
+
+    def _run(self):
+        while True:
+            try:
+                if self.mode == 'inotify':
+                    self._read_events(self._due())
+                else:
+                    due = self._due()
+                    if due is None:
+                        time.sleep(float(get_config(self.basedir, 'wmk_admin').get(
+                            'watch_interval', 5)))
+                        self._poll()
+                    else:
+                        time.sleep(due)
+                if self._due() == 0:
+                    self._publish()
+            except Exception as e:
+                print("WARNING: File watcher: %s" % e)
+                time.sleep(1)
+
+    # ----- inotify -----
+
+    def _start_inotify(self):
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+        self.ctypes, self.libc, self.fd, self.mode = ctypes, libc, fd, 'inotify'
+        try:
+            self._watch(self.basedir, recursive=False)
+            for section in self.SECTIONS:
+                self._watch(os.path.join(self.basedir, section))
+        except OSError as e:
+            print("WARNING: Could not watch files with inotify (%s); polling instead" % e)
+            os.close(fd)
+            self.ctypes = self.libc = self.fd = self.mode = None
+            self.watches = {}
+            return False
+        return True
+
+    def _watch(self, root, recursive=True):
+        "Add watches for `root` and (if `recursive`) the directories below it."
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+            if wd < 0:
+                err = self.ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, 'inotify watch limit reached')
+                continue  # Removed in the meantime
+            self.watches[wd] = path
+            if not recursive:
+                continue
+            try:
+                with os.scandir(path) as it:
+                    stack.extend(_.path for _ in it
+                                 if not _.name.startswith('.') and _.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def _unwatch(self, root):
+        "Remove the watches for `root` and the directories below it."
+        for wd, path in list(self.watches.items()):
+            if path == root or path.startswith(root + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def _read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        buf = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = struct.unpack_from(self.EVENT_HEADER, buf, offset)
+            offset += struct.calcsize(self.EVENT_HEADER)
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost: have everything looked at again
+                for section in self.SECTIONS:
+                    self._add(os.path.join(self.basedir, section))
+                for fn in self.CONFIG_FILES:
+                    self._add(os.path.join(self.basedir, fn))
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            parent = self.watches.get(wd)
+            if parent is None or not name or name.startswith('.'):
+                continue
+            path = os.path.join(parent, name)
+            if parent == self.basedir:
+                if name in self.CONFIG_FILES:
+                    self._add(path)
+                elif name in self.SECTIONS and mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self._watch(path)
+                    self._add(path)
+                continue
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._watch(path)
+                elif mask & self.IN_MOVED_FROM:
+                    self._unwatch(path)
+            self._add(path)
+
+    # ----- polling -----
+
+    def _poll_snapshot(self):
+        ret = {}
+        for fn in self.CONFIG_FILES:
+            path = os.path.join(self.basedir, fn)
+            sig = self._signature(path)
+            if sig:
+                ret[path] = (False, sig)
+        stack = [os.path.join(self.basedir, _) for _ in self.SECTIONS]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            ret[entry.path] = (True, None)
+                        else:
+                            st = entry.stat()
+                            ret[entry.path] = (False, (st.st_mtime_ns, st.st_size))
+                    except OSError:
+                        pass
+        return ret
+
+    def _poll(self):
+        old, new = self.snapshot, self._poll_snapshot()
+        self.snapshot = new
+        for path, entry in new.items():
+            if old.get(path) != entry:
+                self._add(path)
+        for path in old:
+            if path not in new:
+                self._add(path)
+
+
+WATCHER = FileWatcher(BASEDIR)
+CONFIG_CACHE.watcher = WATCHER